@@ -0,0 +1,105 @@
+"""
+Reference lattices and physics processes for the tracking benchmarks.
+
+Every builder returns (lattice, navigator, parray) for the given number of particles.
+"""
+import numpy as np
+
+from ocelot.cpbd.magnetic_lattice import MagneticLattice
+from ocelot.cpbd.elements import Drift, Quadrupole, SBend, Bend, Cavity, Marker, Sextupole, Undulator
+from ocelot.cpbd.transformations import SecondTM
+from ocelot.cpbd.navi import Navigator
+from ocelot.cpbd.beam import generate_parray
+from ocelot.cpbd.csr import CSR
+from ocelot.cpbd.sc import SpaceCharge, SpaceChargeRZ, LSC
+
+
+def fodo_ring(nparticles):
+    """
+    Ring of 16 FODO cells with sextupoles, second order maps, no collective effects.
+    """
+    angle = 2 * np.pi / 32
+    qf = Quadrupole(l=0.3, k1=1.2)
+    qd = Quadrupole(l=0.3, k1=-1.2)
+    sf = Sextupole(l=0.1, k2=10.)
+    sd = Sextupole(l=0.1, k2=-15.)
+    b = SBend(l=1.5, angle=angle)
+    d = Drift(l=0.35)
+    cell = [qf, d, sf, d, b, d, sd, d, qd, d, sd, d, b, d, sf, d]
+    lat = MagneticLattice(cell * 16, method={"global": SecondTM})
+    navi = Navigator(lat)
+    parray = generate_parray(sigma_x=1e-4, sigma_px=1e-5, sigma_tau=1e-3, sigma_p=1e-3, chirp=0.,
+                             nparticles=nparticles, energy=3.)
+    return lat, navi, parray
+
+
+def chicane_csr(nparticles):
+    """
+    Bunch compressor chicane with CSR.
+    """
+    angle = 0.132729704703
+    b1 = Bend(l=0.501471, angle=angle, e1=0.0, e2=angle)
+    b2 = Bend(l=0.501471, angle=-angle, e1=-angle, e2=0.0)
+    b3 = Bend(l=0.501471, angle=-angle, e1=0.0, e2=-angle)
+    b4 = Bend(l=0.501471, angle=angle, e1=angle, e2=0.0)
+    d = Drift(l=1.5 / np.cos(angle))
+    start_csr, stop_csr = Marker(), Marker()
+    cell = [Drift(l=0.1), start_csr, b1, d, b2, Drift(l=1.5), b3, d, b4, Drift(l=1.), stop_csr]
+    lat = MagneticLattice(cell, method={"global": SecondTM})
+    navi = Navigator(lat, unit_step=0.1)
+    navi.add_physics_proc(CSR(traj_step=0.0002, apply_step=0.0005), start_csr, stop_csr)
+    parray = generate_parray(sigma_tau=1e-3, sigma_p=1e-4, chirp=-0.02, charge=0.5e-9, nparticles=nparticles,
+                             energy=0.13)
+    return lat, navi, parray
+
+
+def injector_sc(nparticles, sc_proc=None):
+    """
+    Low energy injector: accelerating cavities and quadrupoles with 3D space charge.
+    """
+    cav = Cavity(l=1.0377, v=0.0185, freq=1.3e9, phi=0.)
+    d = Drift(l=0.3459)
+    q1 = Quadrupole(l=0.2, k1=-1.5)
+    q2 = Quadrupole(l=0.2, k1=1.5)
+    cell = [Drift(l=0.5)] + [cav, d] * 4 + [q1, Drift(l=1.), q2, Drift(l=1.)]
+    lat = MagneticLattice(cell)
+    navi = Navigator(lat, unit_step=0.1)
+    if sc_proc is None:
+        sc_proc = SpaceCharge(nmesh_xyz=[31, 31, 31])
+    navi.add_physics_proc(sc_proc, lat.sequence[0], lat.sequence[-1])
+    parray = generate_parray(sigma_x=3e-4, sigma_px=1e-5, sigma_tau=1e-3, sigma_p=1e-3, chirp=0., charge=250e-12,
+                             nparticles=nparticles, energy=0.0065)
+    return lat, navi, parray
+
+
+def injector_sc_rz(nparticles):
+    """
+    The same injector with the r-z space charge solver (3D solver for the non-round bunch after the quadrupoles).
+    """
+    return injector_sc(nparticles, SpaceChargeRZ(nmesh_xyz=[31, 31, 31], nmesh_rz=[32, 64]))
+
+
+def undulator_line(nparticles):
+    """
+    Undulator line with FODO focusing and LSC.
+    """
+    und = Undulator(lperiod=0.04, nperiods=125, Kx=1.5)
+    qf = Quadrupole(l=0.1, k1=1.)
+    qd = Quadrupole(l=0.1, k1=-1.)
+    d = Drift(l=0.5)
+    cell = [und, d, qf, d, und, d, qd, d] * 4
+    lat = MagneticLattice(cell, method={"global": SecondTM})
+    navi = Navigator(lat, unit_step=0.5)
+    navi.add_physics_proc(LSC(), lat.sequence[0], lat.sequence[-1])
+    parray = generate_parray(sigma_x=3e-5, sigma_px=3e-6, sigma_tau=1e-5, sigma_p=1e-4, chirp=0., charge=250e-12,
+                             nparticles=nparticles, energy=2.)
+    return lat, navi, parray
+
+
+CASES = {
+    "fodo_ring": fodo_ring,
+    "chicane_csr": chicane_csr,
+    "injector_sc": injector_sc,
+    "injector_sc_rz": injector_sc_rz,
+    "undulator_line": undulator_line,
+}
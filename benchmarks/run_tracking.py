@@ -0,0 +1,129 @@
+"""
+Tracking benchmarks: throughput, peak memory and time split per Transformation and PhysProc.
+
+Every (case, nparticles) runs in a separate process, so the peak RSS belongs to that run only.
+
+    python benchmarks/run_tracking.py --particles 10000 100000 --output results.json
+    python benchmarks/run_tracking.py --cases chicane_csr --output new.json --compare results.json
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+
+def run_case(case, nparticles, repeat):
+    """
+    Tracks the case `repeat` times and returns the record of the fastest run
+    """
+    import numpy as np
+    import ocelot
+    from ocelot.cpbd.track import track
+    from ocelot.cpbd import csr, sc
+    from lattices import CASES
+
+    best = None
+    for _ in range(repeat):
+        lat, navi, parray = CASES[case](nparticles)
+        timings = {}
+        start = time.perf_counter()
+        track(lat, parray, navi, print_progress=False, calc_tws=True, timings=timings)
+        t = time.perf_counter() - start
+        if best is None or t < best["time"]:
+            best = {"time": t, "timings": timings}
+
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        rss /= 1024
+    return {
+        "case": case,
+        "nparticles": nparticles,
+        "length": lat.totalLen,
+        "time": best["time"],
+        "particles_m_per_s": nparticles * lat.totalLen / best["time"],
+        "peak_rss_mb": rss / 1024.,
+        "timings": best["timings"],
+        "env": {
+            "ocelot": ocelot.__version__,
+            "numpy": np.__version__,
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "numba": csr.nb_flag,
+            "numexpr": sc.ne_flag,
+            "pyfftw": sc.pyfftw_flag,
+        },
+    }
+
+
+def compare(results, reference, threshold):
+    """
+    Prints the throughput ratio new/reference for the runs present in both files
+
+    :return: number of regressions, i.e. runs slower than the reference by more than threshold
+    """
+    ref = {(r["case"], r["nparticles"]): r for r in reference}
+    n_regressions = 0
+    print("%-16s %10s %14s %14s %8s" % ("case", "particles", "ref [p*m/s]", "new [p*m/s]", "ratio"))
+    for r in results:
+        r0 = ref.get((r["case"], r["nparticles"]))
+        if r0 is None:
+            continue
+        ratio = r["particles_m_per_s"] / r0["particles_m_per_s"]
+        flag = ""
+        if ratio < 1. - threshold:
+            flag = " <- slower"
+            n_regressions += 1
+        print("%-16s %10d %14.4g %14.4g %8.3f%s" % (r["case"], r["nparticles"], r0["particles_m_per_s"],
+                                                  r["particles_m_per_s"], ratio, flag))
+    return n_regressions
+
+
+def main():
+    from lattices import CASES
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--cases", nargs="+", default=list(CASES), choices=list(CASES))
+    parser.add_argument("--particles", nargs="+", type=int, default=[10000, 100000])
+    parser.add_argument("--repeat", type=int, default=1, help="number of runs, the fastest one is reported")
+    parser.add_argument("--output", default="benchmark_results.json")
+    parser.add_argument("--compare", default=None, help="json file of a previous run")
+    parser.add_argument("--threshold", type=float, default=0.1, help="relative slowdown reported as regression")
+    parser.add_argument("--single", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.single:
+        print(json.dumps(run_case(args.cases[0], args.particles[0], args.repeat)))
+        return
+
+    results = []
+    for case in args.cases:
+        for n in args.particles:
+            out = subprocess.run([sys.executable, os.path.abspath(__file__), "--single", "--cases", case,
+                                  "--particles", str(n), "--repeat", str(args.repeat)],
+                                 stdout=subprocess.PIPE, check=True, universal_newlines=True)
+            r = json.loads(out.stdout.strip().splitlines()[-1])
+            results.append(r)
+            split = ", ".join("%s: %.2f" % (k, v) for k, v in sorted(r["timings"].items(), key=lambda x: -x[1]))
+            print("%-16s n = %-8d %8.2f s  %10.4g p*m/s  %7.1f MB  [%s]" % (case, n, r["time"],
+                                                                          r["particles_m_per_s"],
+                                                                          r["peak_rss_mb"], split))
+
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            reference = json.load(f)
+        if compare(results, reference, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+"""
+Space charge solver benchmark: time of the field calculation of SpaceCharge (3D) and SpaceChargeRZ
+for a sequence of round bunches whose length changes along the beamline (e.g. in a buncher), so the
+kernel caches are used as in tracking.
+
+    python benchmarks/space_charge_solvers.py --particles 10000 100000 1000000 --steps 50
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def run(nparticles, nsteps, stretch, rz_kernel_rtol):
+    """
+    :return: (time of SpaceCharge, time of SpaceChargeRZ, relative rms difference of Ez) for all steps
+    """
+    import numpy as np
+    from ocelot.cpbd.sc import SpaceCharge, SpaceChargeRZ
+
+    X0 = np.random.default_rng(1).normal(size=(nparticles, 3)) * [1e-4, 1e-4, 3e-4]
+    Q = np.ones(nparticles) * 250e-12 / nparticles
+    nxyz = np.array([63, 63, 63])
+    sc, sc_rz = SpaceCharge(), SpaceChargeRZ(nmesh_rz=[32, 64], rz_kernel_rtol=rz_kernel_rtol)
+    t_3d = t_rz = 0.
+    diff = []
+    for scale_z in np.linspace(1, stretch, nsteps):
+        X = X0 * [1, 1, scale_z]
+        start = time.perf_counter()
+        E_3d = sc.el_field(X.copy(), Q, 5., nxyz)
+        t_3d += time.perf_counter() - start
+        start = time.perf_counter()
+        E_rz = sc_rz.el_field(X.copy(), Q, 5., nxyz)
+        t_rz += time.perf_counter() - start
+        diff.append(np.std(E_rz[:, 2] - E_3d[:, 2]) / np.std(E_3d[:, 2]))
+    return t_3d, t_rz, max(diff)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--particles", nargs="+", type=int, default=[10000, 100000])
+    parser.add_argument("--steps", type=int, default=50)
+    parser.add_argument("--stretch", type=float, default=1.2, help="final/initial bunch length")
+    parser.add_argument("--rz-kernel-rtol", type=float, default=0.03, help="SpaceChargeRZ.rz_kernel_rtol")
+    args = parser.parse_args()
+
+    print("%10s %10s %10s %8s %10s" % ("particles", "3D [s]", "RZ [s]", "speedup", "dEz [rms]"))
+    for n in args.particles:
+        t_3d, t_rz, diff = run(n, args.steps, args.stretch, args.rz_kernel_rtol)
+        print("%10d %10.3f %10.3f %8.1f %10.3f" % (n, t_3d, t_rz, t_3d / t_rz, diff))
+
+
+if __name__ == "__main__":
+    main()
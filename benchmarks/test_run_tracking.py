@@ -0,0 +1,18 @@
+"""
+Smoke test of the tracking benchmark runner on a small case of benchmarks/lattices.py:
+
+    python -m pytest benchmarks
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from run_tracking import run_case
+
+
+def test_run_case():
+    result = run_case("fodo_ring", 1000, repeat=1)
+    assert set(result["timings"]) == {"SecondTM", "get_twiss"}
+    assert result["time"] >= sum(result["timings"].values()) > 0
+    assert result["particles_m_per_s"] > 0
@@ -0,0 +1,45 @@
+"""
+Tracking of one bunch through a chicane with CSR, the particles are distributed between MPI ranks.
+
+mpirun -n 4 python csr_ex_mpi.py
+"""
+from ocelot import *
+from ocelot.cpbd.parallel import ParticleComm, scatter_parray, gather_parray, track_mpi
+from mpi4py import MPI
+import time
+
+comm = ParticleComm(MPI.COMM_WORLD)
+
+b1 = Bend(l=0.501471, angle=0.132729704703, e1=0.0, e2=0.132729704703, eid="b")
+b2 = Bend(l=0.501471, angle=-0.132729704703, e1=-0.132729704703, e2=0.0, eid="b")
+b3 = Bend(l=0.501471, angle=-0.132729704703, e1=0.0, e2=-0.132729704703, eid="b")
+b4 = Bend(l=0.501471, angle=0.132729704703, e1=0.132729704703, e2=0.0, eid="b")
+d = Drift(l=1.5 / np.cos(b2.angle))
+start_csr = Marker()
+stop_csr = Marker()
+
+cell = [Drift(l=0.1), start_csr, b1, d, b2, Drift(l=1.5), b3, d, b4, Drift(l=1.), stop_csr]
+lat = MagneticLattice(cell)
+
+p_array = None
+if comm.rank == 0:
+    p_array = generate_parray(sigma_tau=0.001, sigma_p=1e-4, chirp=-0.02, charge=0.5e-9, nparticles=1000000,
+                              energy=0.13)
+p_array = scatter_parray(p_array, comm)
+
+csr = CSR()
+csr.traj_step = 0.0002
+csr.apply_step = 0.0005
+
+navi = Navigator(lat)
+navi.add_physics_proc(csr, start_csr, stop_csr)
+navi.unit_step = 0.1
+
+start = time.time()
+tws, p_array = track_mpi(lat, p_array, navi, comm)
+p_array = gather_parray(p_array, comm)
+
+if comm.rank == 0:
+    print("tracking time: ", time.time() - start, " sec")
+    print("emit_x = ", tws[-1].emit_x)
+    sI1, I1 = get_current(p_array, num_bins=200)
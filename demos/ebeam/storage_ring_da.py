@@ -41,7 +41,7 @@ pxy_list = create_track_list(x_array, y_array, p_array=[0.])
 pxy_list = track_nturns( lat, nturns, pxy_list,  nsuperperiods=8, save_track=True)
 
 print("time exec = ", time() - start)
-pxy_list = freq_analysis(pxy_list, lat, nturns, harm=True)
+pxy_list = freq_analysis(pxy_list, lat, nturns, harm=True, nsuperperiods=8)
 
 da = np.array([pxy.turn for pxy in pxy_list])
 show_da(da, x_array, y_array)
@@ -11,6 +11,7 @@ __all__ = ['Twiss', "Beam", "Particle", "get_current", "get_envelope", "generate
             "save_particle_array", "load_particle_array",                                           # io
 
             'fodo_parameters', 'lattice_transfer_map', "Navigator", 'twiss', "MethodTM",            # optics
+            'twiss_table', "OpticsTable",                                                          # optics
 
             'Element', 'Multipole', 'Quadrupole', 'RBend', "Matrix", "UnknownElement",              # elements
             'SBend', 'Bend', 'Drift', 'Undulator', 'Hcor', "Solenoid", "TDCavity",                  # elements
@@ -24,8 +25,8 @@ __all__ = ['Twiss', "Beam", "Particle", "get_current", "get_envelope", "generate
             "pi", "m_e_eV", "m_e_MeV", "m_e_GeV", "speed_of_light",                             # globals
             "compensate_chromaticity",                                                          # chromaticity
             "EbeamParams",                                                                      # beam_params
-            "CSR",                                                                              # csr
-            "SpaceCharge", "LSC",                                                               # sc
+            "CSR", "CSRCache",                                                                  # csr
+            "SpaceCharge", "SpaceChargeRZ", "LSC",                                              # sc
             "Wake", "WakeTable", "WakeKick", "WakeTableDechirperOffAxis",                       # wake
             "BeamTransform", "SmoothBeam", "EmptyProc", "PhysProc", "LaserHeater",
             "LaserModulator", "SpontanRadEffects", "PhaseSpaceAperture",
@@ -1200,7 +1200,8 @@ class ParticleArray:
         tws = get_envelope(self, tws_i=tws_i, bounds=bounds, slice=slice, auto_disp=auto_disp)
         return tws
 
-    def get_twiss_from_slice(self, slice="Imax", nparts_in_slice=5000, smooth_param=0.05, filter_base=2, filter_iter=2):
+    def get_twiss_from_slice(self, slice="Imax", nparts_in_slice=5000, smooth_param=0.05, filter_base=2, filter_iter=2,
+                             method="sort"):
         """
         Function calculates twiss parameters in a beam slice
 
@@ -1210,11 +1211,12 @@ class ParticleArray:
         :param smooth_param: 0.01, smoothing parameters to calculate the beam current: smooth_param = m_std * np.std(p_array.tau())
         :param filter_base: 2, filter parameter in the func: simple_filter
         :param filter_iter: 2, filter parameter in the func: simple_filter
+        :param method: "sort" or "histogram", see global_slice_analysis()
         :return: Twiss
         """
         tws = Twiss()
         slice_params = global_slice_analysis(self, nparts_in_slice=nparts_in_slice, smooth_param=smooth_param,
-                                             filter_base=filter_base, filter_iter=filter_iter)
+                                             filter_base=filter_base, filter_iter=filter_iter, method=method)
 
         if slice == "Imax":
             ind0 = np.argmax(slice_params.I)
@@ -1264,7 +1266,136 @@ def recalculate_ref_particle(p_array):
     return p_array
 
 
-def get_envelope(p_array, tws_i=None, bounds=None, slice=None, auto_disp=False):
+def corrected_coordinates(rparticles, D=(0., 0., 0., 0.), tau_bounds=None, canonical=True):
+    """
+    Coordinates (x, px, y, py, tau, p) of the particles with the dispersion subtracted and, if canonical,
+    px and py converted to the angles as in get_envelope(), see beam_moments().
+
+    :return: array (6, n)
+    """
+    if tau_bounds is not None:
+        tau = rparticles[4]
+        rparticles = rparticles[:, (tau_bounds[0] <= tau) & (tau <= tau_bounds[1])]
+    n = rparticles.shape[1]
+    p = rparticles[5]
+    A = np.empty((6, n))
+    for i in range(4):
+        np.multiply(D[i], p, out=A[i])
+        np.subtract(rparticles[i], A[i], out=A[i])
+    A[4:] = rparticles[4:]
+    if canonical:
+        f = 1. - p - 0.5 * p * p
+        A[1] *= f + 0.5 * A[1] * A[1] + 0.5 * A[3] * A[3]
+        A[3] *= f + 0.5 * A[1] * A[1] + 0.5 * A[3] * A[3]
+    return A
+
+
+def beam_moments_np(rparticles, D=(0., 0., 0., 0.), tau_bounds=None, canonical=True):
+    """
+    Numpy version of beam_moments(). All first and second moments are calculated at once
+    from a single (6, n) array of the corrected coordinates.
+    """
+    A = corrected_coordinates(rparticles, D=D, tau_bounds=tau_bounds, canonical=canonical)
+    n = A.shape[1]
+    if n == 0:
+        return 0, np.full(6, np.nan), np.full((6, 6), np.nan)
+    mean = np.mean(A, axis=1)
+    A -= mean[:, np.newaxis]
+    cov = np.dot(A, A.T) / n
+    return n, mean, cov
+
+
+def beam_moment_sums_py(rparticles, D, tau_min, tau_max, canonical, shift, nchunks):
+    """
+    Single pass over rparticles. Every chunk of particles accumulates the number of particles,
+    the sums and the sums of products of the corrected coordinates (x, px, y, py, tau, p) shifted by `shift`.
+    """
+    N = rparticles.shape[1]
+    counts = np.zeros(nchunks)
+    sums = np.zeros((nchunks, 6))
+    prods = np.zeros((nchunks, 6, 6))
+    for t in _prange(nchunks):
+        v = np.zeros(6)
+        for k in range(t * N // nchunks, (t + 1) * N // nchunks):
+            tau = rparticles[4, k]
+            if tau < tau_min or tau > tau_max:
+                continue
+            p = rparticles[5, k]
+            v[0] = rparticles[0, k] - D[0] * p
+            v[1] = rparticles[1, k] - D[1] * p
+            v[2] = rparticles[2, k] - D[2] * p
+            v[3] = rparticles[3, k] - D[3] * p
+            if canonical:
+                f = 1. - p - 0.5 * p * p
+                v[1] = v[1] * (f + 0.5 * v[1] * v[1] + 0.5 * v[3] * v[3])
+                v[3] = v[3] * (f + 0.5 * v[1] * v[1] + 0.5 * v[3] * v[3])
+            v[4] = tau
+            v[5] = p
+            counts[t] += 1
+            for i in range(6):
+                vi = v[i] - shift[i]
+                sums[t, i] += vi
+                for j in range(i, 6):
+                    prods[t, i, j] += vi * (v[j] - shift[j])
+    return counts, sums, prods
+
+
+if nb_flag:
+    _prange = nb.prange
+    beam_moment_sums = nb.njit(parallel=True)(beam_moment_sums_py)
+else:
+    _prange = range
+    beam_moment_sums = None
+
+
+def beam_moments(rparticles, D=(0., 0., 0., 0.), tau_bounds=None, canonical=True, comm=None):
+    """
+    First and second central moments of the particle coordinates (x, px, y, py, tau, p), where
+    x -> x - Dx*p, px -> px - Dxp*p, y -> y - Dy*p, py -> py - Dyp*p
+    and, if canonical, px and py are converted to the angles as in get_envelope().
+    With numba the moments are accumulated in one parallel pass without temporary arrays.
+
+    :param rparticles: array (6, n)
+    :param D: (Dx, Dxp, Dy, Dyp) dispersion to subtract
+    :param tau_bounds: None or (tau_min, tau_max), only particles with tau_min <= tau <= tau_max are taken
+    :param canonical: if True, the px and py correction of get_envelope() is applied
+    :param comm: None or ParticleComm, if the particles are distributed between MPI ranks
+                 the number of particles, the sums and the sums of products are reduced over all ranks
+    :return: n, mean (6,), covariance matrix (6, 6)
+    """
+    D = np.asarray(D, dtype=float)
+    if comm is None and not nb_flag:
+        return beam_moments_np(rparticles, D=D, tau_bounds=tau_bounds, canonical=canonical)
+    # the shift is a particle close to the beam center, it keeps the single pass sums accurate
+    ref = corrected_coordinates(rparticles[:, :min(rparticles.shape[1], 64)], D=D, canonical=canonical)
+    ref_sums = np.append(np.sum(ref, axis=1), ref.shape[1])
+    if comm is not None:
+        ref_sums = comm.allreduce(ref_sums)
+    if ref_sums[-1] == 0:
+        return 0, np.full(6, np.nan), np.full((6, 6), np.nan)
+    shift = ref_sums[:6] / ref_sums[-1]
+
+    if nb_flag:
+        tau_min, tau_max = (-np.inf, np.inf) if tau_bounds is None else tau_bounds
+        counts, sums, prods = beam_moment_sums(rparticles, D, tau_min, tau_max, canonical, shift,
+                                               nb.get_num_threads())
+        n, s1, s2 = np.sum(counts), np.sum(sums, axis=0), np.sum(prods, axis=0)
+        s2 = np.triu(s2) + np.triu(s2, 1).T
+    else:
+        A = corrected_coordinates(rparticles, D=D, tau_bounds=tau_bounds, canonical=canonical)
+        A -= shift[:, np.newaxis]
+        n, s1, s2 = A.shape[1], np.sum(A, axis=1), np.dot(A, A.T)
+    if comm is not None:
+        total = comm.allreduce(np.concatenate(([n], s1, s2.ravel())))
+        n, s1, s2 = total[0], total[1:7], total[7:].reshape(6, 6)
+    n = int(n)
+    if n == 0:
+        return 0, np.full(6, np.nan), np.full((6, 6), np.nan)
+    s1 = s1 / n
+    return n, shift + s1, s2 / n - np.outer(s1, s1)
+
+
+def get_envelope(p_array, tws_i=None, bounds=None, slice=None, auto_disp=False, comm=None):
     """
     Calculate Twiss parameters from a ParticleArray.
 
@@ -1285,6 +1416,9 @@ def get_envelope(p_array, tws_i=None, bounds=None, slice=None, auto_disp=False):
     auto_disp : bool, optional
         If True and tws_i is None, estimate and subtract linear dispersion from the statistics of the particle array.
         Default is False.
+    comm : ParticleComm or None, optional
+        If the particles are distributed between MPI ranks, the moments are reduced over all ranks
+        and all ranks get the same Twiss (see parallel.get_envelope_mpi). Default is None.
 
     Returns
     -------
@@ -1293,115 +1427,59 @@ def get_envelope(p_array, tws_i=None, bounds=None, slice=None, auto_disp=False):
     """
 
     tau = p_array.tau()
+    tau_bounds = None
     if bounds is not None:
-        sig0 = np.std(tau)
+        sig0 = np.std(tau) if comm is None else comm.std(tau)
         if slice == "Imax":
-            charge = np.sum(p_array.q_array)
-            B = s_to_cur(tau, 0.01 * sig0, charge, speed_of_light)
+            charge = np.sum(p_array.q_array) if comm is None else comm.sum(p_array.q_array)
+            B = s_to_cur(tau, 0.01 * sig0, charge, speed_of_light, comm=comm)
             z0 = B[np.argmax(B[:, 1]), 0]
         else:
-            z0 = np.mean(tau)
-        inds = np.argwhere((z0 + sig0 * bounds[0] <= tau) * (tau <= z0 + sig0 * bounds[1]))
-        p = p_array.p()[inds]
-        x = p_array.x()[inds]
-        px = p_array.px()[inds]
-        y = p_array.y()[inds]
-        py = p_array.py()[inds]
-        tau = p_array.tau()[inds]
-    else:
-        p = p_array.p()
-        x = p_array.x()
-        px = p_array.px()
-        y = p_array.y()
-        py = p_array.py()
+            z0 = np.mean(tau) if comm is None else comm.mean(tau)
+        tau_bounds = (z0 + sig0 * bounds[0], z0 + sig0 * bounds[1])
 
     tws = Twiss()
     tws.E = np.copy(p_array.E)
-    tws.q = np.sum(p_array.q_array)
-    tws.p = np.mean(p)
-
-    # if less than 3 particles are left in the ParticleArray - return default (zero) Twiss()
-    if len(x) < 3:
-        _logger.warning("ParticleArray contains less than 3 particles. Moments are not calculated")
-        return tws
+    tws.q = np.sum(p_array.q_array) if comm is None else comm.sum(p_array.q_array)
 
     if tws_i is None:
+        D = np.zeros(4)
         if auto_disp:
-            mean_x, mean_px = np.mean(x), np.mean(px)
-            mean_y, mean_py = np.mean(y), np.mean(py)
-            mean_p = tws.p
-            var_p = np.var(p)
-            tws.Dx = np.mean((p - mean_p) * (x - mean_x)) / var_p
-            tws.Dxp = np.mean((p - mean_p) * (px - mean_px)) / var_p
-            tws.Dy = np.mean((p - mean_p) * (y - mean_y)) / var_p
-            tws.Dyp = np.mean((p - mean_p) * (py - mean_py)) / var_p
+            # dispersion from the moments of the uncorrected coordinates
+            n, mean, cov = beam_moments(p_array.rparticles, tau_bounds=tau_bounds, canonical=False, comm=comm)
+            if n >= 3:
+                D = cov[5, :4] / cov[5, 5]
     else:
-        tws.Dx = tws_i.Dx
-        tws.Dxp = tws_i.Dxp
-        tws.Dy = tws_i.Dy
-        tws.Dyp = tws_i.Dyp
+        D = np.array([tws_i.Dx, tws_i.Dxp, tws_i.Dy, tws_i.Dyp])
+    tws.Dx, tws.Dxp, tws.Dy, tws.Dyp = D
 
-    dx = tws.Dx * p
-    dy = tws.Dy * p
-    dpx = tws.Dxp * p
-    dpy = tws.Dyp * p
-    x = x - dx
+    n, mean, cov = beam_moments(p_array.rparticles, D=D, tau_bounds=tau_bounds, comm=comm)
+    tws.p = mean[5]
 
-    px = px - dpx
+    # if less than 3 particles are left in the ParticleArray - return default (zero) Twiss()
+    if n < 3:
+        _logger.warning("ParticleArray contains less than 3 particles. Moments are not calculated")
+        return tws
 
-    y = y - dy
-    py = py - dpy
+    tws.x, tws.px, tws.y, tws.py, tws.tau = mean[:5]
+    tws.xx, tws.xpx, tws.pxpx = cov[0, 0], cov[0, 1], cov[1, 1]
+    tws.yy, tws.ypy, tws.pypy = cov[2, 2], cov[2, 3], cov[3, 3]
+    tws.tautau, tws.pp = cov[4, 4], cov[5, 5]
+    tws.xy, tws.pxpy, tws.xpy, tws.ypx = cov[0, 2], cov[1, 3], cov[0, 3], cov[2, 1]
 
-    if ne_flag:
-        px = ne.evaluate('px * (1. - p - 0.5 * p * p + 0.5 * px * px + 0.5 * py * py)')
-        py = ne.evaluate('py * (1. - p - 0.5 * p * p + 0.5 * px * px + 0.5 * py * py)')
-    else:
-        px = px * (1. - p - 0.5 * p * p + 0.5 * px * px + 0.5 * py * py )
-        py = py * (1. - p - 0.5 * p * p + 0.5 * px * px + 0.5 * py * py)
-
-    tws.x = np.mean(x)
-    tws.y = np.mean(y)
-    tws.px = np.mean(px)
-    tws.py = np.mean(py)
-    tws.tau = np.mean(tau)
-
-
-    if ne_flag:
-        tw_x = tws.x
-        tw_y = tws.y
-        tw_px = tws.px
-        tw_py = tws.py
-        tw_tau = tws.tau
-        tw_p = tws.p
-        tws.xx = np.mean(ne.evaluate('(x - tw_x)**2'))
-        tws.xpx = np.mean(ne.evaluate('(x - tw_x) * (px - tw_px)'))
-        tws.pxpx = np.mean(ne.evaluate('(px - tw_px) * (px - tw_px)'))
-        tws.yy = np.mean(ne.evaluate('(y - tw_y)**2'))
-        tws.ypy = np.mean(ne.evaluate('(y - tw_y) * (py - tw_py)'))
-        tws.pypy = np.mean(ne.evaluate('(py - tw_py)**2'))
-        tws.tautau = np.mean(ne.evaluate('(tau - tw_tau)**2'))
-
-        tws.xy = np.mean(ne.evaluate('(x - tw_x) * (y - tw_y)'))
-        tws.pxpy = np.mean(ne.evaluate('(px - tw_px) * (py - tw_py)'))
-        tws.xpy = np.mean(ne.evaluate('(x - tw_x) * (py - tw_py)'))
-        tws.ypx = np.mean(ne.evaluate('(y - tw_y) * (px - tw_px)'))
-        tws.pp = np.mean(ne.evaluate('(p - tw_p)**2'))
+    update_twiss_from_moments(tws, p_array.E)
+    return tws
 
-    else:
-        tws.xx = np.mean((x - tws.x) ** 2)
-        tws.xpx = np.mean((x - tws.x) * (px - tws.px))
-        tws.pxpx = np.mean((px - tws.px) ** 2)
-        tws.yy = np.mean((y - tws.y) ** 2)
-        tws.ypy = np.mean((y - tws.y) * (py - tws.py))
-        tws.pypy = np.mean((py - tws.py) ** 2)
-        tws.tautau = np.mean((tau - tws.tau) * (tau - tws.tau))
-
-        tws.xy = np.mean((x - tws.x) * (y - tws.y))
-        tws.pxpy = np.mean((px - tws.px) * (py - tws.py))
-        tws.xpy = np.mean((x - tws.x) * (py - tws.py))
-        tws.ypx = np.mean((y - tws.y) * (px - tws.px))
-        tws.pp = np.mean((p - tws.p) ** 2)
 
+def update_twiss_from_moments(tws, energy):
+    """
+    Calculates emittances, eigen emittances and Twiss parameters from the second order moments
+    (tws.xx, tws.xpx, ...) which are already set in tws.
+
+    :param tws: Twiss with the second order moments
+    :param energy: beam energy in [GeV]
+    :return: tws
+    """
     Sigma = np.array([[tws.xx, tws.xy, tws.xpx, tws.xpy],
                       [tws.xy, tws.yy, tws.ypx, tws.ypy],
                       [tws.xpx, tws.ypx, tws.pxpx, tws.pxpy],
@@ -1415,7 +1493,7 @@ def get_envelope(p_array, tws_i=None, bounds=None, slice=None, auto_disp=False):
 
     tws.emit_x = np.sqrt(tws.xx * tws.pxpx - tws.xpx ** 2)
     tws.emit_y = np.sqrt(tws.yy * tws.pypy - tws.ypy ** 2)
-    relgamma = p_array.E / m_e_GeV
+    relgamma = energy / m_e_GeV
     relbeta = np.sqrt(1 - relgamma ** -2) if relgamma != 0 else 1.
     tws.emit_xn = tws.emit_x * relgamma * relbeta
     tws.emit_yn = tws.emit_y * relgamma * relbeta
@@ -1697,7 +1775,7 @@ def s2cur_auxil_py(A, xiA, C, N, I):
 s2cur_auxil = s2cur_auxil_py if not nb_flag else nb.jit(nopython=True)(s2cur_auxil_py)
 
 
-def s_to_cur(A, sigma, q0, v):
+def s_to_cur(A, sigma, q0, v, comm=None):
     """
     Function to calculate beam current
 
@@ -1705,12 +1783,17 @@ def s_to_cur(A, sigma, q0, v):
     :param sigma: smoothing parameter, e,g, sigma = 0.01*np.std(A)
     :param q0: bunch charge
     :param v: mean velocity
+    :param comm: None or ParticleComm, if the particles are distributed between MPI ranks
     :return: [s, I]
     """
 
     Nsigma = 3
-    a = np.min(A) - Nsigma * sigma
-    b = np.max(A) + Nsigma * sigma
+    if comm is None:
+        a = np.min(A) - Nsigma * sigma
+        b = np.max(A) + Nsigma * sigma
+    else:
+        a = float(comm.min(A)) - Nsigma * sigma
+        b = float(comm.max(A)) + Nsigma * sigma
     s = 0.25 * sigma
     N = int(np.ceil((b - a) / s))
     s = (b - a) / N
@@ -1723,6 +1806,8 @@ def s_to_cur(A, sigma, q0, v):
     I = np.int_(np.floor(cA))
     xiA = 1 + I - cA
     s2cur_auxil(A, xiA, C, N, I)
+    if comm is not None:
+        C = comm.allreduce(C)
 
     K = np.floor(Nsigma * sigma / s + 0.5)
     G = np.exp(-0.5 * (np.arange(-K, K + 1) * s / sigma) ** 2)
@@ -1996,7 +2081,8 @@ def global_slice_analysis_extended(parray, Mslice, Mcur, p, iter):
     return [s, I, ex, ey, me, se, gamma0, emitxn, emityn]
 
 
-def global_slice_analysis(parray, nparts_in_slice=5000, smooth_param=0.01, filter_base=2, filter_iter=2):
+def global_slice_analysis(parray, nparts_in_slice=5000, smooth_param=0.01, filter_base=2, filter_iter=2,
+                          method="sort"):
     """
     Function to calculate slice parameters
 
@@ -2005,9 +2091,14 @@ def global_slice_analysis(parray, nparts_in_slice=5000, smooth_param=0.01, filte
     :param smooth_param: 0.01, smoothing parameters to calculate the beam current: smooth_param = m_std * np.std(p_array.tau())
     :param filter_base: 2, filter parameter in the func: simple_filter
     :param filter_iter: 2, filter parameter in the func: simple_filter
+    :param method: "sort" - moving window over the sorted particles,
+                   "histogram" - slice moments without sorting, see global_slice_analysis_hist()
     :return: SliceParameters,
     """
     n = 1000  # number of points
+    if method == "histogram":
+        return global_slice_analysis_hist(parray, nslices=n, nparts_in_slice=nparts_in_slice,
+                                          smooth_param=smooth_param, filter_base=filter_base, filter_iter=filter_iter)
 
     slc = SliceParameters()
 
@@ -2119,6 +2210,219 @@ def global_slice_analysis(parray, nparts_in_slice=5000, smooth_param=0.01, filte
     return slc
 
 
+SLICE_SUM_NAMES = ("n", "x", "px", "y", "py", "p", "e", "t",
+                   "xx", "xpx", "pxpx", "yy", "ypy", "pypy", "ee",
+                   "tt", "tx", "tpx", "ty", "tpy", "te")
+
+
+def slice_sums_np(rparticles, E, tau0, h, nslices, shift):
+    """
+    Numpy version of slice_sums(), one np.bincount per accumulated quantity.
+    """
+    idx = np.floor((rparticles[4] - tau0) / h).astype(np.int64)
+    np.clip(idx, 0, nslices - 1, out=idx)
+    pc_0 = np.sqrt(E ** 2 - m_e_GeV ** 2)
+    e = np.sqrt((rparticles[5] * pc_0 + E) ** 2 - m_e_GeV ** 2) * 1e9 - shift[5]
+    x, px, y, py = [rparticles[i] - shift[i] for i in range(4)]
+    t = rparticles[4] - shift[6]
+    weights = [x, px, y, py, rparticles[5] - shift[4], e, t,
+               x * x, x * px, px * px, y * y, y * py, py * py, e * e,
+               t * t, t * x, t * px, t * y, t * py, t * e]
+    sums = np.zeros((nslices, len(SLICE_SUM_NAMES)))
+    sums[:, 0] = np.bincount(idx, minlength=nslices)
+    for k, w in enumerate(weights):
+        sums[:, k + 1] = np.bincount(idx, weights=w, minlength=nslices)
+    return sums
+
+
+def slice_sums_py(rparticles, E, tau0, h, nslices, shift, nchunks):
+    """
+    Single pass over rparticles. Every chunk of particles accumulates in every slice the number of particles,
+    the sums and the sums of products of the coordinates (see SLICE_SUM_NAMES) shifted by `shift`.
+    """
+    N = rparticles.shape[1]
+    pc_0 = np.sqrt(E ** 2 - m_e_GeV ** 2)
+    sums = np.zeros((nchunks, nslices, 21))
+    for c in _prange(nchunks):
+        for k in range(c * N // nchunks, (c + 1) * N // nchunks):
+            i = int(np.floor((rparticles[4, k] - tau0) / h))
+            i = min(max(i, 0), nslices - 1)
+            x = rparticles[0, k] - shift[0]
+            px = rparticles[1, k] - shift[1]
+            y = rparticles[2, k] - shift[2]
+            py = rparticles[3, k] - shift[3]
+            p = rparticles[5, k] - shift[4]
+            e = np.sqrt((rparticles[5, k] * pc_0 + E) ** 2 - m_e_GeV ** 2) * 1e9 - shift[5]
+            t = rparticles[4, k] - shift[6]
+            s = sums[c, i]
+            s[0] += 1.
+            s[1] += x
+            s[2] += px
+            s[3] += y
+            s[4] += py
+            s[5] += p
+            s[6] += e
+            s[7] += t
+            s[8] += x * x
+            s[9] += x * px
+            s[10] += px * px
+            s[11] += y * y
+            s[12] += y * py
+            s[13] += py * py
+            s[14] += e * e
+            s[15] += t * t
+            s[16] += t * x
+            s[17] += t * px
+            s[18] += t * y
+            s[19] += t * py
+            s[20] += t * e
+    return sums
+
+
+if nb_flag:
+    _slice_sums_nb = nb.njit(parallel=True)(slice_sums_py)
+
+
+def slice_sums(rparticles, E, tau0, h, nslices, shift):
+    """
+    Histogram of the particles in nslices equidistant slices [tau0 + i*h, tau0 + (i+1)*h] without sorting.
+    The first and the last slices take also the particles outside.
+
+    :param rparticles: array (6, n)
+    :param E: reference energy [GeV]
+    :param tau0: left edge of the first slice
+    :param h: slice width
+    :param nslices: number of slices
+    :param shift: (x, px, y, py, p, e, tau) subtracted from the coordinates, e is the particle energy pc [eV]
+    :return: array (nslices, len(SLICE_SUM_NAMES)) of the sums in every slice
+    """
+    if nb_flag:
+        return np.sum(_slice_sums_nb(rparticles, E, tau0, h, nslices, shift, nb.get_num_threads()), axis=0)
+    return slice_sums_np(rparticles, E, tau0, h, nslices, shift)
+
+
+def slice_moments(sums, nparts_in_slice=None):
+    """
+    Slice means and second moments from the slice sums (see slice_sums()).
+    If nparts_in_slice is given, the moments of every slice are averaged over a window of nparts_in_slice particles
+    around the slice center, as the moving window of slice_analysis() over the sorted particles.
+    The particles are assumed uniformly distributed inside the slice.
+    The linear correlation with tau inside the window (e.g. energy chirp) is removed from the second moments
+    as the subtraction of the moving mean in slice_analysis() does.
+
+    :param sums: array (nslices, len(SLICE_SUM_NAMES))
+    :param nparts_in_slice: None or number of particles in the moving window
+    :return: dict of arrays. "n" is the number of particles in the window, "x", "px", "y", "py", "p", "e", "t"
+             are the means (without the shift), "xx", "xpx", "pxpx", "yy", "ypy", "pypy", "ee" are the second moments
+    """
+    if nparts_in_slice is None:
+        W = sums
+    else:
+        C = np.vstack([np.zeros((1, sums.shape[1])), np.cumsum(sums, axis=0)])
+        Ncum = C[:, 0]
+        rank = Ncum[:-1] + 0.5 * sums[:, 0]
+        m = max(np.round(nparts_in_slice / 2), 1)
+        r1 = np.clip(rank - m, 0, Ncum[-1])
+        r2 = np.clip(rank + m, 0, Ncum[-1])
+        W = np.array([np.interp(r2, Ncum, C[:, k]) - np.interp(r1, Ncum, C[:, k]) for k in range(C.shape[1])]).T
+    n = W[:, 0]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        M = W / n[:, np.newaxis]
+    mom = {name: M[:, k] for k, name in enumerate(SLICE_SUM_NAMES)}
+    mom["n"] = n
+
+    def cov(a, b):
+        return mom[a + b] - mom[a] * mom[b]
+
+    tt = cov("t", "t")
+    with np.errstate(invalid="ignore", divide="ignore"):
+        tt_inv = np.where(tt > 0, 1. / tt, 0.)
+    for a, b in [("x", "x"), ("x", "px"), ("px", "px"), ("y", "y"), ("y", "py"), ("py", "py"), ("e", "e")]:
+        mom[a + b] = cov(a, b) - cov("t", a) * cov("t", b) * tt_inv
+    return mom
+
+
+def global_slice_analysis_hist(parray, nslices=1000, nparts_in_slice=5000, smooth_param=0.01, filter_base=2,
+                               filter_iter=2):
+    """
+    Function to calculate slice parameters without sorting of the particles.
+    The particles are binned in nslices slices and the slice moments are accumulated in one pass (see slice_sums()),
+    the moving window of nparts_in_slice particles is applied to the slice sums.
+    The result is the same as of global_slice_analysis() on the same grid s within the statistical noise.
+
+    :param parray: ParticleArray
+    :param nslices: 1000, number of slices (points)
+    :param nparts_in_slice: 5000, nparticles in the moving window. If None, the moments of the slices are used
+    :param smooth_param: 0.01, smoothing parameters to calculate the beam current: smooth_param = m_std * np.std(p_array.tau())
+    :param filter_base: 2, filter parameter in the func: simple_filter
+    :param filter_iter: 2, filter parameter in the func: simple_filter
+    :return: SliceParameters
+    """
+    slc = SliceParameters()
+    rp = parray.rparticles
+    tau = rp[4]
+    smin, smax = np.min(tau), np.max(tau)
+    s = np.linspace(smin, smax, num=nslices)
+    h = (smax - smin) / (nslices - 1)
+
+    # the shift of the coordinates keeps the accumulated second moments accurate
+    pc_0 = np.sqrt(parray.E ** 2 - m_e_GeV ** 2)
+    ref = rp[:, :min(rp.shape[1], 64)]
+    e_ref = np.sqrt((ref[5] * pc_0 + parray.E) ** 2 - m_e_GeV ** 2) * 1e9
+    shift = np.array([np.mean(ref[0]), np.mean(ref[1]), np.mean(ref[2]), np.mean(ref[3]), np.mean(ref[5]),
+                      np.mean(e_ref), np.mean(ref[4])])
+    sums = slice_sums(rp, parray.E, smin - h / 2, h, nslices, shift)
+    mom = slice_moments(sums, nparts_in_slice=nparts_in_slice)
+
+    # empty slices are interpolated from the neighbours
+    filled = mom["n"] > 0
+    for name in SLICE_SUM_NAMES[1:15]:
+        mom[name] = np.interp(s, s[filled], mom[name][filled])
+
+    gamma0 = parray.E / m_e_GeV
+    _, _, _, _, _, emitty0 = moments(rp[2], rp[3])
+    slc.emityn = emitty0 * gamma0
+    _, _, _, _, _, emitt0 = moments(rp[0], rp[1])
+    slc.emitxn = emitt0 * gamma0
+
+    ex = np.sqrt(np.maximum(mom["xx"] * mom["pxpx"] - mom["xpx"] ** 2, 0.))
+    ey = np.sqrt(np.maximum(mom["yy"] * mom["pypy"] - mom["ypy"] ** 2, 0.))
+    slc.ex = simple_filter(ex, filter_base, filter_iter)
+    slc.ey = simple_filter(ey, filter_base, filter_iter)
+    slc.exn = slc.ex * gamma0
+    slc.eyn = slc.ey * gamma0
+    slc.se = simple_filter(np.sqrt(np.maximum(mom["ee"], 0.)), filter_base, filter_iter)
+    slc.me = simple_filter(mom["e"] + shift[5], filter_base, filter_iter)
+
+    sig0 = np.std(tau)
+    B = s_to_cur(tau, smooth_param * sig0, np.sum(parray.q_array), speed_of_light)
+    slc.I = interp1(B[:, 0], B[:, 1], s)
+
+    x_px = simple_filter(mom["xpx"], filter_base, filter_iter)
+    y_py = simple_filter(mom["ypy"], filter_base, filter_iter)
+    slc.mx = simple_filter(mom["x"] + shift[0], filter_base, filter_iter)
+    slc.mxp = simple_filter(mom["px"] + shift[1], filter_base, filter_iter)
+    slc.my = simple_filter(mom["y"] + shift[2], filter_base, filter_iter)
+    slc.myp = simple_filter(mom["py"] + shift[3], filter_base, filter_iter)
+
+    slc.sig_x = simple_filter(np.sqrt(np.maximum(mom["xx"], 0.)), filter_base, filter_iter)
+    slc.sig_y = simple_filter(np.sqrt(np.maximum(mom["yy"], 0.)), filter_base, filter_iter)
+    slc.sig_xp = simple_filter(np.sqrt(np.maximum(mom["pxpx"], 0.)), filter_base, filter_iter)
+    slc.sig_yp = simple_filter(np.sqrt(np.maximum(mom["pypy"], 0.)), filter_base, filter_iter)
+
+    slc.beta_x = np.divide(slc.sig_x ** 2, slc.ex, out=np.zeros_like(slc.sig_x), where=slc.ex != 0)
+    slc.beta_y = np.divide(slc.sig_y ** 2, slc.ey, out=np.zeros_like(slc.sig_y), where=slc.ey != 0)
+    slc.alpha_x = -x_px / slc.ex
+    slc.alpha_y = -y_py / slc.ey
+    slc.gamma_x = np.divide(1 + slc.alpha_x ** 2, slc.beta_x, out=np.zeros_like(slc.alpha_x), where=slc.beta_x != 0)
+    slc.gamma_y = np.divide(1 + slc.alpha_y ** 2, slc.beta_y, out=np.zeros_like(slc.alpha_y), where=slc.beta_y != 0)
+    slc.mp = simple_filter(mom["p"] + shift[4], filter_base, filter_iter)
+
+    slc.s = s
+    slc.gamma0 = gamma0
+    return slc
+
+
 '''
 beam funcions proposed
 '''
@@ -3,8 +3,11 @@
 """
 
 import copy
+import hashlib
 import importlib
 import logging
+import os
+import tempfile
 import time
 
 import numpy as np
@@ -629,6 +632,68 @@ class K0_fin_anf:
             KS = 0.5 * K[-1] * s[-1]
         return w, KS
 
+    def K0_fin_anf_block(self, itr, traj, wmin, gamma):
+        """
+        Integrated kernels of a block of trajectory points calculated at once on the 2D grid
+        (observer points itr) x (common window of the source points).
+        The window starts at the start index of the first observer point, the start indices of the next observer
+        points cannot be smaller because w(i, j) decreases with i.
+
+        :param itr: sorted array of the indices of the trajectory points
+        :param traj: trajectory
+        :param wmin: the first coordinate of the mesh
+        :param gamma: Lorentz factor
+        :return: list of (w, KS) for every point of itr
+        """
+        g2i = 1. / gamma ** 2
+        b2 = 1. - g2i
+        beta = np.sqrt(b2)
+        i_first = itr[0]
+        s = traj[0, :i_first] - traj[0, i_first]
+        R = np.linalg.norm(traj[1:4, i_first, None] - traj[1:4, :i_first], axis=0)
+        j = np.where(s + beta * R <= wmin)[0]
+        j0 = j[-1] if len(j) > 0 else 0
+
+        idx = np.arange(j0, itr[-1])
+        nw = len(idx)
+        valid = idx[None, :] < itr[:, None]
+        s = traj[0, idx][None, :] - traj[0, itr][:, None]
+        n = traj[1:4, itr][:, :, None] - traj[1:4, idx][:, None, :]
+        R = np.sqrt(n[0] * n[0] + n[1] * n[1] + n[2] * n[2])
+        R[~valid] = 1.
+        w = s + beta * R
+
+        # start index of each observer point: last point with w <= wmin
+        cond = (w <= wmin) & valid
+        k_start = np.where(cond.any(axis=1), nw - 1 - np.argmax(cond[:, ::-1], axis=1), 0)
+        k_last = itr - j0 - 1
+        k = np.arange(nw)
+        mask = valid & (k[None, :] >= k_start[:, None])
+
+        R_inv = 1. / R
+        n *= R_inv
+        t4 = traj[4, idx][None, :]
+        t5 = traj[5, idx][None, :]
+        t6 = traj[6, idx][None, :]
+        t4i = traj[4, itr][:, None]
+        t5i = traj[5, itr][:, None]
+        t6i = traj[6, itr][:, None]
+        x = n[0] * t4 + n[1] * t5 + n[2] * t6
+        K = ((beta * (x - (n[0] * t4i + n[1] * t5i + n[2] * t6i))
+              - b2 * (1. - (t4 * t4i + t5 * t5i + t6 * t6i))
+              - g2i) * R_inv
+             - (1. - beta * x) / w * g2i)
+        K[~mask] = 0.
+
+        # integrated kernel, the same as integrate_kernel_np for each row
+        a = np.zeros_like(K)
+        a[:, :-1] = 0.5 * (K[:, :-1] + K[:, 1:]) * np.diff(s, axis=1)
+        a[~mask] = 0.
+        rows = np.arange(len(itr))
+        a[rows, k_last] = 0.5 * K[rows, k_last] * s[rows, k_last]
+        KS = np.cumsum(a[:, ::-1], axis=1)[:, ::-1]
+        return [(w[r, k_start[r]:k_last[r] + 1], KS[r, k_start[r]:k_last[r] + 1]) for r in rows]
+
     def estimate_start_index(self, i, traj, w_min, beta, i_min=1000, n_test=10):
         """
         This method estimates the index of the first trajectory point from
@@ -684,6 +749,150 @@ class K0_fin_anf:
         return i_0
 
 
+class CSRCache:
+    """
+    Cache of the reference trajectories of the CSR sections and of the tables of the integrated kernel (w, KS)
+    calculated by K0_fin_anf. The cache can be shared between CSR instances and, if cache_dir is given, between
+    processes (e.g. ParameterScanner workers) through the files in cache_dir.
+
+    Trajectories are keyed by a hash of the geometry of the CSR section, traj_step, rk_traj, end_poles and energy.
+    Kernel tables are keyed in addition by the beam gamma and stored per trajectory point.
+    A table calculated for the mesh edge wmin is reused for any wmin' >= wmin by truncating it at the last point
+    with w <= wmin', which reproduces the direct calculation exactly.
+    The binning parameters (n_bin, sigma_min, ...) only define wmin, so they are not a part of the key.
+
+    :param cache_dir: None or directory of the on-disk cache
+    """
+    def __init__(self, cache_dir=None):
+        self.cache_dir = cache_dir
+        self.trajectories = {}
+        self.kernel_tables = {}
+        self.dirty = set()
+        self.hits = 0
+        self.misses = 0
+
+    def __deepcopy__(self, memo):
+        # Navigator deep copies the physics processes on every reset, the cache must stay shared
+        return self
+
+    def __getstate__(self):
+        # only the location of the on-disk cache is sent to other processes
+        state = self.__dict__.copy()
+        state["trajectories"] = {}
+        state["kernel_tables"] = {}
+        state["dirty"] = set()
+        state["hits"] = 0
+        state["misses"] = 0
+        return state
+
+    @staticmethod
+    def trajectory_key(elements, traj_step, rk_traj, end_poles, energy):
+        """
+        Hash of the geometry of the CSR section
+
+        :param elements: list of the elements of the CSR section
+        :return: str
+        """
+        attrs = ["l", "angle", "tilt", "k1", "x_offs", "y_offs", "lperiod", "nperiods", "Kx", "Ky"]
+        geometry = [(elem.__class__.__name__,) + tuple(getattr(elem, attr, None) for attr in attrs)
+                    for elem in elements]
+        return hashlib.sha1(repr((geometry, traj_step, rk_traj, end_poles, energy)).encode()).hexdigest()
+
+    def _path(self, name):
+        return os.path.join(self.cache_dir, name)
+
+    def _save(self, name, **arrays):
+        # write into a temporary file and rename it to avoid reading of partially written files by other processes
+        os.makedirs(self.cache_dir, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            np.savez(f, **arrays)
+        os.replace(tmp, self._path(name))
+
+    def get_trajectory(self, key):
+        traj = self.trajectories.get(key)
+        if traj is None and self.cache_dir is not None and os.path.isfile(self._path("csr_traj_" + key + ".npz")):
+            with np.load(self._path("csr_traj_" + key + ".npz")) as data:
+                traj = data["traj"]
+            self.trajectories[key] = traj
+        return traj
+
+    def set_trajectory(self, key, traj):
+        self.trajectories[key] = traj
+        if self.cache_dir is not None:
+            self._save("csr_traj_" + key + ".npz", traj=traj)
+
+    @staticmethod
+    def _tables_name(key):
+        return "csr_k0_" + hashlib.sha1(repr(key).encode()).hexdigest() + ".npz"
+
+    def _load_tables(self, key):
+        tables = {}
+        path = self._path(self._tables_name(key))
+        if os.path.isfile(path):
+            with np.load(path) as data:
+                offsets = data["offsets"]
+                for k, i in enumerate(data["indices"]):
+                    sl = slice(offsets[k], offsets[k + 1])
+                    tables[int(i)] = (data["wmin"][k], data["w"][sl], data["KS"][sl])
+        return tables
+
+    def kernel_table(self, key, i, traj, wmin, gamma, k0_func):
+        """
+        Returns the integrated kernel (w, KS) of the trajectory point i, k0_func(i, traj, wmin, gamma) is called
+        if the cached table does not cover wmin.
+
+        :param key: tuple (trajectory key, gamma key)
+        :return: w, KS
+        """
+        tables = self.kernel_tables.get(key)
+        if tables is None:
+            tables = self._load_tables(key) if self.cache_dir is not None else {}
+            self.kernel_tables[key] = tables
+        entry = tables.get(i)
+        if entry is None or wmin < entry[0]:
+            self.misses += 1
+            w, KS = k0_func(i, traj, wmin, gamma)
+            tables[i] = (wmin, w, KS)
+            self.dirty.add(key)
+            return w, KS
+        self.hits += 1
+        _, w, KS = entry
+        j = np.where(w <= wmin)[0]
+        if len(j) > 0 and j[-1] > 0:
+            w = w[j[-1]:]
+            KS = KS[j[-1]:]
+        return w, KS
+
+    def flush(self):
+        """
+        Writes the new kernel tables to cache_dir. Tables written in the meantime by other processes are merged.
+        """
+        if self.cache_dir is None:
+            self.dirty.clear()
+            return
+        for key in self.dirty:
+            tables = self._load_tables(key)
+            for i, entry in self.kernel_tables[key].items():
+                if i not in tables or entry[0] < tables[i][0]:
+                    tables[i] = entry
+            indices = np.array(sorted(tables), dtype=int)
+            w = [np.atleast_1d(tables[i][1]) for i in indices]
+            KS = [np.atleast_1d(tables[i][2]) for i in indices]
+            offsets = np.append(0, np.cumsum([len(x) for x in w]))
+            self._save(self._tables_name(key), indices=indices, offsets=offsets,
+                       wmin=np.array([tables[i][0] for i in indices]),
+                       w=np.concatenate(w) if len(w) > 0 else np.zeros(0),
+                       KS=np.concatenate(KS) if len(KS) > 0 else np.zeros(0))
+            self.kernel_tables[key] = tables
+        self.dirty.clear()
+
+    def clear(self):
+        self.trajectories = {}
+        self.kernel_tables = {}
+        self.dirty = set()
+
+
 class CSR(PhysProc):
     """
     This class simulates the CSR wakefield, its interaction with the beam, and applies the corresponding CSR kick to the particle array.
@@ -716,11 +925,19 @@ class CSR(PhysProc):
 
         pict_debug (bool): If True, the trajectory of the reference particle and CSR wakes will be saved for each step in the working folder. Default is False.
 
+        cache (CSRCache or None): Cache of the trajectory and of the kernel tables, can be shared between CSR instances,
+            tracking runs and (with CSRCache(cache_dir=...)) processes. Default is None (no caching).
+        block_size (int): If positive, the kernels of block_size integration steps are calculated in one batch
+            (see CSR_K1_block). Not used together with cache. Default is 0.
+
         sub_bin (SubBinning): An instance of the SubBinning class for particle binning.
         bin_smoth (Smoothing): An instance of the Smoothing class for applying smoothing to the CSR wakefield.
         k0_fin_anf (K0_fin_anf): An instance of the K0_fin_anf class for further CSR-related calculations.
     """
 
+    # only the momenta are kicked, see PhysProc.changes_coordinates
+    changes_coordinates = False
+
     def __init__(self, **kw):
         PhysProc.__init__(self)
         # binning parameters
@@ -758,6 +975,10 @@ class CSR(PhysProc):
         # and CSR wakes will be saved in the working folder on each step
         self.pict_debug = kw.get("pict_debug", False)
 
+        self.cache = kw.get("cache", None)  # None or CSRCache
+        self.block_size = kw.get("block_size", 0)  # if > 0, K1 of block_size steps are calculated in one batch
+        self.traj_key = None
+
         self.sub_bin = SubBinning(x_qbin=self.x_qbin, n_bin=self.n_bin, m_bin=self.m_bin)
         self.bin_smoth = Smoothing()
         self.k0_fin_anf = K0_fin_anf()
@@ -903,11 +1124,49 @@ class CSR(PhysProc):
             L_fin = False
 
         w_range = np.arange(-NdW[0]-1, 0)*NdW[1]
-        if L_fin:
+        if L_fin and self.cache is not None and self.traj_key is not None:
+            w, KS = self.cache.kernel_table((self.traj_key, "%.10g" % gamma), i, traj, w_range[0], gamma,
+                                            self.k0_fin_anf.eval)
+        elif L_fin:
             w, KS = self.k0_fin_anf.eval(i, traj, w_range[0], gamma)
         else:
             w, KS = self.K0_inf_anf(i, traj, w_range[0])
 
+        return self.K1_from_K0(i, traj, w, KS, NdW, gamma)
+
+    def CSR_K1_block(self, itr, traj, NdW, gamma):
+        """
+        Sum of the convolution kernels K1 of the trajectory points itr.
+        The integrated kernels of the block are calculated in one batch by K0_fin_anf.K0_fin_anf_block.
+
+        :param itr: indices of the trajectory points
+        :param traj: trajectory
+        :param NdW: list [N, dW], see CSR_K1
+        :param gamma: Lorentz factor
+        :return: sum of K1
+        """
+        itr = np.sort(itr)
+        w_range = np.arange(-NdW[0]-1, 0)*NdW[1]
+        K1 = 0
+        for i, (w, KS) in zip(itr, self.k0_fin_anf.K0_fin_anf_block(itr, traj, w_range[0], gamma)):
+            K1 += self.K1_from_K0(i, traj, w, KS, NdW, gamma)
+        return K1
+
+    def K1_from_K0(self, i, traj, w, KS, NdW, gamma=None):
+        """
+        Convolution kernel K1 on the mesh (-N:0) * dW from the integrated kernel KS(w).
+        The contribution of the straight line before the trajectory is added analytically if required.
+
+        :param i: index of the trajectory point
+        :param traj: trajectory
+        :param w: coordinates of the integrated kernel
+        :param KS: integrated kernel
+        :param NdW: list [N, dW], see CSR_K1
+        :param gamma: Lorentz factor, if None gamma = inf
+        :return: K1
+        """
+        L_fin = gamma is not None
+        w_range = np.arange(-NdW[0]-1, 0)*NdW[1]
         try:
             KS1 = KS[0]
         except IndexError:
@@ -972,6 +1231,14 @@ class CSR(PhysProc):
                 "RK trajectory calc set but CSR.energy left unset."
             )
 
+        if self.cache is not None:
+            self.traj_key = self.cache.trajectory_key(lat.sequence[self.indx0:self.indx1+1], self.traj_step,
+                                                      self.rk_traj, self.end_poles, self.energy)
+            traj = self.cache.get_trajectory(self.traj_key)
+            if traj is not None:
+                self.csr_traj = traj
+                return self.csr_traj
+
         for elem in lat.sequence[self.indx0:self.indx1+1]:
 
             if elem.l == 0:
@@ -1096,6 +1363,8 @@ class CSR(PhysProc):
             self.plt.show()
             # data = np.array([np.array(self.s), np.array(self.total_wake)])
             # np.savetxt("trajectory_cos.txt", self.csr_traj)
+        if self.cache is not None:
+            self.cache.set_trajectory(self.traj_key, self.csr_traj)
         return self.csr_traj
 
     def apply(self, p_array, delta_s):
@@ -1106,14 +1375,13 @@ class CSR(PhysProc):
         s_cur = self.z0 - self.z_csr_start
         z = -p_array.tau()
 
-        ind_z_sort = np.argsort(z)
+        ind_z_sort = self.projection(("argsort", "-tau"), lambda: np.argsort(z))
         #SBINB, NBIN = subbin_bound(p_array.q_array, z[ind_z_sort], self.x_qbin, self.n_bin, self.m_bin)
         #B_params = [self.x_qbin, self.n_bin, self.m_bin, self.ip_method, self.sp, self.sigma_min]
         #s1, s2, Ns, lam_ds = Q2EQUI(p_array.q_array[ind_z_sort], B_params, SBINB, NBIN)
-        SBINB, NBIN = self.sub_bin.subbin_bound(p_array.q_array, z[ind_z_sort], self.x_qbin, self.n_bin, self.m_bin)
-
         B_params = [self.x_qbin, self.n_bin, self.m_bin, self.ip_method, self.sp, self.sigma_min]
-        s1, s2, Ns, lam_ds = self.bin_smoth.Q2EQUI(p_array.q_array[ind_z_sort], B_params, SBINB, NBIN)
+        s1, s2, Ns, lam_ds = self.projection(("csr_binning", self.comm is None) + tuple(B_params),
+                                             lambda: self.binning(z, p_array.q_array, ind_z_sort, B_params))
 
         st = (s2 - s1) / Ns
         sa = s1 + st / 2.
@@ -1131,8 +1399,12 @@ class CSR(PhysProc):
         itr_ra = np.unique(-np.round(np.arange(-indx, -indx_prev, h))).astype(int)
         #print(s1, s2, Ns, Ndw, itr_ra)
         K1 = 0
-        for it in itr_ra:
-            K1 += self.CSR_K1(it, self.csr_traj, Ndw, gamma=gamma)
+        if self.block_size > 0 and self.cache is None:
+            for i in range(0, len(itr_ra), self.block_size):
+                K1 += self.CSR_K1_block(itr_ra[i:i + self.block_size], self.csr_traj, Ndw, gamma)
+        else:
+            for it in itr_ra:
+                K1 += self.CSR_K1(it, self.csr_traj, Ndw, gamma=gamma)
             #plt.plot(np.linspace(s1, s2, num=int(Ns)), K1*st)
             #plt.show()
 
@@ -1158,12 +1430,54 @@ class CSR(PhysProc):
         if self.pict_debug:
             self.plot_wake(p_array, lam_K1, itr_ra, s1, st)
 
+    def binning(self, z, q, ind_z_sort, B_params):
+        """
+        Charge density on the equidistant grid
+
+        :param z: longitudinal coordinates of the particles
+        :param q: charges of the particles
+        :param ind_z_sort: indices which sort z
+        :param B_params: [x_qbin, n_bin, m_bin, ip_method, sp, sigma_min]
+        :return: s1, s2, Ns, lam_ds
+        """
+        if self.comm is not None:
+            return self.binning_mpi(z, q)
+        SBINB, NBIN = self.sub_bin.subbin_bound(q, z[ind_z_sort], self.x_qbin, self.n_bin, self.m_bin)
+        return tuple(self.bin_smoth.Q2EQUI(q[ind_z_sort], B_params, SBINB, NBIN))
+
+    def binning_mpi(self, z, q):
+        """
+        Binning of the ParticleArray distributed between MPI ranks (self.comm).
+        For the length binning (x_qbin = 0) the sub-bins are equidistant and only the charges of the sub-bins
+        are reduced, otherwise the coordinates and charges of all particles are gathered on every rank.
+
+        :param z: longitudinal coordinates of the local particles
+        :param q: charges of the local particles
+        :return: s1, s2, Ns, lam_ds - see Smoothing.Q2EQUI
+        """
+        B_params = [self.x_qbin, self.n_bin, self.m_bin, self.ip_method, self.sp, self.sigma_min]
+        if self.x_qbin != 0:
+            z = self.comm.allgather(z)
+            q = self.comm.allgather(q)
+            ind_z_sort = np.argsort(z)
+            SBINB, NBIN = self.sub_bin.subbin_bound(q[ind_z_sort], z[ind_z_sort], self.x_qbin, self.n_bin, self.m_bin)
+            return self.bin_smoth.Q2EQUI(q[ind_z_sort], B_params, SBINB, NBIN)
+
+        K_BIN = self.n_bin * self.m_bin
+        SBINB = np.linspace(float(self.comm.min(z)), float(self.comm.max(z)), K_BIN + 1)
+        ib = np.clip(np.searchsorted(SBINB, z, side='right') - 1, 0, K_BIN - 1)
+        Q_BIN = self.comm.allreduce(np.bincount(ib, q, K_BIN))
+        # with one "particle" per sub-bin Q2EQUI takes the charges of the sub-bins as they are
+        return self.bin_smoth.Q2EQUI(Q_BIN, B_params, SBINB, np.ones(K_BIN))
+
     def finalize(self, *args, **kwargs):
         """
         the method is called at the end of tracking
 
         :return:
         """
+        if self.cache is not None:
+            self.cache.flush()
         # if self.pict_debug:
         #     data = np.array([ np.array(self.total_wake)])
         #     np.savetxt("total_wake_test.txt", data)
@@ -10,7 +10,12 @@ from ocelot.cpbd.beam import Particle
 from ocelot.cpbd.elements import *
 from ocelot.cpbd.beam import get_envelope
 from ocelot.cpbd.track import track
-from ocelot.cpbd.optics import lattice_transfer_map, twiss, Twiss
+from ocelot.cpbd.optics import lattice_transfer_map, twiss, Twiss, OpticsTable, twiss_blocks, propagate_twiss, \
+    prefix_products
+from ocelot.cpbd.r_matrix import uni_matrix_derivative, rot_mtx
+from ocelot.cpbd.elements.magnet import Magnet
+from ocelot.cpbd.elements.bend_atom import BendAtom
+from ocelot.cpbd.transformations.transformation import TMTypes
 from ocelot.cpbd.elements.optic_element import OpticElement
 from ocelot.cpbd.tm_utils import SecondOrderMult
 
@@ -39,6 +44,323 @@ def weights_default(val):
     return 0.0001
 
 
+class MatchOptics:
+    """
+    First order optics of the lattice for match().
+    The Twiss propagation blocks of all transfer maps are cached. After a change of the variables only the maps
+    of the changed elements are recalculated and the Twiss parameters are propagated from the first changed element
+    up to the last row which is needed for the constraints. Rows upstream are taken from the previous evaluation.
+
+    Row i of the table is the Twiss after the i-th transfer map (row 0 is the initial Twiss).
+
+    :param lat: MagneticLattice
+    :param tw: initial Twiss, its energy is used for the transfer maps
+    :param last_row: None or the last row which is evaluated, None - all rows
+    """
+    twiss0_attrs = ("beta_x", "alpha_x", "beta_y", "alpha_y", "Dx", "Dxp", "Dy", "Dyp", "mux", "muy", "E", "s")
+
+    def __init__(self, lat, tw, last_row=None):
+        self.lat = lat
+        self.E0 = tw.E
+        self.last_row = last_row
+        self.build()
+
+    def build(self):
+        zero_tol = 1.e-10
+        E = self.E0
+        R, k_energy, energies, lengths, ids = [], [], [E], [], [""]
+        self.elem_rows = []  # (first map index, number of maps) of every element of lat.sequence
+        for e in self.lat.sequence:
+            tms = e.first_order_tms
+            self.elem_rows.append((len(R), len(tms)))
+            for tm in tms:
+                R.append(tm.get_params(energy=E).get_rotated_R())
+                delta_e = tm.get_delta_e()
+                if abs(delta_e) > zero_tol:
+                    k_energy.append(np.sqrt((E + delta_e) / E))
+                    E = E + delta_e
+                else:
+                    k_energy.append(1.)
+                energies.append(E)
+                lengths.append(tm.delta_length if tm.delta_length is not None else tm.length)
+                ids.append(e.id)
+        self.n = len(R)
+        self.k = np.array(k_energy)
+        self.energies = np.array(energies)
+        self.lengths = np.array(lengths, dtype=float)
+        self.ids = ids
+        self.Mx, self.My = twiss_blocks(np.array(R, dtype=float).reshape(self.n, 6, 6), self.k)
+        self.table = None
+        self.twiss0 = None
+
+    def element_rows(self, elem):
+        """
+        :return: list of table rows after every map of every occurrence of elem in lat.sequence
+        """
+        rows = []
+        for e, (start, count) in zip(self.lat.sequence, self.elem_rows):
+            if e is elem:
+                rows.extend(range(start + 1, start + count + 1))
+        return rows
+
+    def update_elements(self, elements):
+        """
+        Recalculates the transfer maps of the changed elements
+
+        :param elements: list of elements
+        :return: index of the first changed map
+        """
+        first = self.n
+        elements = set(elements)
+        for j, e in enumerate(self.lat.sequence):
+            if e not in elements:
+                continue
+            start, count = self.elem_rows[j]
+            tms = e.first_order_tms
+            if len(tms) != count:
+                self.build()
+                return 0
+            R = np.array([tm.get_params(energy=self.energies[start + i]).get_rotated_R() for i, tm in enumerate(tms)])
+            Mx, My = twiss_blocks(R, self.k[start:start + count])
+            self.Mx[start:start + count] = Mx
+            self.My[start:start + count] = My
+            self.lengths[start:start + count] = [tm.delta_length if tm.delta_length is not None else tm.length
+                                                 for tm in tms]
+            first = min(first, start)
+        return first
+
+    def evaluate(self, tw0, first=0):
+        """
+        Twiss parameters along the lattice
+
+        :param tw0: initial Twiss
+        :param first: index of the first map which is changed since the previous evaluation
+        :return: OpticsTable
+        """
+        twiss0 = tuple(getattr(tw0, name) for name in self.twiss0_attrs)
+        if self.table is None or twiss0 != self.twiss0:
+            data = {"s": None, "E": self.energies}
+            for name in OpticsTable.columns[2:]:
+                data[name] = np.zeros(self.n + 1)
+            self.table = OpticsTable(tw0, data, self.ids)
+            self.twiss0 = twiss0
+            first = 0
+        table = self.table
+        table.tws0 = tw0
+        table._template = None
+        last = self.n if self.last_row is None else self.last_row
+        table.s = np.cumsum(np.append(tw0.s, self.lengths))
+        if first >= last:
+            return table
+        for M, names in [(self.Mx, ("beta_x", "alpha_x", "Dx", "Dxp", "mux")),
+                         (self.My, ("beta_y", "alpha_y", "Dy", "Dyp", "muy"))]:
+            cols = [getattr(table, name) for name in names]
+            if first == 0:
+                v0 = [getattr(tw0, name) for name in names]
+                for col, v in zip(cols, v0):
+                    col[0] = v
+            else:
+                v0 = [col[first] for col in cols]
+            for col, v in zip(cols, propagate_twiss(M[first:last], *v0)):
+                col[first + 1:last + 1] = v
+        return table
+
+
+    def prepare_derivatives(self, det_tol=1e-10):
+        """
+        Cumulative products of the Twiss blocks and their inverses which are used by derivatives()
+
+        :param det_tol: tolerance of the unit determinant, see propagate_twiss()
+        """
+        self.Q, self.Q_inv, self.bounds = [], [], []
+        for M in (self.Mx, self.My):
+            Q = np.empty((self.n + 1, 3, 3))
+            Q[0] = np.eye(3)
+            Q[1:] = prefix_products(M)
+            self.Q.append(Q)
+            self.Q_inv.append(np.linalg.inv(Q))
+            # as in propagate_twiss() the maps with non unit determinant are applied one by one
+            det = M[:, 0, 0] * M[:, 1, 1] - M[:, 0, 1] * M[:, 1, 0]
+            breaks = np.flatnonzero(np.abs(det - 1.) > det_tol)
+            self.bounds.append(np.unique(np.concatenate([[0, self.n], breaks, breaks + 1])))
+
+    def derivatives(self, rows, dmaps, dtw0):
+        """
+        Derivatives of the Twiss parameters over one variable at the table rows.
+        The variation of the maps is propagated with the cumulative products:
+        dQ_r = Q_r * sum_{j < r} Q_{j+1}^-1 dM_j Q_j. Beta and alpha are differentiated segment by segment
+        and the phase advance map by map in the same way as they are calculated in propagate_twiss().
+        prepare_derivatives() must be called after the last evaluate().
+
+        :param rows: array of table rows
+        :param dmaps: dictionary {map index: (dMx, dMy, dl)}, derivatives of the Twiss blocks and length of the maps
+        :param dtw0: dictionary of the derivatives of the initial Twiss parameters, e.g. {"beta_x": 1.}
+        :return: dictionary {column: array of the derivatives at the rows}
+        """
+        table = self.table
+        rows = np.asarray(rows, dtype=int)
+        last = np.max(rows)
+        out = {}
+        maps = np.array(sorted(dmaps), dtype=int)
+        n_before = np.searchsorted(maps, np.arange(last + 1), side="left")
+        dl = np.cumsum([0.] + [dmaps[j][2] for j in maps])
+        out["s"] = dl[n_before][rows]
+        out["E"] = np.zeros(len(rows))
+        for plane, (xy, names) in enumerate([("x", ("beta_x", "alpha_x", "Dx", "Dxp", "mux")),
+                                             ("y", ("beta_y", "alpha_y", "Dy", "Dyp", "muy"))]):
+            Q, Q_inv = self.Q[plane][:last + 1], self.Q_inv[plane]
+            if len(maps) > 0:
+                dM = np.array([dmaps[j][plane] for j in maps])
+                G = np.matmul(np.matmul(Q_inv[maps + 1], dM), self.Q[plane][maps])
+                C = np.concatenate([np.zeros((1, 3, 3)), np.cumsum(G, axis=0)])[n_before]
+            else:
+                dM = np.zeros((0, 3, 3))
+                C = np.zeros((last + 1, 3, 3))
+            beta, alpha = getattr(table, names[0])[:last + 1], getattr(table, names[1])[:last + 1]
+            D0, Dp0 = getattr(table, names[2])[0], getattr(table, names[3])[0]
+            dD0, dDp0 = dtw0.get(names[2], 0.), dtw0.get(names[3], 0.)
+            dQ = np.matmul(Q, C)
+            dD = dQ[:, 0, 0] * D0 + dQ[:, 0, 1] * Dp0 + dQ[:, 0, 2] + Q[:, 0, 0] * dD0 + Q[:, 0, 1] * dDp0
+            dDp = dQ[:, 1, 0] * D0 + dQ[:, 1, 1] * Dp0 + dQ[:, 1, 2] + Q[:, 1, 0] * dD0 + Q[:, 1, 1] * dDp0
+
+            dbeta = np.zeros(last + 1)
+            dalpha = np.zeros(last + 1)
+            dbeta[0], dalpha[0] = dtw0.get(names[0], 0.), dtw0.get(names[1], 0.)
+            bounds = self.bounds[plane]
+            for start, stop in zip(bounds[:-1], bounds[1:]):
+                if start >= last:
+                    break
+                stop = min(stop, last)
+                # products relative to the start of the segment: Q_r Q_start^-1
+                Qs = np.matmul(Q[start + 1:stop + 1], Q_inv[start])
+                dQs = np.matmul(np.matmul(Q[start + 1:stop + 1], C[start + 1:stop + 1] - C[start]), Q_inv[start])
+                b0, a0, db0, da0 = beta[start], alpha[start], dbeta[start], dalpha[start]
+                g0 = (1. + a0 * a0) / b0
+                dg0 = (2. * a0 * da0 * b0 - (1. + a0 * a0) * db0) / b0 ** 2
+                a, b, c, d = Qs[:, 0, 0], Qs[:, 0, 1], Qs[:, 1, 0], Qs[:, 1, 1]
+                da, db, dc, dd = dQs[:, 0, 0], dQs[:, 0, 1], dQs[:, 1, 0], dQs[:, 1, 1]
+                dbeta[start + 1:stop + 1] = (2. * a * da * b0 - 2. * (da * b + a * db) * a0 + 2. * b * db * g0
+                                             + a * a * db0 - 2. * a * b * da0 + b * b * dg0)
+                dalpha[start + 1:stop + 1] = (-(da * c + a * dc) * b0 + (da * d + a * dd + db * c + b * dc) * a0
+                                              - (db * d + b * dd) * g0 - a * c * db0 + (a * d + b * c) * da0
+                                              - b * d * dg0)
+
+            # phase advance of every map with the Twiss before the map
+            M = (self.Mx, self.My)[plane][:last]
+            dM00, dM01 = np.zeros(last), np.zeros(last)
+            in_range = maps < last
+            dM00[maps[in_range]] = dM[in_range, 0, 0]
+            dM01[maps[in_range]] = dM[in_range, 0, 1]
+            u = M[:, 0, 0] * beta[:-1] - M[:, 0, 1] * alpha[:-1]
+            du = dM00 * beta[:-1] + M[:, 0, 0] * dbeta[:-1] - dM01 * alpha[:-1] - M[:, 0, 1] * dalpha[:-1]
+            d_mu = (u * dM01 - M[:, 0, 1] * du) / (u * u + M[:, 0, 1] ** 2)
+            dmu = np.cumsum(np.append(dtw0.get(names[4], 0.), d_mu))
+
+            out[names[0]], out[names[1]] = dbeta[rows], dalpha[rows]
+            out[names[2]], out[names[3]], out[names[4]] = dD[rows], dDp[rows], dmu[rows]
+            beta, alpha, dbeta, dalpha = beta[rows], alpha[rows], dbeta[rows], dalpha[rows]
+            out["gamma_" + xy] = (2. * alpha * dalpha * beta - (1. + alpha * alpha) * dbeta) / beta ** 2
+            out["emit_" + xy] = np.zeros(len(rows))
+        return out
+
+    def periodic_derivatives(self, dmaps):
+        """
+        Derivatives of the periodic solution (see periodic_twiss()) over one variable
+
+        :param dmaps: dictionary {map index: (dMx, dMy, dl)}
+        :return: dictionary of the derivatives of the initial Twiss parameters
+        """
+        out = {}
+        maps = np.array(sorted(dmaps), dtype=int)
+        for plane, names in enumerate([("beta_x", "alpha_x", "Dx", "Dxp"), ("beta_y", "alpha_y", "Dy", "Dyp")]):
+            Q = self.Q[plane][self.n]
+            dQ = np.zeros((3, 3))
+            for j in maps:
+                dQ += np.dot(Q, np.dot(np.dot(self.Q_inv[plane][j + 1], dmaps[j][plane]), self.Q[plane][j]))
+            cos_mu = (Q[0, 0] + Q[1, 1]) / 2.
+            sin_mu = np.sign(Q[0, 1]) * np.sqrt(1. - cos_mu * cos_mu)
+            dcos = (dQ[0, 0] + dQ[1, 1]) / 2.
+            dsin = -cos_mu * dcos / sin_mu
+            out[names[0]] = np.sign(Q[0, 1] / sin_mu) * (dQ[0, 1] * sin_mu - Q[0, 1] * dsin) / sin_mu ** 2
+            out[names[1]] = ((dQ[0, 0] - dQ[1, 1]) * sin_mu - (Q[0, 0] - Q[1, 1]) * dsin) / (2. * sin_mu ** 2)
+            H = np.eye(2) - Q[:2, :2]
+            D = np.linalg.solve(H, Q[:2, 2])
+            dD = np.linalg.solve(H, dQ[:2, 2] + np.dot(dQ[:2, :2], D))
+            out[names[2]], out[names[3]] = dD
+        return out
+
+
+
+def element_derivatives(elem, attr, energies, step=1e-6):
+    """
+    Derivatives of the rotated R matrices of the first order maps of the element over its attribute.
+    The main maps of the magnets (see uni_matrix()) and the bend edges are differentiated analytically,
+    the maps of other elements by central differences.
+
+    :param elem: element
+    :param attr: attribute name, e.g. "k1", "angle" or "l"
+    :param energies: energy before every map of the element
+    :param step: relative step of the central differences
+    :return: dR - array (n, 6, 6), dl - array (n,), derivatives of the lengths
+    """
+    atom = elem.element
+    tms = elem.first_order_tms
+    is_magnet = isinstance(atom, Magnet) and \
+        type(atom).create_first_order_main_params is Magnet.create_first_order_main_params
+    if not is_magnet or attr not in ("k1", "angle", "l"):
+        x0 = getattr(elem, attr)
+        h = step * max(1., abs(x0))
+        dR = []
+        for sign in (1., -1.):
+            setattr(elem, attr, x0 + sign * h)
+            dR.append(np.array([tm.get_params(E).get_rotated_R() for tm, E in zip(elem.first_order_tms, energies)]))
+        setattr(elem, attr, x0)
+        dl = np.array([float(tm.tm_type == TMTypes.MAIN and attr == "l") for tm in elem.first_order_tms])
+        return (dR[0] - dR[1]) / (2. * h), dl
+
+    hx = atom.angle / atom.l if atom.l != 0 else 0.
+    dz, dk1, dhx = 0., 0., 0.
+    if attr == "k1":
+        dk1 = 1.
+    elif attr == "angle":
+        dhx = 1. / atom.l if atom.l != 0 else 0.
+    else:
+        dz = 1.
+        dhx = -atom.angle / atom.l ** 2 if atom.l != 0 else 0.
+    dR = np.zeros((len(tms), 6, 6))
+    dl = np.zeros(len(tms))
+    for i, (tm, E) in enumerate(zip(tms, energies)):
+        if tm.tm_type == TMTypes.MAIN:
+            dR[i] = uni_matrix_derivative(atom.l, atom.k1, hx, dz=dz, dk1=dk1, dhx=dhx, sum_tilts=atom.tilt, energy=E)
+            dl[i] = dz
+        elif isinstance(atom, BendAtom) and dhx != 0:
+            # edge, see BendAtom._R_edge()
+            fint, edge = (atom.fint, atom.e1) if tm.tm_type == TMTypes.ENTRANCE else (atom.fintx, atom.e2)
+            c = fint * atom.gap / np.cos(edge) * (1. + np.sin(edge) ** 2)
+            dR[i, 1, 0] = dhx * np.tan(edge)
+            dR[i, 3, 2] = -dhx * (np.tan(edge - c * hx) - hx * c / np.cos(edge - c * hx) ** 2)
+            dR[i] = np.dot(np.dot(rot_mtx(-atom.tilt), dR[i]), rot_mtx(atom.tilt))
+    return dR, dl
+
+def optics_table_constr(constr):
+    """
+    Checks if all constrained parameters are available in OpticsTable, e.g. the closed orbit (x, xp, ...) is not.
+
+    :param constr: dictionary of constraints, see match()
+    :return: True or False
+    """
+    keys = set(OpticsTable.columns) | {"gamma_x", "gamma_y", "emit_x", "emit_y"}
+    for e, rules in constr.items():
+        if e in ('periodic', 'total_len'):
+            continue
+        if e == 'delta':
+            if any(rule[0] not in keys for el, rule in rules.items() if isinstance(el, OpticElement)):
+                return False
+        elif any(k not in keys for k in rules.keys()):
+            return False
+    return True
+
+
 def match(lat, constr, vars, tw, verbose=True, max_iter=1000, method='simplex', weights=weights_default,
           vary_bend_angle=False, min_i5=False, tol=1e-5):
     """
@@ -79,7 +401,10 @@ def match(lat, constr, vars, tw, verbose=True, max_iter=1000, method='simplex',
     :param tw: initial Twiss
     :param verbose: allow print output of minimization procedure
     :param max_iter:
-    :param method: string, available 'simplex', 'cg', 'bfgs'
+    :param method: string, available 'simplex', 'cg', 'bfgs' and 'lsq'.
+                    'lsq' - least squares (scipy.optimize.least_squares) with the analytic Jacobian of the
+                    constrained Twiss parameters over the variables, the penalties are the squares of the residuals
+                    sqrt(weight) * (val - v1). Not available with min_i5 and constraints on the orbit.
     :param weights: function returns weights, for example
                     def weights_default(val):
                         if val == 'periodic': return 10000001.0
@@ -97,19 +422,41 @@ def match(lat, constr, vars, tw, verbose=True, max_iter=1000, method='simplex',
 
     # tw = deepcopy(tw0)
 
-    def errf(x):
-
-        tw_loc = deepcopy(tw)
-        tw0 = deepcopy(tw)
-
+    def sequential_events(tw_loc):
+        for e in lat.sequence:
+            for tm in e.first_order_tms:
+                tw_loc = tm * tw_loc  # apply transfer map
+                yield e, tw_loc
+
+    def var_elements(v):
+        if isinstance(v, tuple):
+            return list(v)
+        if isinstance(v, dict):
+            return list(v.keys())
+        if isinstance(v, OpticElement):
+            return [v]
+        return []
+
+    def global_error(table):
+        err = 0.0
+        for c, rule in constr['global'].items():
+            if isinstance(rule, list):
+                op, v1 = rule[0], rule[1]
+                val = getattr(table, c)[1:]
+                if op == '<':
+                    err += weights(c) * np.sum((val[val > v1] - v1) ** 2)
+                elif op == '>':
+                    err += weights(c) * np.sum((val[val < v1] - v1) ** 2)
+        return err
 
+    def set_vars(x, tw_loc):
         # parameter to be varied is determined by variable class
 
         for i in range(len(vars)):
             if isinstance(vars[i], Drift):
                 if x[i] < 0:
                     # print('negative length in match')
-                    return weights('negative_length')
+                    return False
 
                 vars[i].l = x[i]
             if isinstance(vars[i], Quadrupole):
@@ -134,6 +481,23 @@ def match(lat, constr, vars, tw, verbose=True, max_iter=1000, method='simplex',
             # with coupling parameters given as values.
                 for q in vars[i].keys():
                     q.k1 = vars[i][q] * x[i]
+        return True
+
+    def evaluate_optics(x, tw_loc):
+        changed = [e for i, v in enumerate(vars) if x[i] != x_prev[i] for e in var_elements(v)]
+        x_prev[:] = x
+        if tw_loc.E != optics.E0:
+            optics.E0 = tw_loc.E
+            optics.build()
+        return optics.evaluate(tw_loc, first=optics.update_elements(changed))
+
+    def errf(x):
+
+        tw_loc = deepcopy(tw)
+        tw0 = deepcopy(tw)
+
+        if not set_vars(x, tw_loc):
+            return weights('negative_length')
 
         err = 0.0
         if "periodic" in constr.keys():
@@ -161,68 +525,75 @@ def match(lat, constr, vars, tw, verbose=True, max_iter=1000, method='simplex',
 
         tw_loc.s = 0
 
-        for e in lat.sequence:
-            for tm in e.first_order_tms:
-                tw_loc = tm * tw_loc  # apply transfer map
+        if optics is None:
+            events = sequential_events(tw_loc)
+        else:
+            table = evaluate_optics(x, tw_loc)
+            if 'global' in constr:
+                err += global_error(table)
+            events = ((e, table[row]) for row, e in event_rows)
 
-                # --- Global constraints ---
-                if 'global' in constr:
-                    for c, rule in constr['global'].items():
-                        if isinstance(rule, list):
-                            op, v1 = rule[0], rule[1]
-                            val = getattr(tw_loc, c)
-
-                            if op == '<' and val > v1:
-                                err += weights(c) * (val - v1) ** 2
-                            elif op == '>' and val < v1:
-                                err += weights(c) * (val - v1) ** 2
-
-                # --- Delta constraint update ---
-                if 'delta' in constr and e in constr['delta']:
-                    tw_k = constr['delta'][e][0]
-                    constr['delta'][e][1] = getattr(tw_loc, tw_k)
-
-                # --- Update reference hash if needed ---
-                if e in ref_hsh:
-                    ref_hsh[e] = deepcopy(tw_loc)
-
-                # --- Local constraints ---
-                if e in constr:
-                    for k, rule in constr[e].items():
-                        val = getattr(tw_loc, k)
-
-                        if isinstance(rule, list):
-                            op = rule[0]
-                            v1 = rule[1]
-
-                            if op == '<' and val > v1:
-                                err += weights(k) * (val - v1) ** 2
-                            elif op == '>' and val < v1:
-                                err += weights(k) * (val - v1) ** 2
-                            elif op == 'a<' and abs(val) > v1:
-                                err += weights(k) * (abs(val) - v1) ** 2
-                            elif op == 'a>' and abs(val) < v1:
-                                err += weights(k) * (abs(val) - v1) ** 2
-                            elif op == '->':
-                                try:
-                                    dv1 = float(rule[2]) if len(rule) > 2 else 0.0
-                                    ref_val = getattr(ref_hsh[v1], k)
-                                    err += (val - (ref_val + dv1)) ** 2
-                                    if val < v1:
-                                        err += (val - v1) ** 2
-                                except Exception as ex:
-                                    print(f'Constraint error: rval should precede lval in lattice ({ex})')
-
-                            if val < 0:
-                                err += (val - v1) ** 2
-
-                        elif isinstance(rule, str):
-                            # handle symbolic constraints if any
-                            pass
-                        else:
-                            # direct comparison
-                            ref_val = rule
-                            err += weights(k) * (ref_val - val) ** 2
+        for e, tw_loc in events:
+            # --- Global constraints ---
+            if optics is None and 'global' in constr:
+                for c, rule in constr['global'].items():
+                    if isinstance(rule, list):
+                        op, v1 = rule[0], rule[1]
+                        val = getattr(tw_loc, c)
+
+                        if op == '<' and val > v1:
+                            err += weights(c) * (val - v1) ** 2
+                        elif op == '>' and val < v1:
+                            err += weights(c) * (val - v1) ** 2
+
+            # --- Delta constraint update ---
+            if 'delta' in constr and e in constr['delta']:
+                tw_k = constr['delta'][e][0]
+                constr['delta'][e][1] = getattr(tw_loc, tw_k)
+
+            # --- Update reference hash if needed ---
+            if e in ref_hsh:
+                ref_hsh[e] = deepcopy(tw_loc)
+
+            # --- Local constraints ---
+            if e in constr:
+                for k, rule in constr[e].items():
+                    val = getattr(tw_loc, k)
+
+                    if isinstance(rule, list):
+                        op = rule[0]
+                        v1 = rule[1]
+
+                        if op == '<' and val > v1:
+                            err += weights(k) * (val - v1) ** 2
+                        elif op == '>' and val < v1:
+                            err += weights(k) * (val - v1) ** 2
+                        elif op == 'a<' and abs(val) > v1:
+                            err += weights(k) * (abs(val) - v1) ** 2
+                        elif op == 'a>' and abs(val) < v1:
+                            err += weights(k) * (abs(val) - v1) ** 2
+                        elif op == '->':
+                            try:
+                                dv1 = float(rule[2]) if len(rule) > 2 else 0.0
+                                ref_val = getattr(ref_hsh[v1], k)
+                                err += (val - (ref_val + dv1)) ** 2
+                                if val < v1:
+                                    err += (val - v1) ** 2
+                            except Exception as ex:
+                                print(f'Constraint error: rval should precede lval in lattice ({ex})')
+
+                        if val < 0:
+                            err += (val - v1) ** 2
+
+                    elif isinstance(rule, str):
+                        # handle symbolic constraints if any
+                        pass
+                    else:
+                        # direct comparison
+                        ref_val = rule
+                        err += weights(k) * (ref_val - val) ** 2
+        if optics is not None:
+            tw_loc.s = table.s[-1]
         if "total_len" in constr.keys():
             total_len = constr["total_len"]
             err = err + weights('total_len') * (tw_loc.s - total_len) ** 2
@@ -256,6 +627,141 @@ def match(lat, constr, vars, tw, verbose=True, max_iter=1000, method='simplex',
             print('iteration error:', err)
         return err
 
+    def var_dmaps(v):
+        # derivatives of the Twiss blocks of the maps and of the initial Twiss over one variable
+        if isinstance(v, list):
+            return {}, {v[1]: 1.}
+        if isinstance(v, dict):
+            coefs = [(e, 'k1', coef) for e, coef in v.items()]
+        elif isinstance(v, tuple):
+            coefs = [(e, 'k1', 1.) for e in v]
+        elif isinstance(v, Drift):
+            coefs = [(v, 'l', 1.)]
+        elif isinstance(v, Solenoid):
+            coefs = [(v, 'k', 1.)]
+        elif isinstance(v, (RBend, SBend, Bend)):
+            coefs = [(v, 'angle' if vary_bend_angle else 'k1', 1.)]
+        else:
+            coefs = [(v, 'k1', 1.)]
+        dmaps = {}
+        for e, attr, coef in coefs:
+            for elem, (start, count) in zip(lat.sequence, optics.elem_rows):
+                if elem is not e:
+                    continue
+                dR, dl = element_derivatives(e, attr, optics.energies[start:start + count])
+                dMx, dMy = twiss_blocks(dR, optics.k[start:start + count])
+                dMx[:, 2, 2] = 0.
+                dMy[:, 2, 2] = 0.
+                for m in range(count):
+                    dMx0, dMy0, dl0 = dmaps.get(start + m, (0., 0., 0.))
+                    dmaps[start + m] = (dMx0 + coef * dMx[m], dMy0 + coef * dMy[m], dl0 + coef * dl[m])
+        return dmaps, {}
+
+    def lsq_terms(table):
+        # residuals are linear combinations of the table values: const + sum(coef * table.key[row])
+        terms = []
+        last_rows = {}
+        for row, e in event_rows:
+            last_rows[e] = row
+            if e not in constr:
+                continue
+            for k, rule in constr[e].items():
+                val = getattr(table, k)[row]
+                if isinstance(rule, list):
+                    op, v1 = rule[0], rule[1]
+                    if op == '->':
+                        dv1 = float(rule[2]) if len(rule) > 2 else 0.0
+                        if v1 in last_rows:
+                            term = (-dv1, [(1., row, k), (-1., last_rows[v1], k)])
+                        else:
+                            term = (0., [])
+                        terms.append(term)
+                        # penalty of the negative value as in errf, v1 is the reference element, the target is used
+                        terms.append(term if val < 0 else (0., []))
+                        continue
+                    sw = np.sqrt(weights(k))
+                    active = {'<': val > v1, '>': val < v1, 'a<': abs(val) > v1, 'a>': abs(val) < v1}.get(op, False)
+                    if active:
+                        sign = np.sign(val) if op in ('a<', 'a>') else 1.
+                        terms.append((-sw * v1, [(sw * sign, row, k)]))
+                    else:
+                        terms.append((0., []))
+                    terms.append((-v1, [(1., row, k)]) if val < 0 else (0., []))
+                elif not isinstance(rule, str):
+                    sw = np.sqrt(weights(k))
+                    terms.append((-sw * rule, [(sw, row, k)]))
+        if "total_len" in constr:
+            sw = np.sqrt(weights('total_len'))
+            terms.append((-sw * constr["total_len"], [(sw, len(table) - 1, 's')]))
+        if 'delta' in constr:
+            delta_dict = constr['delta']
+            elems = [e for e in delta_dict.keys() if isinstance(e, OpticElement)]
+            sw = np.sqrt(delta_dict["weight"])
+            terms.append((-sw * delta_dict["val"], [(sw, last_rows[elems[1]], delta_dict[elems[1]][0]),
+                                                    (-sw, last_rows[elems[0]], delta_dict[elems[0]][0])]))
+        return terms
+
+    lsq_state = {"x": None}
+
+    def lsq_eval(x):
+        tw_loc = deepcopy(tw)
+        set_vars(x, tw_loc)
+        if constr.get("periodic"):
+            tw_loc = lat.periodic_twiss(tw_loc)
+            if tw_loc is None:
+                lsq_state.update(x=np.array(x), table=None)
+                return np.ones(lsq_state["n_res"]) * np.sqrt(weights('periodic'))
+        tw_loc.s = 0
+        table = evaluate_optics(x, tw_loc)
+        terms = lsq_terms(table)
+        res = [const + sum(coef * getattr(table, k)[row] for coef, row, k in comb) for const, comb in terms]
+        if 'global' in constr:
+            for c, rule in constr['global'].items():
+                if isinstance(rule, list):
+                    op, v1 = rule[0], rule[1]
+                    val = getattr(table, c)[1:]
+                    active = val > v1 if op == '<' else val < v1
+                    res = np.append(res, np.sqrt(weights(c)) * np.where(active, val - v1, 0.))
+        res = np.array(res, dtype=float)
+        lsq_state.update(x=np.array(x), table=table, terms=terms, n_res=len(res))
+        if verbose:
+            print('iteration error:', np.sum(res ** 2))
+        return res
+
+    def lsq_jac(x):
+        if lsq_state["x"] is None or not np.array_equal(x, lsq_state["x"]):
+            lsq_eval(x)
+        J = np.zeros((lsq_state["n_res"], len(vars)))
+        table = lsq_state["table"]
+        if table is None:
+            return J
+        terms = lsq_state["terms"]
+        rows = sorted({row for _, comb in terms for _, row, _ in comb} | {0})
+        if 'global' in constr:
+            rows = list(range(len(table)))
+        rows = np.array(rows)
+        optics.prepare_derivatives()
+        for i, v in enumerate(vars):
+            dmaps, dtw0 = var_dmaps(v)
+            if constr.get("periodic"):
+                mu = {k: d for k, d in dtw0.items() if k in ('mux', 'muy')}
+                dtw0 = optics.periodic_derivatives(dmaps)
+                dtw0.update(mu)
+            d = optics.derivatives(rows, dmaps, dtw0)
+            idx = {row: j for j, row in enumerate(rows)}
+            for n_res, (_, comb) in enumerate(terms):
+                J[n_res, i] = sum(coef * d[k][idx[row]] for coef, row, k in comb)
+            n_res = len(terms)
+            if 'global' in constr:
+                for c, rule in constr['global'].items():
+                    if isinstance(rule, list):
+                        op, v1 = rule[0], rule[1]
+                        val = getattr(table, c)[1:]
+                        active = val > v1 if op == '<' else val < v1
+                        J[n_res:n_res + len(val), i] = np.sqrt(weights(c)) * np.where(active, d[c][1:], 0.)
+                        n_res += len(val)
+        return J
+
 
     # list of arguments determined based on the variable class
 
@@ -285,6 +791,32 @@ def match(lat, constr, vars, tw, verbose=True, max_iter=1000, method='simplex',
             else:
                 x[i] = vars[i].k1
 
+    # the first order optics is cached, after a step of the minimizer the Twiss parameters are re-evaluated
+    # only downstream of the changed variables and only up to the last constrained element
+    optics, event_rows, x_prev = None, [], [None] * len(x)
+    if optics_table_constr(constr):
+        event_elems = [e for e in list(constr.keys()) + list(constr.get('delta', {}).keys())
+                       if isinstance(e, OpticElement)]
+        for e in constr.keys():
+            if isinstance(e, OpticElement):
+                event_elems += [rule[1] for rule in constr[e].values() if isinstance(rule, list) and rule[0] == '->']
+        last_row = None
+        optics = MatchOptics(lat, tw)
+        for e in set(event_elems):
+            event_rows += [(row, e) for row in optics.element_rows(e)]
+        event_rows.sort(key=lambda r: r[0])
+        if 'global' not in constr:
+            last_row = event_rows[-1][0] if event_rows else 0
+        optics.last_row = last_row
+
+    if method == 'lsq':
+        if optics is None or min_i5:
+            raise ValueError("match: method='lsq' does not support the constraints on the orbit and min_i5")
+        for v in vars:
+            if isinstance(v, list) and v[1] not in ("beta_x", "alpha_x", "Dx", "Dxp", "mux",
+                                                    "beta_y", "alpha_y", "Dy", "Dyp", "muy"):
+                raise ValueError("match: method='lsq' does not support the variable " + str(v[1]))
+
     print("initial value: x = ", x)
     if method == 'simplex':
         res = fmin(errf, x, xtol=tol, maxiter=max_iter, maxfun=max_iter)
@@ -292,6 +824,15 @@ def match(lat, constr, vars, tw, verbose=True, max_iter=1000, method='simplex',
         res = fmin_cg(errf, x, gtol=tol, epsilon=1.e-5, maxiter=max_iter)
     if method == 'bfgs':
         res = fmin_bfgs(errf, x, gtol=tol, epsilon=1.e-5, maxiter=max_iter)
+    if method == 'lsq':
+        lower = [0. if isinstance(v, Drift) else -np.inf for v in vars]
+        lsq_eval(x)
+        if "n_res" not in lsq_state:
+            raise ValueError("match: periodic solution does not exist for the initial values")
+        result = least_squares(lsq_eval, x, jac=lsq_jac, bounds=(lower, np.inf), xtol=tol, ftol=1e-12,
+                               gtol=1e-12, max_nfev=max_iter)
+        res = result.x
+        set_vars(res, deepcopy(tw))
 
 
     # if initial twiss was varied set the twiss argument object to resulting value
@@ -596,7 +1137,7 @@ def match_matrix(lat, beam, varz, target_matrix):
     fmin(error_func, x, xtol=1e-8, maxiter=20000, maxfun=20000)
 
 
-def match_tunes(lat, tw0, quads, nu_x, nu_y, ncells=1, max_iter=1000, tol=1e-5, print_proc=0):
+def match_tunes(lat, tw0, quads, nu_x, nu_y, ncells=1, max_iter=1000, tol=1e-5, print_proc=0, method='simplex'):
     print("matching start .... ")
     end = Monitor(eid="end")
     lat = MagneticLattice(lat.sequence + [end])
@@ -612,7 +1153,7 @@ def match_tunes(lat, tw0, quads, nu_x, nu_y, ncells=1, max_iter=1000, tol=1e-5,
     # print constr
     vars = quads
 
-    match(lat, constr, vars, tws[0], max_iter=max_iter, tol=tol)
+    match(lat, constr, vars, tws[0], max_iter=max_iter, tol=tol, method=method)
     for i, q in enumerate(quads):
         print(q.id, ".k1: before: ", strengths1[i], "  after: ", q.k1)
     lat = MagneticLattice(lat.sequence[:-1])
@@ -3,9 +3,11 @@ from deap import base
 from deap import creator
 from deap import tools
 
+import os
 import pickle
 import numpy as np
 from scipy.optimize import *
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 try:
     from mpi4py import MPI
@@ -19,6 +21,99 @@ except Exception:
     MPI_RANK = 0
 
 
+class SerialEvaluator:
+    """
+    Evaluates the fitness function of the individuals one by one in the current process.
+    Evaluators are called on all MPI ranks, tasks and results are meaningful only on the rank 0.
+    """
+    def open(self):
+        pass
+
+    def close(self):
+        pass
+
+    def __call__(self, evaluate, tasks, iteration, args):
+        """
+        :param evaluate: fitness function, evaluate(x0=x, iter_data=(key, iteration), args=args)
+        :param tasks: list of (key, x), key is the index of the individual in the population
+        :param iteration: current generation
+        :param args: additional arguments of the fitness function
+        :return: list of fitnesses in the order of tasks
+        """
+        return [evaluate(x0=x, iter_data=(key, iteration), args=args) for key, x in tasks]
+
+
+def _evaluate_task(evaluate, key, x, iteration, args):
+    return key, evaluate(x0=x, iter_data=(key, iteration), args=args)
+
+
+class PoolEvaluator(SerialEvaluator):
+    """
+    Evaluates the individuals in a pool of local processes. Every individual is submitted as a separate task,
+    so a free worker takes the next individual as soon as it is done (dynamic scheduling)
+    and slow individuals do not hold the other workers.
+    The fitness function and its arguments must be picklable, e.g. a function defined at the module level.
+
+    :param nproc: number of processes, None - os.cpu_count()
+    """
+    def __init__(self, nproc=None):
+        self.nproc = nproc if nproc is not None else os.cpu_count()
+        self.executor = None
+
+    def open(self):
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(max_workers=self.nproc)
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+    def __call__(self, evaluate, tasks, iteration, args):
+        self.open()
+        futures = [self.executor.submit(_evaluate_task, evaluate, key, list(x), iteration, args) for key, x in tasks]
+        results = dict(f.result() for f in as_completed(futures))
+        return [results[key] for key, x in tasks]
+
+
+class MPIEvaluator(SerialEvaluator):
+    """
+    Master-worker evaluation over MPI ranks. The rank 0 sends the individuals one by one to the free ranks
+    and collects the results, so the work is balanced dynamically. With one rank it is SerialEvaluator.
+    """
+    def __call__(self, evaluate, tasks, iteration, args):
+        if MPI_SIZE == 1:
+            return SerialEvaluator.__call__(self, evaluate, tasks, iteration, args)
+
+        if MPI_RANK != 0:
+            while True:
+                task = MPI_COMM.recv(source=0)
+                if task is None:
+                    return None
+                key, x = task
+                MPI_COMM.send((key, evaluate(x0=x, iter_data=(key, iteration), args=args)), dest=0)
+
+        results = {}
+        n_sent = 0
+        for rank in range(1, MPI_SIZE):
+            if n_sent < len(tasks):
+                MPI_COMM.send(tasks[n_sent], dest=rank)
+                n_sent += 1
+            else:
+                MPI_COMM.send(None, dest=rank)
+        status = MPI.Status()
+        while len(results) < len(tasks):
+            key, fit = MPI_COMM.recv(source=MPI.ANY_SOURCE, status=status)
+            results[key] = fit
+            rank = status.Get_source()
+            if n_sent < len(tasks):
+                MPI_COMM.send(tasks[n_sent], dest=rank)
+                n_sent += 1
+            else:
+                MPI_COMM.send(None, dest=rank)
+        return [results[key] for key, x in tasks]
+
+
 class Moga():
 
     def __init__(self, bounds, weights=(-1.0, -1.0)):
@@ -50,6 +145,18 @@ class Moga():
         self.fit_func = lambda x: None
         self.fit_func_args = []
 
+        # fitness evaluation backend, see SerialEvaluator, PoolEvaluator, MPIEvaluator
+        self.evaluator = MPIEvaluator() if MPI_SIZE > 1 else SerialEvaluator()
+
+        # fitness values of the evaluated individuals, the key is the gene vector rounded to memo_decimals
+        # memo_decimals = None switches off the memoization, e.g. for a noisy fitness function
+        self.memo = {}
+        self.memo_decimals = 12
+        self.n_memo_hits = 0
+
+        # the population of every generation is saved to checkpoint_file, see load_checkpoint()
+        self.checkpoint_file = None
+
         self.vars_num = len(bounds)
         self.bounds_min = []
         self.bounds_max = []
@@ -58,7 +165,7 @@ class Moga():
             self.bounds_max.append(bounds[i][1])
 
     def set_params(self, n_pop=None, weights=None, elite=None, penalty=None, n_gen=None, seed=None, log_print=None,
-                   log_file=False, plt_file=False):
+                   log_file=False, plt_file=False, evaluator=None, memo_decimals=False, checkpoint_file=False):
 
         if n_pop != None:
             self.n_pop = n_pop
@@ -90,6 +197,15 @@ class Moga():
         if plt_file != False and MPI_RANK == 0:
             self.plt_file = plt_file
 
+        if evaluator != None:
+            self.evaluator = evaluator
+
+        if memo_decimals is not False:
+            self.memo_decimals = memo_decimals
+
+        if checkpoint_file != False and MPI_RANK == 0:
+            self.checkpoint_file = checkpoint_file
+
     def generate_ind(self):
         return [np.random.uniform(self.bounds_min[i], self.bounds_max[i]) for i in range(self.vars_num)]
 
@@ -124,6 +240,7 @@ class Moga():
         # Evaluate initial population
         self.c_iter = 0
         pop = self.eval_pop(pop)
+        self.save_checkpoint(pop)
 
         # This is just to assign the crowding distance to the individuals (no actual selection is done)
         pop = self.toolbox.select(pop, len(pop))
@@ -199,6 +316,8 @@ class Moga():
 
             invalid_ind = self.eval_pop(invalid_ind)
 
+            self.save_checkpoint(pop)
+
         self.c_iter = None
 
         return pop
@@ -218,62 +337,79 @@ class Moga():
 
         return pop
 
-    def eval_pop(self, pop):
-
-        # Split data
-        if MPI_SIZE > 1:
-            data_in = None
-            keys = None
-            if MPI_RANK == 0:
-                data_in = []
-                keys = []
-                length = int(len(pop) / MPI_SIZE)
-                for i in range(MPI_SIZE):
-                    start = i * length
-                    stop = start + length
-                    data_in.append(pop[start:stop])
-                    keys.append([ii for ii in range(start, stop)])
-
-                j = 0
-                for i in range(stop, len(pop)):
-                    data_in[j] += [pop[i]]
-                    keys[j] += [i]
-                    j += 1
-
-            data_in = MPI_COMM.scatter(data_in, root=0)
-            keys = MPI_COMM.scatter(keys, root=0)
-        else:
-            data_in = pop
-            keys = [ii for ii in range(len(data_in))]
-
-        # Evaluate initial population
-        fitnesses = [self.toolbox.evaluate(x0=x, iter_data=(key, self.c_iter), args=self.fit_func_args) for key, x in
-                     zip(keys, data_in)]
+    def memo_key(self, ind):
+        return tuple(np.round(np.asarray(ind, dtype=float), self.memo_decimals))
 
-        # Merge data
-        if MPI_SIZE > 1:
-            data_out = MPI_COMM.gather(fitnesses, root=0)
+    def eval_pop(self, pop):
 
-            if MPI_RANK == 0:
-                fitnesses = []
-                for i in data_out:
-                    fitnesses += i[:length]
-                for i in data_out:
-                    fitnesses += i[length:length + 1]
-                    j -= 1
-                    if j == 0: break
+        # Individuals with known fitness are taken from the memo, the same new individuals are evaluated once
+        tasks = []
+        if MPI_RANK == 0:
+            todo = {}
+            for i, ind in enumerate(pop):
+                if self.memo_decimals is None:
+                    tasks.append((i, ind))
+                    continue
+                key = self.memo_key(ind)
+                if key in self.memo:
+                    ind.fitness.values = self.memo[key]
+                    self.n_memo_hits += 1
+                elif key in todo:
+                    todo[key].append(ind)
+                else:
+                    todo[key] = [ind]
+                    tasks.append((i, ind))
+
+        fitnesses = self.evaluator(self.toolbox.evaluate, tasks, self.c_iter, self.fit_func_args)
 
         # Update population data
         if MPI_RANK == 0:
-            for ind, fit in zip(pop, fitnesses):
+            for (i, ind), fit in zip(tasks, fitnesses):
                 ind.fitness.values = fit
+                if self.memo_decimals is not None:
+                    key = self.memo_key(ind)
+                    self.memo[key] = ind.fitness.values
+                    for ind_same in todo[key][1:]:
+                        ind_same.fitness.values = ind.fitness.values
         else:
             pop = None
 
-        if self.log_print: print("Evaluated %i" % (len(pop)))
+        if self.log_print: print("Evaluated %i, new %i" % (len(pop), len(tasks)))
 
         return pop
 
+    def save_checkpoint(self, pop):
+        """
+        Saves the genes and fitnesses of the population, the memo and the state of the random generators
+        to self.checkpoint_file
+
+        :param pop: population
+        """
+        if self.checkpoint_file is None or MPI_RANK != 0:
+            return
+        data = {"iteration": self.c_iter, "n_gen": self.n_gen,
+                "population": [list(ind) for ind in pop],
+                "fitness": [ind.fitness.values for ind in pop],
+                "memo": self.memo,
+                "random_state": (random.getstate(), np.random.get_state())}
+        tmp_file = self.checkpoint_file + ".tmp"
+        with open(tmp_file, 'wb') as fh:
+            pickle.dump(data, fh, protocol=2)
+        os.replace(tmp_file, self.checkpoint_file)
+
+    def load_checkpoint(self, filename):
+        """
+        Restores the memo from a checkpoint file. The population can be passed to nsga2() as init_pop
+        to continue the optimization, the memoized individuals are not evaluated again.
+
+        :param filename: checkpoint file, see save_checkpoint()
+        :return: dict with "iteration", "n_gen", "population", "fitness", "memo" and "random_state"
+        """
+        with open(filename, 'rb') as fh:
+            data = pickle.load(fh)
+        self.memo.update(data["memo"])
+        return data
+
     def get_good_inds(self, pop):
 
         if MPI_RANK != 0: return None
@@ -497,7 +633,11 @@ class Moga():
         if self.log_print: print("Number of used CPU: %i" % MPI_SIZE)
 
         # optimization
-        result = self.optimize(init_pop)
+        self.evaluator.open()
+        try:
+            result = self.optimize(init_pop)
+        finally:
+            self.evaluator.close()
 
         if self.log_print: print("End of (successful) evolution")
 
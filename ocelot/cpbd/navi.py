@@ -1,10 +1,86 @@
 from ocelot.cpbd.physics_proc import RectAperture, EllipticalAperture
 from ocelot.common.ocelog import *
 from ocelot.cpbd.elements.aperture import Aperture
+from ocelot.cpbd.transformations.transformation import TMTypes
+from ocelot.cpbd.transformations.transfer_map import TransferMap
+from ocelot.cpbd.transformations.second_order import SecondTM
+from ocelot.cpbd.tm_params.first_order_params import FirstOrderParams
+from ocelot.cpbd.tm_params.second_order_params import SecondOrderParams
+from ocelot.cpbd.tm_utils import transfer_maps_mult_full
 import numpy as np
 from copy import deepcopy
+from collections import OrderedDict
 _logger_navi = logging.getLogger(__name__ + ".navi")
 
+# default maximal number of element sections in the cache of Navigator.get_map()
+SECTION_MAPS_CACHE_SIZE = 4096
+
+
+class MergedTMParams:
+    """
+    Callable which calculates the parameters of the product of consecutive TransferMap/SecondTM transformations.
+    It is used as create_tm_param_func and delta_e_func of the merged transformation (see merge_transfer_maps).
+    A class instead of a closure keeps the merged maps picklable (e.g. for ParameterScanner).
+    """
+
+    def __init__(self, tms):
+        self.tms = tms
+        self.second_order = any(type(tm) == SecondTM for tm in tms)
+
+    def __call__(self, energy, delta_length=None):
+        E = energy
+        B = np.zeros((6, 1))
+        R = np.eye(6)
+        T = np.zeros((6, 6, 6))
+        for tm in self.tms:
+            params = tm.get_params(E)
+            Rb = params.get_rotated_R() if params.tilt != 0 else params.R
+            if self.second_order:
+                if type(tm) == SecondTM:
+                    Tb = params.get_rotated_T() if params.tilt != 0 else params.T
+                else:
+                    Tb = np.zeros((6, 6, 6))
+                B, R, T = transfer_maps_mult_full(B, R, T, params.B, Rb, Tb)
+            else:
+                B = np.dot(Rb, B) + params.B
+                R = np.dot(Rb, R)
+            E += tm.get_delta_e()
+        if self.second_order:
+            return SecondOrderParams(R, B, T, tilt=0., dx=0., dy=0.)
+        return FirstOrderParams(R, B, tilt=0.)
+
+    def delta_e(self, delta_length=None, total_length=None):
+        return np.sum([tm.get_delta_e() for tm in self.tms])
+
+
+def merge_transfer_maps(tms):
+    """
+    Merges runs of consecutive TransferMap and SecondTM transformations into one transformation.
+    Other transformations (e.g. KickTM, CavityTM, RungeKuttaTM) are kept as they are and break the runs.
+    Merging of first order maps is exact, merging of second order maps is truncated to the second order.
+
+    :param tms: list of Transformations
+    :return: list of Transformations
+    """
+    merged = []
+    group = []
+    for tm in tms + [None]:
+        if tm is not None and type(tm) in (TransferMap, SecondTM):
+            group.append(tm)
+            continue
+        if len(group) == 1:
+            merged.append(group[0])
+        elif len(group) > 1:
+            params_func = MergedTMParams(group)
+            length = np.sum([tm_g.delta_length if tm_g.delta_length is not None else tm_g.length for tm_g in group])
+            tm_class = SecondTM if params_func.second_order else TransferMap
+            merged.append(tm_class(create_tm_param_func=params_func, delta_e_func=params_func.delta_e,
+                                   tm_type=TMTypes.MAIN, length=length, delta_length=length))
+        group = []
+        if tm is not None:
+            merged.append(tm)
+    return merged
+
 
 class ProcessTable:
     def __init__(self, lattice):
@@ -55,6 +131,11 @@ class Navigator:
     Attributes:
         lattice (MagneticLattice): The magnetic lattice to which the navigator is applied.
         unit_step (float): Unit step size for all physics processes, default is 1 meter.
+        merge_maps (bool): If True, consecutive TransferMap/SecondTM transformations of every step are
+            pre-multiplied into one map, which is cached and reused, e.g. for the next bunch. Default is False.
+            Note: merging of SecondTM maps is truncated to the second order.
+        section_maps_size (int): maximal number of element sections whose transformations are cached by get_map(),
+            the least recently used sections are dropped first. Default is SECTION_MAPS_CACHE_SIZE.
 
     Methods:
         add_physics_proc(physics_proc, elem1, elem2):
@@ -69,7 +150,7 @@ class Navigator:
                 The physical process starts at the beginning of elem1 and ends at the beginning of elem2.
     """
 
-    def __init__(self, lattice, unit_step=1):
+    def __init__(self, lattice, unit_step=1, merge_maps=False):
 
         self.lat = lattice
         if len(self.lat.sequence) < 2:
@@ -84,6 +165,10 @@ class Navigator:
         self.proc_kick_elems = []
         self.kill_process = False  # for case when calculations are needed to terminated e.g. from gui
         self.inactive_processes = [] # processes are sometimes deactivated during tracking
+        self.merge_maps = merge_maps
+        self._merged_maps = {}  # cache of merged maps {sections: (element tms, merged tms)}
+        self.section_maps_size = SECTION_MAPS_CACHE_SIZE
+        self._section_maps = OrderedDict()  # LRU cache {(index, start_l, delta_l, energy): (element, element tms, tms)}
 
     def get_current_element(self):
         if self.n_elem < len(self.lat.sequence):
@@ -283,7 +368,14 @@ class Navigator:
         # Navigator class
         self._update_references()
 
-    def get_next_step(self):
+    def get_next_step(self, p_array=None):
+        """
+        generator of the tracking steps
+
+        :param p_array: None or ParticleArray, if given, the transformations of the element sections are cached
+                        for its current energy (see get_map)
+        :return: t_maps, dz, proc_list, phys_steps
+        """
         while np.abs(self.z0 - self.lat.totalLen) > 1e-10:
             if self.kill_process:
                 _logger_navi.info("Killing tracking ... ")
@@ -292,7 +384,11 @@ class Navigator:
             if self.z0 + dz > self.lat.totalLen:
                 dz = self.lat.totalLen - self.z0
 
-            yield self.get_map(dz), dz, proc_list, phys_steps
+            if self.merge_maps:
+                t_maps = self.get_merged_map(dz)
+            else:
+                t_maps = self.get_map(dz, energy=None if p_array is None else p_array.E)
+            yield t_maps, dz, proc_list, phys_steps
 
     def get_next(self):
 
@@ -346,9 +442,15 @@ class Navigator:
             s += physproc.__class__.__name__ + " start: " + str(physproc.s_start) + "/ stop: " + str(physproc.s_stop) + "\n"
         return s
 
-    def get_map(self, dz):
+    def get_sections(self, dz):
+        """
+        method moves the Navigator by dz and returns the traversed element sections
+
+        :param dz: step in [m]
+        :return: list of tuples (element index, start_l, delta_l)
+        """
         nelems = len(self.lat.sequence)
-        TM = []
+        sections = []
         i = self.n_elem
         z1 = self.z0 + dz
         elem = self.lat.sequence[i]
@@ -357,7 +459,7 @@ class Navigator:
         while z1 + 1e-10 > L:
 
             dl = L - self.z0
-            TM += elem.get_section_tms(start_l=self.z0 + elem.l - L, delta_l=dl)
+            sections.append((i, self.z0 + elem.l - L, dl))
 
             self.z0 = L
             dz -= dl
@@ -369,13 +471,60 @@ class Navigator:
             L += elem.l
 
         if abs(dz) > 1e-10:
-            TM += elem.get_section_tms(start_l=self.z0 + elem.l - L, delta_l=dz)
+            sections.append((i, self.z0 + elem.l - L, dz))
 
         self.z0 += dz
         self.sum_lengths = L - elem.l
         self.n_elem = i
+        return sections
+
+    def get_map(self, dz, energy=None):
+        """
+        method moves the Navigator by dz and returns the transformations of the traversed element sections.
+        The transformations of every section are cached (keyed by element, start_l, delta_l and energy), so the
+        repeated steps, e.g. tracking of the next bunch, reuse them together with their calculated parameters.
+        A section is rebuilt if the transformations of the element were changed (e.g. by setting quad.k1).
+
+        :param dz: step in [m]
+        :param energy: None or beam energy in [GeV], the sections tracked at different energies are cached separately
+        :return: list of Transformations
+        """
+        TM = []
+        for i, start_l, delta_l in self.get_sections(dz):
+            elem = self.lat.sequence[i]
+            key = (i, np.round(start_l, 10), np.round(delta_l, 10), energy)
+            cached = self._section_maps.get(key)
+            if cached is None or cached[0] is not elem or cached[1] is not elem.tms:
+                tms = elem.get_section_tms(start_l=start_l, delta_l=delta_l)
+                self._section_maps[key] = (elem, elem.tms, tms)
+                while len(self._section_maps) > self.section_maps_size:
+                    self._section_maps.popitem(last=False)
+            else:
+                tms = cached[2]
+                self._section_maps.move_to_end(key)
+            TM += tms
         return TM
 
+    def get_merged_map(self, dz):
+        """
+        the same as get_map() but consecutive TransferMap/SecondTM transformations are merged (see merge_transfer_maps).
+        The merged maps are cached for the step and rebuilt if transformations of an element were changed.
+
+        :param dz: step in [m]
+        :return: list of Transformations
+        """
+        sections = self.get_sections(dz)
+        key = tuple((i, np.round(start_l, 10), np.round(delta_l, 10)) for i, start_l, delta_l in sections)
+        elems = [self.lat.sequence[i] for i, _, _ in sections]
+        elem_tms, merged_tms = self._merged_maps.get(key, (None, None))
+        if elem_tms is None or any(tms is not elem.tms for tms, elem in zip(elem_tms, elems)):
+            TM = []
+            for elem, (i, start_l, delta_l) in zip(elems, sections):
+                TM += elem.get_section_tms(start_l=start_l, delta_l=delta_l)
+            merged_tms = merge_transfer_maps(TM)
+            self._merged_maps[key] = ([elem.tms for elem in elems], merged_tms)
+        return merged_tms
+
     def _update_references(self):
         # At initialisation the ProcessTable and Navi instances both
         # share the same lat instance.  However, ProcessTable is reset
@@ -1,7 +1,9 @@
 __author__ = 'Sergey'
 
+import copy
 
 from numpy.linalg import inv
+import pandas as pd
 
 from ocelot.cpbd.transformations.transfer_map import TransferMap
 from ocelot.cpbd.beam import Twiss, twiss_iterable_to_df
@@ -117,6 +119,249 @@ def trace_z(lattice, obj0, z_array):
     return obj_list
 
 
+def prefix_products(M):
+    """
+    Cumulative products P[i] = M[i] @ M[i-1] @ ... @ M[0] of the stack of matrices M (n, k, k)
+    by log2(n) batched multiplications.
+
+    :param M: array (n, k, k)
+    :return: array (n, k, k)
+    """
+    P = np.array(M, dtype=float)
+    n = len(P)
+    k = 1
+    while k < n:
+        P[k:] = np.matmul(P[k:], P[:-k])
+        k *= 2
+    return P
+
+
+def propagate_twiss(M, beta0, alpha0, D0, Dp0, mu0, det_tol=1e-10):
+    """
+    Twiss parameters of one plane after every map of the stack M.
+    As in Twiss.track() gamma = (1 + alpha^2)/beta is recalculated from beta and alpha before every map.
+    For maps with unit determinant it is the same as the propagation with the cumulative matrix products,
+    maps with |det - 1| > det_tol (e.g. tilted elements or cavities) are applied one by one.
+
+    :param M: array (n, 3, 3), [[R00, R01, R05], [R10, R11, R15], [0, 0, 1]] for every map
+    :param beta0: initial beta
+    :param alpha0: initial alpha
+    :param D0: initial dispersion
+    :param Dp0: initial derivative of dispersion
+    :param mu0: initial phase advance
+    :param det_tol: tolerance of the unit determinant
+    :return: beta, alpha, D, Dp, mu - arrays (n,) after every map
+    """
+    n = len(M)
+    P = prefix_products(M)
+    D = P[:, 0, 0] * D0 + P[:, 0, 1] * Dp0 + P[:, 0, 2]
+    Dp = P[:, 1, 0] * D0 + P[:, 1, 1] * Dp0 + P[:, 1, 2]
+
+    beta = np.empty(n)
+    alpha = np.empty(n)
+    det = M[:, 0, 0] * M[:, 1, 1] - M[:, 0, 1] * M[:, 1, 0]
+    breaks = np.flatnonzero(np.abs(det - 1.) > det_tol)
+    b, a = beta0, alpha0
+    start = 0
+    for stop in list(breaks) + [n]:
+        g = (1 + a ** 2) / b if b != 0 else 0
+        if stop > start:
+            Q = P if len(breaks) == 0 else prefix_products(M[start:stop])
+            Q00, Q01, Q10, Q11 = Q[:, 0, 0], Q[:, 0, 1], Q[:, 1, 0], Q[:, 1, 1]
+            beta[start:stop] = Q00 ** 2 * b - 2 * Q00 * Q01 * a + Q01 ** 2 * g
+            alpha[start:stop] = -Q00 * Q10 * b + (Q01 * Q10 + Q11 * Q00) * a - Q01 * Q11 * g
+            b, a = beta[stop - 1], alpha[stop - 1]
+            g = (1 + a ** 2) / b if b != 0 else 0
+        if stop < n:
+            R00, R01, R10, R11 = M[stop, 0, 0], M[stop, 0, 1], M[stop, 1, 0], M[stop, 1, 1]
+            beta[stop] = R00 ** 2 * b - 2 * R00 * R01 * a + R01 ** 2 * g
+            alpha[stop] = -R00 * R10 * b + (R01 * R10 + R11 * R00) * a - R01 * R11 * g
+            b, a = beta[stop], alpha[stop]
+        start = stop + 1
+
+    # phase advance of every map with the Twiss before the map
+    d_mu = np.arctan2(M[:, 0, 1], M[:, 0, 0] * np.append(beta0, beta)[:-1] - M[:, 0, 1] * np.append(alpha0, alpha)[:-1])
+    d_mu[d_mu < 0] += np.pi
+    mu = np.cumsum(np.append(mu0, d_mu))[1:]
+    return beta, alpha, D, Dp, mu
+
+
+class OpticsTable:
+    """
+    Twiss parameters along the lattice stored as arrays (struct of arrays), see twiss_table().
+    The row 0 is the initial Twiss, the row i is the Twiss after the i-th first order transfer map.
+
+    Columns are numpy arrays: s, E, beta_x, alpha_x, beta_y, alpha_y, Dx, Dxp, Dy, Dyp, mux, muy
+    and properties gamma_x, gamma_y, emit_x, emit_y. table.id is the list of element ids.
+
+    For compatibility the table behaves as a read-only list of Twiss: table[i] returns Twiss which is created
+    on demand, iteration, len() and slicing work as for the list returned by twiss().
+    """
+    columns = ("s", "E", "beta_x", "alpha_x", "beta_y", "alpha_y", "Dx", "Dxp", "Dy", "Dyp", "mux", "muy")
+
+    def __init__(self, tws0, data, ids):
+        self.tws0 = tws0
+        for name in self.columns:
+            setattr(self, name, data[name])
+        self.id = ids
+        self._template = None
+
+    def __len__(self):
+        return len(self.s)
+
+    @property
+    def gamma_x(self):
+        return np.divide(1 + self.alpha_x ** 2, self.beta_x, out=np.zeros_like(self.beta_x), where=self.beta_x != 0)
+
+    @property
+    def gamma_y(self):
+        return np.divide(1 + self.alpha_y ** 2, self.beta_y, out=np.zeros_like(self.beta_y), where=self.beta_y != 0)
+
+    def _emittance(self, emit_n):
+        relgamma = self.E / m_e_GeV
+        with np.errstate(invalid="ignore", divide="ignore"):
+            rb = np.where(relgamma > 0, np.sqrt(1 - relgamma ** -2.) * relgamma, 0.)
+            return np.where(rb != 0, emit_n / rb, 0.)
+
+    @property
+    def emit_x(self):
+        return self._emittance(self.tws0.emit_xn)
+
+    @property
+    def emit_y(self):
+        return self._emittance(self.tws0.emit_yn)
+
+    def _twiss(self, i):
+        if i == 0:
+            return self.tws0
+        if self._template is None:
+            self._template = Twiss(self.tws0)
+            self._template.p = self.tws0.p
+        tws = copy.copy(self._template)
+        tws.__dict__.update(_beta_x=self.beta_x[i], _alpha_x=self.alpha_x[i], _beta_y=self.beta_y[i],
+                            _alpha_y=self.alpha_y[i], Dx=self.Dx[i], Dxp=self.Dxp[i], Dy=self.Dy[i], Dyp=self.Dyp[i],
+                            mux=self.mux[i], muy=self.muy[i], _E=self.E[i], s=self.s[i], id=self.id[i])
+        return tws
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return [self._twiss(i) for i in range(*item.indices(len(self)))]
+        i = int(item)
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("OpticsTable index out of range")
+        return self._twiss(i)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self._twiss(i)
+
+    def to_list(self):
+        """
+        :return: list of Twiss as returned by twiss()
+        """
+        return [self._twiss(i) for i in range(len(self))]
+
+    def to_df(self):
+        """
+        :return: DataFrame with the same columns as twiss(..., return_df=True)
+        """
+        first = self.tws0.to_series()
+        row = self._twiss(min(1, len(self) - 1)).to_series()
+        arrays = {name: getattr(self, name) for name in self.columns}
+        arrays.update(emit_x=self.emit_x, emit_y=self.emit_y)
+        data = {}
+        for key in row.index:
+            if key in arrays:
+                col = np.array(arrays[key], dtype=float)
+            elif key == "id":
+                col = np.array(self.id, dtype=object)
+            else:
+                col = np.full(len(self), row[key], dtype=np.asarray(row[key]).dtype)
+            if key in first.index:
+                col[0] = first[key]
+            data[key] = col
+        return pd.DataFrame(data)
+
+
+def twiss_blocks(R, k):
+    """
+    Horizontal and vertical blocks of the first order maps which are used for the Twiss propagation:
+    [[R00, R01, R05], [R10, R11, R15], [0, 0, 1]] and [[R22, R23, R25], [R32, R33, R35], [0, 0, 1]]
+
+    :param R: array (n, 6, 6), rotated R matrices
+    :param k: array (n,), sqrt(E_final/E_initial) of every map, adiabatic damping as in Twiss.map_x_twiss()
+    :return: Mx, My - arrays (n, 3, 3)
+    """
+    n = len(R)
+    Mx = np.zeros((n, 3, 3))
+    Mx[:, :2, :2] = R[:, 0:2, 0:2] * k[:, None, None]
+    Mx[:, :2, 2] = R[:, 0:2, 5]
+    Mx[:, 2, 2] = 1.
+    My = np.zeros((n, 3, 3))
+    My[:, :2, :2] = R[:, 2:4, 2:4] * k[:, None, None]
+    My[:, :2, 2] = R[:, 2:4, 5]
+    My[:, 2, 2] = 1.
+    return Mx, My
+
+
+def twiss_table(lattice, tws0, attach2elem=False):
+    """
+    Vectorized twiss parameters calculation. The first order transfer maps of all elements are collected
+    in a stack of matrices and propagated with cumulative matrix products. The result is the same as of
+    trace_obj(lattice, tws0) but the parameters are stored in arrays.
+
+    :param lattice: MagneticLattice
+    :param tws0: initial Twiss
+    :param attach2elem: if True, Twiss at the end of the element is attached to 'elem.tws'
+    :return: OpticsTable
+    """
+    zero_tol = 1.e-10
+    E = tws0.E
+    rows = []
+    k_energy = []
+    energies = [E]
+    lengths = []
+    ids = [tws0.id]
+    elem_ends = []
+    r_cache = {}
+    for e in lattice.sequence:
+        for tm in e.first_order_tms:
+            key = (id(tm), E)
+            R = r_cache.get(key)
+            if R is None:
+                R = tm.get_params(energy=E).get_rotated_R()
+                r_cache[key] = R
+            rows.append(R)
+            delta_e = tm.get_delta_e()
+            if abs(delta_e) > zero_tol:
+                k_energy.append(np.sqrt((E + delta_e) / E))
+                E = E + delta_e
+            else:
+                k_energy.append(1.)
+            energies.append(E)
+            lengths.append(tm.delta_length if tm.delta_length is not None else tm.length)
+            ids.append(e.id)
+        elem_ends.append(len(rows))
+
+    Mx, My = twiss_blocks(np.array(rows, dtype=float).reshape(len(rows), 6, 6), np.array(k_energy))
+
+    data = {"s": np.cumsum(np.append(tws0.s, lengths)), "E": np.array(energies)}
+    for M, twiss0, names in [(Mx, (tws0.beta_x, tws0.alpha_x, tws0.Dx, tws0.Dxp, tws0.mux),
+                              ("beta_x", "alpha_x", "Dx", "Dxp", "mux")),
+                             (My, (tws0.beta_y, tws0.alpha_y, tws0.Dy, tws0.Dyp, tws0.muy),
+                              ("beta_y", "alpha_y", "Dy", "Dyp", "muy"))]:
+        for name, v0, v in zip(names, twiss0, propagate_twiss(M, *twiss0)):
+            data[name] = np.append(v0, v)
+
+    table = OpticsTable(tws0, data, ids)
+    if attach2elem:
+        for e, i in zip(lattice.sequence, elem_ends):
+            e.tws = table[i]
+    return table
+
+
 def trace_obj(lattice, obj, nPoints=None, attach2elem=False):
     """
     track object through the lattice
@@ -124,6 +369,8 @@ def trace_obj(lattice, obj, nPoints=None, attach2elem=False):
     """
 
     if nPoints is None:
+        if isinstance(obj, Twiss):
+            return twiss_table(lattice, obj, attach2elem=attach2elem).to_list()
         obj_list = [obj]
         for e in lattice.sequence:
             for tm in e.first_order_tms:
@@ -190,7 +437,7 @@ def periodic_twiss(tws, R):
     return tws
 
 
-def twiss(lattice, tws0=None, nPoints=None, return_df=False, attach2elem=False):
+def twiss(lattice, tws0=None, nPoints=None, return_df=False, attach2elem=False, return_table=False):
     """
     twiss parameters calculation
 
@@ -200,6 +447,7 @@ def twiss(lattice, tws0=None, nPoints=None, return_df=False, attach2elem=False):
     :param lattice: lattice, MagneticLattice() object
     :param tws0: initial twiss parameters, Twiss() object. If None, function tries to find periodic solution.
     :param nPoints: number of points per cell. If None, then twiss parameters are calculated at the end of each element.
+    :param return_table: if True and nPoints=None, OpticsTable is returned instead of the list of Twiss (see twiss_table())
     :return: list of Twiss() objects
     """
     if tws0 is None:
@@ -212,6 +460,14 @@ def twiss(lattice, tws0=None, nPoints=None, return_df=False, attach2elem=False):
                 _logger.info(' twiss: Twiss: no periodic solution')
                 return None
 
+        if nPoints is None:
+            table = twiss_table(lattice, tws0, attach2elem=attach2elem)
+            if return_table:
+                return table
+            if return_df:
+                return table.to_df()
+            return table.to_list()
+
         twiss_list = trace_obj(lattice, tws0, nPoints, attach2elem)
 
         if return_df:
@@ -0,0 +1,196 @@
+"""
+Domain decomposed tracking of a single bunch with MPI.
+
+Every rank holds a slice of the particles (a usual ParticleArray) and applies the transfer maps locally.
+Collective physics processes (SpaceCharge, CSR, Wake, LSC) reduce the global quantities they need
+(mesh bounds, charge grid, current profile, moments) through ParticleComm and kick the local particles.
+
+Usage (mpirun -n 4 python script.py):
+
+    comm = ParticleComm(MPI.COMM_WORLD)
+    parray_local = scatter_parray(parray if comm.rank == 0 else None, comm)
+    tws, parray_local = track_mpi(lat, parray_local, navi, comm)
+    parray = gather_parray(parray_local, comm)  # full ParticleArray on rank 0
+"""
+import logging
+from functools import partial
+
+import numpy as np
+
+from ocelot.cpbd.beam import ParticleArray, get_envelope
+
+_logger = logging.getLogger(__name__)
+
+try:
+    from mpi4py import MPI
+    mpi_flag = True
+except ImportError:
+    _logger.debug("parallel.py: module mpi4py is not installed. Only serial ParticleComm is available")
+    mpi_flag = False
+
+
+class ParticleComm:
+    """
+    Reductions over the particles distributed between MPI ranks.
+    With comm=None all reductions are local, i.e. the whole bunch is on one process.
+
+    :param comm: None or mpi4py communicator, e.g. MPI.COMM_WORLD
+    """
+    def __init__(self, comm=None):
+        if comm is not None and not mpi_flag:
+            raise ImportError("ParticleComm: mpi4py is required for the MPI communicator")
+        self.comm = comm
+        self.rank = 0 if comm is None else comm.Get_rank()
+        self.size = 1 if comm is None else comm.Get_size()
+
+    def __deepcopy__(self, memo):
+        # Navigator deep copies the physics processes, the communicator must stay the same
+        return self
+
+    def allreduce(self, a, op="sum"):
+        """
+        Element-wise reduction of the array over all ranks
+
+        :param a: array or scalar
+        :param op: "sum", "min" or "max"
+        :return: array
+        """
+        a = np.array(a, dtype=float)
+        if self.comm is None:
+            return a
+        out = np.empty_like(a)
+        self.comm.Allreduce(a, out, op={"sum": MPI.SUM, "min": MPI.MIN, "max": MPI.MAX}[op])
+        return out
+
+    def sum(self, a, axis=None):
+        return self.allreduce(np.sum(a, axis=axis))
+
+    def min(self, a, axis=None):
+        return self.allreduce(np.min(a, axis=axis, initial=np.inf), op="min")
+
+    def max(self, a, axis=None):
+        return self.allreduce(np.max(a, axis=axis, initial=-np.inf), op="max")
+
+    def count(self, a, axis=-1):
+        return self.allreduce(np.shape(a)[axis])
+
+    def mean(self, a, axis=-1):
+        return self.sum(a, axis=axis) / self.count(a, axis=axis)
+
+    def std(self, a):
+        return np.sqrt(self.sum((a - self.mean(a)) ** 2) / self.count(a))
+
+    def bcast(self, obj, root=0):
+        if self.comm is None:
+            return obj
+        return self.comm.bcast(obj, root=root)
+
+    def allgather(self, a):
+        """
+        Concatenation of the 1D arrays of all ranks
+
+        :param a: 1D array
+        :return: 1D array
+        """
+        if self.comm is None:
+            return a
+        return np.concatenate(self.comm.allgather(a))
+
+
+def scatter_parray(parray, comm):
+    """
+    Splits the ParticleArray of the rank 0 between all ranks
+
+    :param parray: ParticleArray on rank 0, ignored on other ranks
+    :param comm: ParticleComm
+    :return: local ParticleArray
+    """
+    if comm.comm is None:
+        return parray
+    parts = None
+    if comm.rank == 0:
+        parts = []
+        for inds in np.array_split(np.arange(parray.n), comm.size):
+            p = ParticleArray(n=len(inds))
+            p.rparticles[:] = parray.rparticles[:, inds]
+            p.q_array[:] = parray.q_array[inds]
+            p.E = parray.E
+            p.s = parray.s
+            parts.append(p)
+    return comm.comm.scatter(parts, root=0)
+
+
+def gather_parray(parray, comm, root=0):
+    """
+    Collects the local ParticleArrays on the root rank
+
+    :param parray: local ParticleArray
+    :param comm: ParticleComm
+    :param root: rank which gets the ParticleArray
+    :return: ParticleArray on the root rank, None on other ranks
+    """
+    if comm.comm is None:
+        return parray
+    parts = comm.comm.gather(parray, root=root)
+    if comm.rank != root:
+        return None
+    p_array = ParticleArray(n=sum(p.n for p in parts))
+    p_array.rparticles[:] = np.concatenate([p.rparticles for p in parts], axis=1)
+    p_array.q_array[:] = np.concatenate([p.q_array for p in parts])
+    p_array.E = parray.E
+    p_array.s = parray.s
+    return p_array
+
+
+def get_envelope_mpi(p_array, comm, tws_i=None, bounds=None, slice=None, auto_disp=False):
+    """
+    get_envelope() of the ParticleArray distributed between the ranks of comm.
+    The moments are reduced over all ranks, all ranks get the same Twiss.
+
+    :param p_array: local ParticleArray
+    :param comm: ParticleComm
+    :param tws_i: see get_envelope
+    :param bounds: see get_envelope
+    :param slice: see get_envelope
+    :param auto_disp: see get_envelope
+    :return: Twiss
+    """
+    return get_envelope(p_array, tws_i=tws_i, bounds=bounds, slice=slice, auto_disp=auto_disp, comm=comm)
+
+
+def set_comm(navi, comm):
+    """
+    Sets the communicator to all physics processes of the Navigator
+
+    :param navi: Navigator
+    :param comm: ParticleComm or None
+    """
+    for table in [navi.process_table, navi.ref_process_table]:
+        for p in table.proc_list + table.kick_proc_list:
+            p.comm = comm
+    for p in navi.inactive_processes:
+        p.comm = comm
+
+
+def track_mpi(lattice, p_array, navi, comm, **kwargs):
+    """
+    Tracking of the ParticleArray distributed between MPI ranks. Every rank calls track_mpi with its local particles,
+    the transfer maps are applied locally, the collective physics processes and the Twiss calculation
+    use the global reductions.
+
+    :param lattice: MagneticLattice
+    :param p_array: local ParticleArray, see scatter_parray()
+    :param navi: Navigator
+    :param comm: ParticleComm or mpi4py communicator
+    :param kwargs: arguments of track()
+    :return: twiss_list, local ParticleArray
+    """
+    from ocelot.cpbd.track import track
+    if not isinstance(comm, ParticleComm):
+        comm = ParticleComm(comm)
+    set_comm(navi, comm)
+    if kwargs.get("get_twiss") is None:
+        kwargs["get_twiss"] = partial(get_envelope_mpi, comm=comm)
+    if comm.rank != 0:
+        kwargs["print_progress"] = False
+    return track(lattice, p_array, navi, comm=comm, **kwargs)
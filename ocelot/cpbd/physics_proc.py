@@ -1,6 +1,7 @@
 from ocelot.cpbd.io import save_particle_array
 from ocelot.common.globals import h_eV_s, m_e_eV, m_e_GeV, ro_e, speed_of_light, q_e
 from ocelot.cpbd.beam import Twiss, beam_matching, global_slice_analysis, s_to_cur, get_envelope
+from ocelot.cpbd.beam import global_slice_analysis_hist
 from ocelot.utils.acc_utils import slice_bunching
 from ocelot.common.ocelog import *
 from ocelot.cpbd.beam import ParticleArray
@@ -11,6 +12,41 @@ from scipy import optimize
 _logger = logging.getLogger(__name__)
 
 
+class BeamProjections:
+    """
+    Longitudinal projections of the beam (current profiles, sorting indices, wake potentials) shared by
+    the physics processes within one tracking step. A projection is computed by the first process which requests it
+    and is reused by the other processes until the particle coordinates change.
+    track.track() creates one BeamProjections per tracking, invalidates it after the transfer maps
+    and after every process with changes_coordinates = True and assigns it to PhysProc.projections before p.apply().
+    The cached arrays are read-only.
+    """
+    def __init__(self):
+        self.cache = {}
+        self.n_hits = 0
+        self.n_calls = 0
+
+    def invalidate(self):
+        self.cache = {}
+
+    def get(self, key, func):
+        """
+        :param key: hashable key of the projection, it must include all parameters of func
+        :param func: function without arguments which calculates the projection
+        :return: cached func()
+        """
+        self.n_calls += 1
+        if key in self.cache:
+            self.n_hits += 1
+            return self.cache[key]
+        value = func()
+        for a in (value if isinstance(value, tuple) else (value,)):
+            if isinstance(a, np.ndarray):
+                a.setflags(write=False)
+        self.cache[key] = value
+        return value
+
+
 class PhysProc:
     """
     Parent class for all Physics processes
@@ -25,7 +61,14 @@ class PhysProc:
     :attribute start_elem: -  start element in lattice - assigned in navigator.add_physics_proc()
     :attribute end_elem: -  stop element in lattice.sequence - assigned in navigator.add_physics_proc()
     :attribute z0: - current position of navigator - assigned in track.track() before p.apply()
+    :attribute comm: - None or ParticleComm, if the ParticleArray is distributed between MPI ranks (see parallel.py)
+    :attribute projections: - None or BeamProjections shared by the processes of the step - assigned in track.track()
+    :attribute changes_coordinates: - False if the process kicks only the momenta (px, py, p) of the particles,
+                                      then the projections of the step stay valid after the process
     """
+    comm = None
+    projections = None
+    changes_coordinates = True
 
     def __init__(self, step=1):
         self.step = step
@@ -69,6 +112,18 @@ class PhysProc:
         """
         pass
 
+    def projection(self, key, func):
+        """
+        Returns func() from the shared BeamProjections of the step, without it func() is calculated
+
+        :param key: hashable key of the projection, see BeamProjections.get()
+        :param func: function without arguments
+        :return: func()
+        """
+        if self.projections is None:
+            return func()
+        return self.projections.get(key, func)
+
 
 class EmptyProc(PhysProc):
     def __init__(self, step=1):
@@ -620,6 +675,55 @@ class BeamAnalysis(PhysProc):
         np.savetxt(self.filename, data)
 
 
+class SliceMonitor(PhysProc):
+    """
+    Records slice parameters of the beam on every step. The slice moments are calculated without sorting of
+    the particles (see global_slice_analysis_hist()), so the monitor can be applied often along the lattice.
+
+    :param step: in Navigator.unit_step
+    :param nslices: number of slices
+    :param nparts_in_slice: None or number of particles in the moving window, if None the slice moments are used
+    :param smooth_param: smoothing parameter of the current profile
+    :param filter_base: filter parameter in the func: simple_filter
+    :param filter_iter: filter parameter in the func: simple_filter
+    :param keep_slices: if True, SliceParameters of every step are kept in self.slices
+
+    After tracking, self.s, self.I, self.exn, self.eyn, self.se and self.me contain the
+    position and the parameters of the slice with the maximum current on every step.
+    """
+    def __init__(self, step=1, nslices=200, nparts_in_slice=None, smooth_param=0.01, filter_base=2, filter_iter=2,
+                 keep_slices=False):
+        PhysProc.__init__(self, step=step)
+        self.nslices = nslices
+        self.nparts_in_slice = nparts_in_slice
+        self.smooth_param = smooth_param
+        self.filter_base = filter_base
+        self.filter_iter = filter_iter
+        self.keep_slices = keep_slices
+        self.slices = []
+        self.s = []
+        self.I = []
+        self.exn = []
+        self.eyn = []
+        self.se = []
+        self.me = []
+
+    def apply(self, p_array, dz):
+        _logger.debug(" SliceMonitor applied, dz =" + str(dz))
+        slc = global_slice_analysis_hist(p_array, nslices=self.nslices, nparts_in_slice=self.nparts_in_slice,
+                                         smooth_param=self.smooth_param, filter_base=self.filter_base,
+                                         filter_iter=self.filter_iter)
+        ind = np.argmax(slc.I)
+        self.s.append(np.copy(p_array.s))
+        self.I.append(slc.I[ind])
+        self.exn.append(slc.exn[ind])
+        self.eyn.append(slc.eyn[ind])
+        self.se.append(slc.se[ind])
+        self.me.append(slc.me[ind])
+        if self.keep_slices:
+            self.slices.append(slc)
+
+
 class Chicane(PhysProc):
     """
     simple physics process to simulate longitudinal dynamics in chicane
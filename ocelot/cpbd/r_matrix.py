@@ -70,3 +70,98 @@ def uni_matrix(z, k1, hx, sum_tilts=0., energy=0.):
     if sum_tilts != 0:
         u_matrix = np.dot(np.dot(rot_mtx(-sum_tilts), u_matrix), rot_mtx(sum_tilts))
     return u_matrix
+
+
+def _uni_functions(K, z):
+    """
+    C = cos(sqrt(K) z), S = sin(sqrt(K) z)/sqrt(K), F = (1 - C)/K, G = (z - S)/K and their derivatives over K.
+    For small |K z^2| the power series are used, they have no cancellation at K -> 0.
+
+    :param K: focusing strength [1/m**2]
+    :param z: length [m]
+    :return: (C, S, F, G), (dC/dK, dS/dK, dF/dK, dG/dK)
+    """
+    if abs(K) * z * z < 0.1:
+        # f = sum_n (-K)^n z^(2n + p) / (2n + p)!, p = 0, 1, 2, 3 for C, S, F * (-1) shifted, ...
+        C, S, F, G = 0., 0., 0., 0.
+        dC, dS, dF, dG = 0., 0., 0., 0.
+        fact = [1.]
+        for i in range(1, 24):
+            fact.append(fact[-1] * i)
+        for n in range(10):
+            sgn = (-1.) ** n
+            C += sgn * K ** n * z ** (2 * n) / fact[2 * n]
+            S += sgn * K ** n * z ** (2 * n + 1) / fact[2 * n + 1]
+            F += sgn * K ** n * z ** (2 * n + 2) / fact[2 * n + 2]
+            G += sgn * K ** n * z ** (2 * n + 3) / fact[2 * n + 3]
+            if n > 0:
+                dC += sgn * n * K ** (n - 1) * z ** (2 * n) / fact[2 * n]
+                dS += sgn * n * K ** (n - 1) * z ** (2 * n + 1) / fact[2 * n + 1]
+                dF += sgn * n * K ** (n - 1) * z ** (2 * n + 2) / fact[2 * n + 2]
+                dG += sgn * n * K ** (n - 1) * z ** (2 * n + 3) / fact[2 * n + 3]
+        return (C, S, F, G), (dC, dS, dF, dG)
+    k = np.sqrt(K + 0.j)
+    C = np.cos(z * k).real
+    S = (np.sin(z * k) / k).real
+    F = (1. - C) / K
+    G = (z - S) / K
+    dC = -z * S / 2.
+    dS = (z * C - S) / (2. * K)
+    dF = (-dC * K - (1. - C)) / K ** 2
+    dG = (-dS * K - (z - S)) / K ** 2
+    return (C, S, F, G), (dC, dS, dF, dG)
+
+
+def uni_matrix_derivative(z, k1, hx, dz=0., dk1=0., dhx=0., sum_tilts=0., energy=0.):
+    """
+    Directional derivative of the universal matrix uni_matrix(z, k1, hx, sum_tilts, energy):
+    dR = dR/dz * dz + dR/dk1 * dk1 + dR/dhx * dhx
+
+    :param z: element length [m]
+    :param k1: quadrupole strength [1/m**2]
+    :param hx: the curvature (1/r) of the element [1/m]
+    :param dz: variation of the length
+    :param dk1: variation of the quadrupole strength
+    :param dhx: variation of the curvature
+    :param sum_tilts: rotation relative to longitudinal axis [rad]
+    :param energy: the beam energy [GeV]
+    :return: dR-matrix [6, 6]
+    """
+    gamma = energy / m_e_GeV
+    igamma2 = 0.
+    if gamma != 0:
+        igamma2 = 1. / (gamma * gamma)
+    beta = np.sqrt(1. - igamma2)
+
+    # horizontal plane, K = k1 + hx^2
+    K = k1 + hx * hx
+    dK = dk1 + 2. * hx * dhx
+    (C, S, F, G), (C_K, S_K, F_K, G_K) = _uni_functions(K, z)
+    dC = C_K * dK - K * S * dz
+    dS = S_K * dK + C * dz
+    dF = F_K * dK + S * dz
+    dG = G_K * dK + F * dz
+
+    # vertical plane, Ky = -k1
+    Ky = -k1
+    (Cy, Sy, _, _), (Cy_K, Sy_K, _, _) = _uni_functions(Ky, z)
+    dCy = -Cy_K * dk1 - Ky * Sy * dz
+    dSy = -Sy_K * dk1 + Cy * dz
+
+    dR = np.zeros((6, 6))
+    dR[0, 0] = dC
+    dR[0, 1] = dS
+    dR[0, 5] = (dhx * F + hx * dF) / beta
+    dR[1, 0] = -dK * S - K * dS
+    dR[1, 1] = dC
+    dR[1, 5] = (dhx * S + hx * dS) / beta
+    dR[2, 2] = dCy
+    dR[2, 3] = dSy
+    dR[3, 2] = dk1 * Sy - Ky * dSy
+    dR[3, 3] = dCy
+    dR[4, 0] = (dhx * S + hx * dS) / beta
+    dR[4, 1] = (dhx * F + hx * dF) / beta
+    dR[4, 5] = (2. * hx * dhx * G + hx * hx * dG) / beta ** 2 - dz / beta ** 2 * igamma2
+    if sum_tilts != 0:
+        dR = np.dot(np.dot(rot_mtx(-sum_tilts), dR), rot_mtx(sum_tilts))
+    return dR
@@ -1,5 +1,5 @@
 from ocelot.cpbd.navi import Navigator
-from ocelot.cpbd.optics import twiss
+from ocelot.cpbd.optics import twiss, prefix_products
 from ocelot.cpbd.beam import Twiss
 from ocelot.cpbd.match import closed_orbit
 from ocelot.cpbd.track import tracking_step
@@ -7,6 +7,7 @@ from ocelot.cpbd.elements import *
 from ocelot.cpbd.beam import Particle
 import copy
 import os
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 from scipy.interpolate import splrep, splev
 import json
@@ -127,6 +128,73 @@ class MeasureResponseMatrix:
             vcor.E = splev([0, vcor.s], tck_E)[1]
 
 
+    def cumulative_maps(self, energy):
+        """
+        Cumulative first order maps of the lattice. P[0] = I, P[k] = R_k...R_1 is the map from the lattice start
+        to the end of the k-th transfer map. The result is cached while the transfer maps of the lattice,
+        the energy, correctors and bpms are the same.
+
+        :param energy: initial beam energy [GeV]
+        :return: P - array (n + 1, 6, 6), P_inv - inverse of P,
+                 rows - array, rows[i] is the row of P after the i-th element of lat.sequence
+        """
+        tms_lists = [elem.first_order_tms for elem in self.lat.sequence]
+        key = (tuple(id(tms) for tms in tms_lists), energy,
+               tuple(id(elem) for elem in list(self.hcors) + list(self.vcors) + list(self.bpms)))
+        cache = getattr(self, "_maps_cache", None)
+        if cache is not None and cache[0] == key:
+            return cache[2]
+        R = []
+        rows = np.zeros(len(tms_lists), dtype=int)
+        E = energy
+        for i, tms in enumerate(tms_lists):
+            for tm in tms:
+                R.append(tm.get_params(E).get_rotated_R())
+                E += tm.get_delta_e()
+            rows[i] = len(R)
+        P = np.empty((len(R) + 1, 6, 6))
+        P[0] = np.eye(6)
+        if len(R) > 0:
+            P[1:] = prefix_products(np.array(R))
+        maps = (P, np.linalg.inv(P), rows)
+        # tms_lists are kept in the cache, so their ids can not be reused while the cache is alive
+        self._maps_cache = (key, tms_lists, maps)
+        return maps
+
+    def sequence_positions(self, elements):
+        """
+        Positions of the elements in lat.sequence. The same element object can appear several times in the
+        sequence, then its n-th appearance in the list takes its n-th position in the sequence (as create_bpms()
+        and create_correctors() list them).
+
+        :param elements: list of elements
+        :return: array of indices of lat.sequence
+        """
+        positions = {}
+        for i, elem in enumerate(self.lat.sequence):
+            positions.setdefault(id(elem), []).append(i)
+        counts = {}
+        inx = np.zeros(len(elements), dtype=int)
+        for j, elem in enumerate(elements):
+            pos = positions[id(elem)]
+            n = counts.get(id(elem), 0)
+            inx[j] = pos[min(n, len(pos) - 1)]
+            counts[id(elem)] = n + 1
+        return inx
+
+    def kick_vectors(self, cors):
+        """
+        Derivatives of the corrector maps over the kick angle
+
+        :param cors: list of correctors
+        :return: array (len(cors), 6)
+        """
+        dB = np.zeros((len(cors), 6))
+        for j, cor in enumerate(cors):
+            dB[j] = cor.element.kick_b(z=cor.l, l=cor.l, angle=1., tilt=cor.tilt)[:, 0]
+        return dB
+
+
 class RingRM(MeasureResponseMatrix):
 
     def __init__(self, lattice, hcors, vcors, bpms):
@@ -274,6 +342,89 @@ class LinacSimRM(MeasureResponseMatrix):
         return self.resp
 
 
+class LinacAnalyticRM(MeasureResponseMatrix):
+    """
+    Linear response matrix of a linac calculated from the cumulative first order maps in one pass
+    over the lattice instead of tracking for every corrector (see LinacSimRM).
+    The orbit at BPM b after the kick of the corrector c is P_b * P_c^-1 * dB_c, where P are the cumulative R matrices
+    and dB_c is the derivative of the corrector map over the kick angle.
+
+    :param block_size: number of correctors which are calculated together
+    :param nthread: number of threads for the blocks of correctors
+    """
+    def __init__(self, lattice, hcors, vcors, bpms, block_size=256, nthread=1):
+        super(LinacAnalyticRM, self).__init__(lattice, hcors, vcors, bpms)
+        self.block_size = block_size
+        self.nthread = nthread
+
+    def response_block(self, P, P_inv, rows_bpm, rows_cor, dB):
+        """
+        Orbit at the BPMs for the block of correctors
+
+        :param P: cumulative maps, see cumulative_maps()
+        :param P_inv: inverse of the cumulative maps
+        :param rows_bpm: rows of P after the BPMs
+        :param rows_cor: rows of P after the correctors
+        :param dB: kick vectors of the correctors, see kick_vectors()
+        :return: array (n_bpm, n_cor, 2), horizontal and vertical orbit
+        """
+        # kick at the corrector exit propagated back to the lattice start
+        V = np.einsum('kij,kj->ki', P_inv[rows_cor], dB)
+        X = np.einsum('mij,kj->mki', P[rows_bpm][:, [0, 2]], V)
+        return X * (rows_bpm[:, None] >= rows_cor[None, :])[:, :, None]
+
+    def calculate(self, tw_init=None):
+        """
+        calculation of the response matrix
+
+        :param tw_init: initial Twiss, only the energy is used. If tw_init is None, initial beam energy is ZERO
+        :return: orbit.resp
+        """
+        Einit = 0. if tw_init is None else tw_init.E
+        P, P_inv, rows = self.cumulative_maps(Einit)
+        cache = getattr(self, "_resp_cache", None)
+        if cache is not None and cache[0] is P:
+            self.resp = cache[1].copy()
+            return self.resp
+        cors = list(self.hcors) + list(self.vcors)
+        rows_bpm = rows[self.sequence_positions(self.bpms)]
+        rows_cor = rows[self.sequence_positions(cors)]
+        dB = self.kick_vectors(cors)
+
+        blocks = [slice(i, i + self.block_size) for i in range(0, len(cors), self.block_size)]
+        with ThreadPoolExecutor(max_workers=self.nthread) as executor:
+            X = list(executor.map(lambda b: self.response_block(P, P_inv, rows_bpm, rows_cor[b], dB[b]), blocks))
+        m = len(self.bpms)
+        self.resp = np.zeros((2 * m, len(cors)))
+        for b, Xb in zip(blocks, X):
+            self.resp[:m, b] = Xb[:, :, 0]
+            self.resp[m:, b] = Xb[:, :, 1]
+        self._resp_cache = (P, self.resp.copy())
+        return self.resp
+
+
+class RingAnalyticRM(LinacAnalyticRM):
+    """
+    Closed orbit response matrix of a ring calculated from the cumulative first order maps.
+    The closed orbit at the corrector c is X_c = (I - M_c)^-1 dB_c, M_c = P_c M P_c^-1 is the one turn map
+    starting at the corrector. The orbit at BPM b is P_b P_c^-1 X_c for BPMs downstream of the corrector
+    and P_b M P_c^-1 X_c for BPMs upstream.
+    """
+    def __init__(self, lattice, hcors, vcors, bpms, block_size=256, nthread=1):
+        super(RingAnalyticRM, self).__init__(lattice, hcors, vcors, bpms, block_size=block_size, nthread=nthread)
+
+    def response_block(self, P, P_inv, rows_bpm, rows_cor, dB):
+        M = P[-1]
+        M_cor = np.matmul(np.matmul(P[rows_cor], M), P_inv[rows_cor])
+        # transverse closed orbit at the corrector exit
+        X_cor = np.zeros((len(rows_cor), 6))
+        X_cor[:, :4] = np.linalg.solve(np.eye(4) - M_cor[:, :4, :4], dB[:, :4, None])[:, :, 0]
+        V = np.einsum('kij,kj->ki', P_inv[rows_cor], X_cor)
+        V = np.where((rows_bpm[:, None] >= rows_cor[None, :])[:, :, None], V[None, :, :],
+                     np.einsum('ij,kj->ki', M, V)[None, :, :])
+        return np.einsum('mij,mkj->mki', P[rows_bpm][:, [0, 2]], V)
+
+
 class LinacRmatrixRM(MeasureResponseMatrix):
 
     def __init__(self, lattice, hcors, vcors, bpms):
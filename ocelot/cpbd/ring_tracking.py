@@ -0,0 +1,449 @@
+"""
+Turn-by-turn tracking of particles in a ring.
+
+The one-turn sequence of transformations is compiled into arrays: merged runs of first order maps, second order maps,
+thin kicks (KickTM) and multipole kicks (MultipoleTM). With numba the particles are tracked through all turns in one
+parallel loop, otherwise turn by turn with numpy over the particles which are still alive. Lost particles are not
+deleted but flagged with the turn of the loss, the coordinates can be recorded every `record_step` turns into a
+preallocated ring buffer.
+The tunes of the particles are determined from the records with NAFF (naff_tune, frequency_map).
+"""
+
+import logging
+from math import factorial
+
+import numpy as np
+
+from ocelot.cpbd.beam import ParticleArray
+from ocelot.cpbd.navi import Navigator
+from ocelot.cpbd.transformations.transfer_map import TransferMap
+from ocelot.cpbd.transformations.second_order import SecondTM
+from ocelot.cpbd.transformations.kick import KickTM, KICK_INTEGRATORS, kick_coefficients, kick_slices
+from ocelot.cpbd.transformations.multipole import MultipoleTM
+
+_logger = logging.getLogger(__name__)
+
+try:
+    import numba as nb
+    nb_flag = True
+except ImportError:
+    _logger.debug("ring_tracking.py: module NUMBA is not installed. Install it to speed up calculation")
+    nb_flag = False
+
+LINEAR, SECOND, KICK, MULTIPOLE = 0, 1, 2, 3
+
+
+def one_turn_steps(t_maps, energy):
+    """
+    Consecutive TransferMaps without energy change are merged into one (R, B) pair.
+
+    :param t_maps: list of Transformations
+    :param energy: beam energy in [GeV]
+    :return: list of (R, B) tuples and Transformations
+    """
+    steps = []
+    for tm in t_maps:
+        if type(tm) is TransferMap and tm.get_delta_e() == 0:
+            params = tm.get_params(energy)
+            R, B = params.get_rotated_R(), params.B[:, 0]
+            if steps and isinstance(steps[-1], tuple):
+                R0, B0 = steps[-1]
+                steps[-1] = (np.dot(R, R0), np.dot(R, B0) + B)
+            else:
+                steps.append((R, B))
+        else:
+            steps.append(tm)
+    return steps
+
+
+def compile_steps(steps, energy):
+    """
+    Arrays of the one-turn steps for the compiled tracking.
+
+    :param steps: list of (R, B) tuples and Transformations, see one_turn_steps()
+    :param energy: beam energy in [GeV]
+    :return: (kinds, Rs, Ts, Bs, kicks, kns) or None if a step can not be compiled
+    """
+    nsteps = len(steps)
+    kinds = np.zeros(nsteps, dtype=np.int64)
+    Rs = np.zeros((nsteps, 6, 6))
+    Ts = np.zeros((nsteps, 6, 6, 6))
+    Bs = np.zeros((nsteps, 6))
+    kicks = np.zeros((nsteps, 20))
+    kn_list = [[0.]] * nsteps
+
+    beta, coef = kick_coefficients(energy)
+
+    for m, step in enumerate(steps):
+        if isinstance(step, tuple):
+            kinds[m] = LINEAR
+            Rs[m], Bs[m] = step
+        elif step.get_delta_e() != 0:
+            return None
+        elif type(step) is SecondTM:
+            params = step.get_params(energy)
+            kinds[m] = SECOND
+            if params.tilt != 0:
+                Rs[m], Ts[m] = params.get_rotated_R(), params.get_rotated_T()
+            else:
+                Rs[m], Ts[m] = params.R, params.T
+            Bs[m] = params.B[:, 0]
+        elif type(step) is KickTM:
+            params = step.get_params()
+            kinds[m] = KICK
+            nkick = step.nkick
+            l = (step.delta_length if step.delta_length is not None else step.length) / nkick
+            drifts, weights = KICK_INTEGRATORS[step.integrator]
+            kicks[m, :13] = [nkick, l, params.angle / nkick, params.k1 * l, params.k2 * l / 2., params.k3 * l / 6.,
+                             params.dx, params.dy, np.cos(params.tilt), np.sin(params.tilt), beta, coef, step.nstages]
+            kicks[m, 13:17], kicks[m, 17:20] = drifts, weights
+        elif type(step) is MultipoleTM:
+            kinds[m] = MULTIPOLE
+            kn = np.atleast_1d(step.get_params().kn)
+            kn_list[m] = [kn[0]] + [kn[n] / factorial(n) for n in range(1, len(kn))]
+        else:
+            return None
+
+    kns = np.zeros((nsteps, max(len(kn) for kn in kn_list)))
+    for m, kn in enumerate(kn_list):
+        kns[m, :len(kn)] = kn
+    return kinds, Rs, Ts, Bs, kicks, kns
+
+
+def track_turns_py(X, kinds, Rs, Ts, Bs, kicks, kns, turn0, turn1, nturns, nsuperperiods, limits, loss_turn,
+                   record, record_step):
+    """
+    Tracking of the particles which are still alive (loss_turn < 0) from turn0 to turn1.
+    After every superperiod the particle is lost if |x| > limits[0], |y| > limits[1], |px| > limits[2],
+    |py| > limits[3] or a coordinate is NaN.
+    The record k (turn k*record_step) is written in record[k % len(record)], for lost particles it is NaN.
+
+    :param X: array (6, N), changed in place
+    :param kinds, Rs, Ts, Bs, kicks, kns: compiled one-turn steps, see compile_steps()
+    :param turn0: first turn
+    :param turn1: last turn + 1
+    :param nturns: total number of turns
+    :param nsuperperiods: number of superperiods
+    :param limits: array [xlim, ylim, px_lim, py_lim]
+    :param loss_turn: array (N), the turn of the particle loss, changed in place
+    :param record: array (nrecords, 6, N)
+    :param record_step: turns between records, 0 - no records
+    :return: None
+    """
+    nsteps = kinds.shape[0]
+    nrecords = record.shape[0]
+    nkn = kns.shape[1]
+    for n in _prange(X.shape[1]):
+        if loss_turn[n] >= 0:
+            continue
+        x = np.empty(6)
+        y = np.empty(6)
+        for i in range(6):
+            x[i] = X[i, n]
+        for turn in range(turn0, turn1):
+            for sp in range(nsuperperiods):
+                for m in range(nsteps):
+                    kind = kinds[m]
+                    if kind == 0 or kind == 1:
+                        for i in range(6):
+                            v = 0.
+                            for j in range(6):
+                                v += Rs[m, i, j] * x[j]
+                            if kind == 1:
+                                for j in range(6):
+                                    for k in range(6):
+                                        v += Ts[m, i, j, k] * x[j] * x[k]
+                            y[i] = v + Bs[m, i]
+                        for i in range(6):
+                            x[i] = y[i]
+                    elif kind == 2:
+                        dx, dy, cs, sn = kicks[m, 6], kicks[m, 7], kicks[m, 8], kicks[m, 9]
+                        a, b = x[0] - dx, x[2] - dy
+                        x[0], x[2] = cs * a + sn * b, -sn * a + cs * b
+                        a, b = x[1], x[3]
+                        x[1], x[3] = cs * a + sn * b, -sn * a + cs * b
+                        kick_slices(x, kicks[m, 1], kicks[m, 2], kicks[m, 3], kicks[m, 4], kicks[m, 5], kicks[m, 10],
+                                    kicks[m, 11], int(kicks[m, 0]), kicks[m, 13:17], kicks[m, 17:20], int(kicks[m, 12]))
+                        a, b = x[0], x[2]
+                        x[0], x[2] = cs * a - sn * b + dx, sn * a + cs * b + dy
+                        a, b = x[1], x[3]
+                        x[1], x[3] = cs * a - sn * b, sn * a + cs * b
+                    else:
+                        re, im = -kns[m, 0] * x[5], 0.
+                        zr, zi = 1., 0.
+                        for k in range(1, nkn):
+                            zr, zi = zr * x[0] - zi * x[2], zr * x[2] + zi * x[0]
+                            re += kns[m, k] * zr
+                            im += kns[m, k] * zi
+                        x[1] -= re
+                        x[3] += im
+                        x[4] -= kns[m, 0] * x[0]
+                if not (abs(x[0]) <= limits[0] and abs(x[2]) <= limits[1] and
+                        abs(x[1]) <= limits[2] and abs(x[3]) <= limits[3]):
+                    loss_turn[n] = turn
+                    break
+            if loss_turn[n] >= 0:
+                if record_step > 0:
+                    k_last = nturns // record_step
+                    for k in range(max(turn // record_step + 1, k_last - nrecords + 1), k_last + 1):
+                        for i in range(6):
+                            record[k % nrecords, i, n] = np.nan
+                break
+            if record_step > 0 and (turn + 1) % record_step == 0:
+                k = (turn + 1) // record_step
+                for i in range(6):
+                    record[k % nrecords, i, n] = x[i]
+        for i in range(6):
+            X[i, n] = x[i]
+
+
+if nb_flag:
+    _prange = nb.prange
+    track_turns = nb.njit(parallel=True)(track_turns_py)
+else:
+    _prange = range
+    track_turns = None
+
+
+class RingTracker:
+    """
+    Turn-by-turn tracking of particles in a ring.
+
+    tracker = RingTracker(lat, aperture=aperture_limit(lat), record_step=10, nrecords=100)
+    X = tracker.track(X0, nturns=10000, energy=3.)
+
+    tracker.loss_turn - turn of the loss of the particles, -1 for the particles which survived
+    tracker.get_record() - turns and coordinates of the last 100 records (every 10th turn)
+
+    RingTracker.compiled = False (or tracker.compiled = False) forces the numpy tracking. Both give the same results
+    up to rounding, which the chaotic motion at the border of the dynamic aperture can amplify to different loss turns.
+    """
+    compiled = nb_flag
+
+    def __init__(self, lat, nsuperperiods=1, aperture=None, record_step=0, nrecords=None):
+        """
+        :param lat: MagneticLattice of one superperiod
+        :param nsuperperiods: number of superperiods
+        :param aperture: (xlim, ylim, px_lim, py_lim) checked after every superperiod,
+                         if None only particles with NaN coordinates are lost
+        :param record_step: the coordinates are recorded every record_step turns, 0 - no records
+        :param nrecords: size of the ring buffer of the records, if None all records are kept
+        """
+        self.lat = lat
+        self.nsuperperiods = nsuperperiods
+        self.limits = np.array(aperture if aperture is not None else [np.inf] * 4, dtype=float)
+        self.record_step = record_step
+        self.nrecords = nrecords
+        self.loss_turn = None
+        self.record = None
+        self.nturns = 0
+
+    def prepare(self, energy):
+        """
+        The one-turn steps of the lattice at the energy.
+
+        :param energy: beam energy in [GeV]
+        :return: list of steps, compiled steps (None if the lattice contains other transformations)
+        """
+        navi = Navigator(self.lat)
+        steps = one_turn_steps(navi.get_map(self.lat.totalLen), energy)
+        return steps, compile_steps(steps, energy)
+
+    def track(self, X0, nturns, energy=0., print_progress=False):
+        """
+        :param X0: array (6, N) of initial coordinates, it is not changed
+        :param nturns: number of turns
+        :param energy: beam energy in [GeV]
+        :param print_progress: print the turn number
+        :return: array (6, N), the coordinates after the last turn or at the loss of the particle
+        """
+        X = np.array(X0, dtype=float)
+        npart = X.shape[1]
+        self.nturns = nturns
+        self.loss_turn = -np.ones(npart, dtype=np.int64)
+        nrecords = 0
+        if self.record_step > 0:
+            nrecords = nturns // self.record_step + 1
+            if self.nrecords is not None:
+                nrecords = min(self.nrecords, nrecords)
+        self.record = np.full((nrecords, 6, npart), np.nan)
+        if nrecords > 0:
+            self.record[0] = X
+
+        steps, tables = self.prepare(energy)
+        if tables is not None and self.compiled and track_turns is not None:
+            chunk = 100 if print_progress else max(nturns, 1)
+            for turn0 in range(0, nturns, chunk):
+                turn1 = min(turn0 + chunk, nturns)
+                track_turns(X, *tables, turn0, turn1, nturns, self.nsuperperiods, self.limits, self.loss_turn,
+                            self.record, self.record_step)
+                if print_progress:
+                    print(turn1 - 1)
+        else:
+            self._track_numpy(X, steps, nturns, energy, print_progress)
+        return X
+
+    def _track_numpy(self, X, steps, nturns, energy, print_progress):
+        alive = np.arange(X.shape[1])
+        p_array = ParticleArray()
+        p_array.rparticles = X.copy()
+        p_array.q_array = np.zeros(X.shape[1])
+        p_array.E = energy
+        nrecords = self.record.shape[0]
+        for turn in range(nturns):
+            if print_progress:
+                print(turn)
+            for sp in range(self.nsuperperiods):
+                for step in steps:
+                    if isinstance(step, tuple):
+                        R, B = step
+                        p_array.rparticles[:] = np.dot(R, p_array.rparticles) + B[:, np.newaxis]
+                    else:
+                        step.apply(p_array)
+                x = p_array.rparticles
+                lost = ~((np.abs(x[0]) <= self.limits[0]) & (np.abs(x[2]) <= self.limits[1]) &
+                         (np.abs(x[1]) <= self.limits[2]) & (np.abs(x[3]) <= self.limits[3]))
+                if np.any(lost):
+                    self.loss_turn[alive[lost]] = turn
+                    X[:, alive[lost]] = x[:, lost]
+                    alive = alive[~lost]
+                    p_array.rparticles = x[:, ~lost]
+                    p_array.q_array = p_array.q_array[~lost]
+            if self.record_step > 0 and (turn + 1) % self.record_step == 0:
+                record = self.record[(turn + 1) // self.record_step % nrecords]
+                record[:] = np.nan
+                record[:, alive] = p_array.rparticles
+        X[:, alive] = p_array.rparticles
+
+    def get_record(self):
+        """
+        Records in chronological order.
+
+        :return: turns (nrecords), coordinates (nrecords, 6, N), NaN after the loss of the particle
+        """
+        nrecords = self.record.shape[0]
+        if nrecords == 0:
+            return np.zeros(0, dtype=int), self.record
+        k_last = self.nturns // self.record_step
+        ks = np.arange(k_last - nrecords + 1, k_last + 1)
+        return ks * self.record_step, self.record[ks % nrecords]
+
+    def frequency_map(self, tws=None, window=True, nu0=None, diap=None, nearest=False):
+        """
+        Frequency map analysis of the records (see frequency_map()), the coordinates have to be recorded every turn.
+
+        :param tws: Twiss at the start of the ring, if given the normalized complex signals are analysed
+        :param window: use the Hann window
+        :param nu0: None or (nux, nuy), the tunes are searched around them (see naff_tune)
+        :param diap: half width of the search window around nu0
+        :param nearest: take the spectral peak nearest to nu0
+        :return: nux, nuy, diffusion - arrays (N), NaN for lost particles
+        """
+        if self.record_step != 1:
+            raise ValueError("frequency map analysis needs the coordinates of every turn, record_step must be 1")
+        _, record = self.get_record()
+        return frequency_map(record, tws=tws, window=window, nu0=nu0, diap=diap, nearest=nearest)
+
+
+def naff_tune(signal, window=True, niter=3, chunk=1024, nu0=None, diap=None, nearest=False):
+    """
+    Fundamental frequency of turn-by-turn signals (NAFF). The peak of the FFT spectrum of the signal multiplied by
+    the Hann window is interpolated between the bins and refined by Newton iterations on the amplitude of the
+    Fourier integral, all particles at once.
+
+    :param signal: array (nparticles, nturns), real (e.g. x) or complex (e.g. x - i*px)
+    :param window: use the Hann window
+    :param niter: number of Newton iterations
+    :param chunk: number of particles processed at once
+    :param nu0: None or the expected tune (e.g. the linear tune). If given, the peak is searched in the window
+                |nu - nu0| <= diap, so that the strongest line of coupled motion (e.g. nux + nuy) is not taken instead.
+                If the window has no peak, the highest peak of the whole spectrum is used.
+    :param diap: half width of the search window around nu0, None - the whole spectrum
+    :param nearest: take the local maximum of the spectrum nearest to nu0 instead of the highest one
+    :return: array (nparticles) of tunes, in [0, 0.5] for real signals and in [0, 1) for complex signals,
+             NaN if the signal is not finite
+    """
+    signal = np.atleast_2d(signal)
+    npart, n = signal.shape
+    tunes = np.full(npart, np.nan)
+    finite = np.all(np.isfinite(signal), axis=1)
+    if n < 3 or not np.any(finite):
+        return tunes
+    t = np.arange(n)
+    w = 1. - np.cos(2 * np.pi * t / n) if window else np.ones(n)
+    is_real = not np.iscomplexobj(signal)
+    nbins = n // 2 + 1 if is_real else n
+
+    z = signal[finite]
+    z = (z - np.mean(z, axis=1)[:, np.newaxis]) * w
+    spectrum = np.abs(np.fft.fft(z, axis=1))
+    k = 1 + np.argmax(spectrum[:, 1:nbins], axis=1)
+    rows = np.arange(len(k))
+    if nu0 is not None:
+        bins = np.arange(1, nbins)
+        nu_bins = np.minimum(bins, n - bins) / n if is_real else bins / n
+        dist = np.abs(nu_bins - nu0)
+        if not is_real:
+            dist = np.minimum(dist, 1. - dist)
+        s = spectrum[:, bins]
+        peaks = (s > spectrum[:, bins - 1]) & (s >= spectrum[:, (bins + 1) % n])
+        inside = peaks & (dist <= diap) if diap is not None else peaks
+        score = np.where(inside, -dist if nearest else s, -np.inf)
+        found = np.any(inside, axis=1)
+        k = np.where(found, 1 + np.argmax(score, axis=1), k)
+    a0, a1, a2 = spectrum[rows, k - 1], spectrum[rows, k], spectrum[rows, (k + 1) % n]
+    sign = np.where(a2 > a0, 1., -1.)
+    alpha = np.maximum(a0, a2) / np.where(a1 > 0, a1, 1.)
+    delta = sign * ((2 * alpha - 1) / (alpha + 1) if window else alpha / (1 + alpha))
+    nu = (k + np.clip(delta, -0.5, 0.5)) / n
+
+    for i in range(0, len(nu), chunk):
+        zc = z[i:i + chunk]
+        nuc = nu[i:i + chunk]
+        for _ in range(niter):
+            e = zc * np.exp(-2j * np.pi * nuc[:, np.newaxis] * t)
+            F = np.sum(e, axis=1)
+            F1 = -2j * np.pi * np.dot(e, t)
+            F2 = -4 * np.pi ** 2 * np.dot(e, t * t)
+            dg = np.real(np.conj(F) * F1)
+            d2g = np.abs(F1) ** 2 + np.real(np.conj(F) * F2)
+            step = np.where(d2g < 0, -dg / np.where(d2g < 0, d2g, -1.), 0.)
+            nuc = nuc + np.clip(step, -0.5 / n, 0.5 / n)
+        nu[i:i + chunk] = nuc
+
+    nu = nu % 1.
+    if is_real:
+        nu = np.minimum(nu, 1. - nu)
+    tunes[finite] = nu
+    return tunes
+
+
+def frequency_map(record, tws=None, window=True, nu0=None, diap=None, nearest=False):
+    """
+    Frequency map analysis of turn-by-turn coordinates, e.g. RingTracker.get_record()[1] with record_step = 1.
+    The tunes are calculated for the whole record and for its two halves, the tune diffusion is
+    log10(sqrt(dnux**2 + dnuy**2)) of the tune change between the halves.
+
+    :param record: array (nturns, 6, N) of coordinates, NaN for lost particles
+    :param tws: Twiss at the start of the ring. If given, the normalized complex signals x - i*(alpha_x*x + beta_x*px)
+                are analysed and the tunes are in [0, 1), otherwise the real signals x and y with the tunes in [0, 0.5]
+    :param window: use the Hann window
+    :param nu0: None or (nux, nuy), the tunes are searched around them (see naff_tune)
+    :param diap: half width of the search window around nu0
+    :param nearest: take the spectral peak nearest to nu0
+    :return: nux, nuy, diffusion - arrays (N), NaN for lost particles
+    """
+    x, px, y, py = record[:, 0].T, record[:, 1].T, record[:, 2].T, record[:, 3].T
+    if tws is not None:
+        x = x - 1j * (tws.alpha_x * x + tws.beta_x * px)
+        y = y - 1j * (tws.alpha_y * y + tws.beta_y * py)
+    half = x.shape[1] // 2
+    nux0, nuy0 = (None, None) if nu0 is None else nu0
+    kw_x = dict(window=window, nu0=nux0, diap=diap, nearest=nearest)
+    kw_y = dict(window=window, nu0=nuy0, diap=diap, nearest=nearest)
+    nux, nuy = naff_tune(x, **kw_x), naff_tune(y, **kw_y)
+    dnux = naff_tune(x[:, :half], **kw_x) - naff_tune(x[:, half:2 * half], **kw_x)
+    dnuy = naff_tune(y[:, :half], **kw_y) - naff_tune(y[:, half:2 * half], **kw_y)
+    with np.errstate(divide="ignore"):
+        diffusion = np.log10(np.sqrt(dnux ** 2 + dnuy ** 2))
+    return nux, nuy, diffusion
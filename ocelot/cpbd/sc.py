@@ -7,17 +7,19 @@ Revision on 01.06.2017: coordinate transform to the velocity direction
 import numpy as np
 import scipy.ndimage as ndimage
 import time
+from collections import OrderedDict
 from ocelot.common.globals import *
 from ocelot.cpbd.coord_transform import *
 from scipy import interpolate
 import multiprocessing
-from scipy.special import exp1, k1
+from scipy.special import exp1, k1, ellipk
 from ocelot.cpbd.physics_proc import PhysProc
 from ocelot.common.math_op import conj_sym
 from ocelot.cpbd.beam import s_to_cur
 from ocelot.common import conf
 from ocelot.cpbd.elements import Undulator
 from scipy.interpolate import interp1d
+from scipy.fft import next_fast_len
 import logging
 
 try:
@@ -31,12 +33,16 @@ try:
     pyfftw_flag = True
     from pyfftw.interfaces.numpy_fft import fftn
     from pyfftw.interfaces.numpy_fft import ifftn
+    from pyfftw.interfaces.numpy_fft import rfftn
+    from pyfftw.interfaces.numpy_fft import irfftn
     import pyfftw
 except:
     pyfftw_flag = False
     logger.debug("cs.py: module PYFFTW is not installed. Install it to speed up calculation")
     from numpy.fft import ifftn
     from numpy.fft import fftn
+    from numpy.fft import rfftn
+    from numpy.fft import irfftn
 
 try:
     import numexpr as ne
@@ -45,6 +51,15 @@ except:
     logger.debug("sc.py: module NUMEXPR is not installed. Install it to speed up calculation")
     ne_flag = False
 
+try:
+    import numba as nb
+    nb_flag = True
+except:
+    logger.debug("sc.py: module NUMBA is not installed. Install it to speed up calculation")
+    nb_flag = False
+
+DEPOSITION_ORDERS = {"ngp": 0, "cic": 1, "tsc": 2}
+
 def smooth_z(Zin, mslice):
 
     def myfunc(x, A):
@@ -73,6 +88,288 @@ def smooth_z(Zin, mslice):
     return Zout
 
 
+def shape_weights_py(c, order):
+    """
+    1D weights of the NGP (order = 0), CIC (order = 1) and TSC (order = 2) shape functions.
+    Grid nodes are at the integer coordinates.
+
+    :param c: coordinate in units of the mesh step
+    :param order: order of the shape function
+    :return: index of the first node and weights of three consecutive nodes
+    """
+    if order == 0:
+        i0 = int(np.floor(c + 0.5))
+        return i0, 1., 0., 0.
+    elif order == 1:
+        i0 = int(np.floor(c))
+        d = c - i0
+        return i0, 1. - d, d, 0.
+    k = int(np.floor(c + 0.5))
+    d = c - k
+    return k - 1, 0.5 * (0.5 - d) ** 2, 0.75 - d * d, 0.5 * (0.5 + d) ** 2
+
+
+def deposit_charge_np(U, Q, nxyz, order):
+    """
+    Deposits charges on the grid with the shape function of the given order.
+    Indices out of the grid are clipped to the grid boundaries.
+
+    :param U: array (N, 3), particle coordinates in units of the mesh steps, grid nodes are at the integer coordinates
+    :param Q: array (N, ), charges
+    :param nxyz: grid shape
+    :param order: 0 - NGP, 1 - CIC, 2 - TSC
+    :return: array nxyz, charge density on the grid
+    """
+    nx, ny, nz = nxyz
+    idx = []
+    weights = []
+    for d in range(3):
+        c = U[:, d]
+        if order == 0:
+            i0 = np.floor(c + 0.5)
+            w = [np.ones_like(c)]
+        elif order == 1:
+            i0 = np.floor(c)
+            dc = c - i0
+            w = [1. - dc, dc]
+        else:
+            i0 = np.floor(c + 0.5)
+            dc = c - i0
+            i0 = i0 - 1
+            w = [0.5 * (0.5 - dc) ** 2, 0.75 - dc * dc, 0.5 * (0.5 + dc) ** 2]
+        i0 = i0.astype(int)
+        idx.append([np.clip(i0 + m, 0, nxyz[d] - 1) for m in range(order + 1)])
+        weights.append(w)
+    q = np.zeros(nx * ny * nz)
+    for a in range(order + 1):
+        for b in range(order + 1):
+            inds_xy = idx[0][a] * (ny * nz) + idx[1][b] * nz
+            w_xy = Q * weights[0][a] * weights[1][b]
+            for c in range(order + 1):
+                q += np.bincount(inds_xy + idx[2][c], w_xy * weights[2][c], nx * ny * nz)
+    return q.reshape(nxyz)
+
+
+def deposit_charge_nb(U, Q, nxyz, order):
+    """
+    Parallel version of deposit_charge_np(). Every thread deposits its chunk of particles on a private grid,
+    then the private grids are summed up.
+    """
+    nx, ny, nz = nxyz[0], nxyz[1], nxyz[2]
+    N = U.shape[0]
+    nchunks = nb.get_num_threads()
+    grids = np.zeros((nchunks, nx, ny, nz))
+    for t in nb.prange(nchunks):
+        for n in range(t * N // nchunks, (t + 1) * N // nchunks):
+            i0, wx0, wx1, wx2 = shape_weights(U[n, 0], order)
+            j0, wy0, wy1, wy2 = shape_weights(U[n, 1], order)
+            k0, wz0, wz1, wz2 = shape_weights(U[n, 2], order)
+            wx = (wx0, wx1, wx2)
+            wy = (wy0, wy1, wy2)
+            wz = (wz0, wz1, wz2)
+            for a in range(order + 1):
+                i = min(max(i0 + a, 0), nx - 1)
+                qa = Q[n] * wx[a]
+                for b in range(order + 1):
+                    j = min(max(j0 + b, 0), ny - 1)
+                    qb = qa * wy[b]
+                    for c in range(order + 1):
+                        k = min(max(k0 + c, 0), nz - 1)
+                        grids[t, i, j, k] += qb * wz[c]
+    q = np.zeros((nx, ny, nz))
+    for i in nb.prange(nx):
+        for t in range(nchunks):
+            q[i] += grids[t, i]
+    return q
+
+
+def gather_field_nb(U, p, steps, order):
+    """
+    Calculates the electric field -grad(p) and interpolates it to the particle positions in one pass
+    without the field arrays on the grid. The field components are on the staggered grids as in SpaceCharge.el_field(),
+    the field out of the grid is zero. Linear interpolation is used for order < 2.
+
+    :param U: array (N, 3), particle coordinates in units of the mesh steps, grid nodes are at the integer coordinates
+    :param p: array (nx, ny, nz), potential on the grid
+    :param steps: mesh steps
+    :param order: order of the shape function
+    :return: array (N, 3), Ex, Ey, Ez
+    """
+    nx, ny, nz = p.shape
+    N = U.shape[0]
+    order = max(order, 1)
+    Exyz = np.zeros((N, 3))
+    for n in nb.prange(N):
+        for comp in range(3):
+            # the field component is shifted by half of the mesh step in its direction
+            cx = U[n, 0] - 0.5 if comp == 0 else U[n, 0]
+            cy = U[n, 1] - 0.5 if comp == 1 else U[n, 1]
+            cz = U[n, 2] - 0.5 if comp == 2 else U[n, 2]
+            i0, wx0, wx1, wx2 = shape_weights(cx, order)
+            j0, wy0, wy1, wy2 = shape_weights(cy, order)
+            k0, wz0, wz1, wz2 = shape_weights(cz, order)
+            wx = (wx0, wx1, wx2)
+            wy = (wy0, wy1, wy2)
+            wz = (wz0, wz1, wz2)
+            E = 0.
+            for a in range(order + 1):
+                i = i0 + a
+                if i < 0 or i >= nx or (comp == 0 and i == nx - 1):
+                    continue
+                for b in range(order + 1):
+                    j = j0 + b
+                    if j < 0 or j >= ny or (comp == 1 and j == ny - 1):
+                        continue
+                    for c in range(order + 1):
+                        k = k0 + c
+                        if k < 0 or k >= nz or (comp == 2 and k == nz - 1):
+                            continue
+                        if comp == 0:
+                            dp = p[i, j, k] - p[i + 1, j, k]
+                        elif comp == 1:
+                            dp = p[i, j, k] - p[i, j + 1, k]
+                        else:
+                            dp = p[i, j, k] - p[i, j, k + 1]
+                        E += wx[a] * wy[b] * wz[c] * dp
+            Exyz[n, comp] = E / steps[comp]
+    return Exyz
+
+
+def gather_field_np(U, p, steps, order):
+    """
+    NumPy version of gather_field_nb(). The field is calculated on the grid and interpolated to the particle positions.
+    """
+    nx, ny, nz = p.shape
+    Ex = np.zeros(p.shape)
+    Ey = np.zeros(p.shape)
+    Ez = np.zeros(p.shape)
+    Ex[:nx - 1, :, :] = (p[:nx - 1, :, :] - p[1:nx, :, :]) / steps[0]
+    Ey[:, :ny - 1, :] = (p[:, :ny - 1, :] - p[:, 1:ny, :]) / steps[1]
+    Ez[:, :, :nz - 1] = (p[:, :, :nz - 1] - p[:, :, 1:nz]) / steps[2]
+    Exyz = np.zeros((U.shape[0], 3))
+    for comp, E in enumerate([Ex, Ey, Ez]):
+        C = U - 0.5 * (np.arange(3) == comp)
+        if order < 2:
+            Exyz[:, comp] = ndimage.map_coordinates(E, C.T, order=1)
+            continue
+        idx = []
+        weights = []
+        for d in range(3):
+            k = np.floor(C[:, d] + 0.5)
+            dc = C[:, d] - k
+            k = k.astype(int) - 1
+            idx.append([k, k + 1, k + 2])
+            weights.append([0.5 * (0.5 - dc) ** 2, 0.75 - dc * dc, 0.5 * (0.5 + dc) ** 2])
+        for a in range(3):
+            for b in range(3):
+                for c in range(3):
+                    i, j, k = idx[0][a], idx[1][b], idx[2][c]
+                    inside = (i >= 0) & (i < nx) & (j >= 0) & (j < ny) & (k >= 0) & (k < nz)
+                    Exyz[inside, comp] += (weights[0][a] * weights[1][b] * weights[2][c])[inside] * E[i[inside], j[inside], k[inside]]
+    return Exyz
+
+
+if nb_flag:
+    shape_weights = nb.njit(shape_weights_py)
+    deposit_charge = nb.njit(parallel=True)(deposit_charge_nb)
+    gather_field = nb.njit(parallel=True)(gather_field_nb)
+else:
+    shape_weights = shape_weights_py
+    deposit_charge = deposit_charge_np
+    gather_field = gather_field_np
+
+
+class GreenFunctionCache:
+    """
+    LRU cache of the FFTs of the integrated Green's function (see SpaceCharge.sym_kernel)
+    and of the FFTW plans for the zero-padded charge grid.
+
+    The integrated Green's function scales as h**2 for the mesh steps h*[1, hy/hx, hz/hx],
+    therefore the kernels are calculated for hx = 1 and cached with the key
+    (grid shape, hy/hx, hz/hx). The cache is shared by all SpaceCharge instances (SpaceCharge.kernel_cache).
+
+    :param maxsize: maximum number of cached kernels and FFTW plans, the least recently used are removed first
+    :param planner_effort: FFTW planner effort for new plans, e.g. 'FFTW_ESTIMATE', 'FFTW_MEASURE'.
+                           Plans are reused, so 'FFTW_MEASURE' pays off for long runs.
+    """
+    def __init__(self, maxsize=4, planner_effort='FFTW_ESTIMATE'):
+        self.maxsize = maxsize
+        self.planner_effort = planner_effort
+        self.kernels = OrderedDict()
+        self.plans = OrderedDict()
+        self.wisdom = None
+        self.hits = 0
+        self.misses = 0
+
+    def clear(self):
+        self.kernels.clear()
+        self.plans.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def _put(self, cache, key, value):
+        cache[key] = value
+        while len(cache) > self.maxsize:
+            cache.popitem(last=False)
+
+    def get_kernel_fft(self, shape, steps, kernel_func, padded_shape=None):
+        """
+        Returns the FFT of the mirrored kernel for the mesh steps
+
+        :param shape: shape of the charge grid (Nx, Ny, Nz)
+        :param steps: mesh steps [hx, hy, hz]
+        :param kernel_func: function(shape, steps, padded_shape) which calculates the FFT of the kernel on the padded grid
+        :param padded_shape: shape of the padded grid for the real-to-complex FFT.
+                             If None, the complex FFT on the grid (2*Nx-1, 2*Ny-1, 2*Nz-1) is used.
+        :return: array (2*Nx-1, 2*Ny-1, 2*Nz-1) or the half spectrum of padded_shape
+        """
+        hx = steps[0]
+        # ratios are rounded to suppress the floating point noise
+        unit_steps = (1., float("%.12g" % (steps[1] / hx)), float("%.12g" % (steps[2] / hx)))
+        key = (tuple(shape), padded_shape, unit_steps[1], unit_steps[2])
+        K_fft = self.kernels.get(key)
+        if K_fft is None:
+            self.misses += 1
+            K_fft = kernel_func(shape, unit_steps, padded_shape)
+            self._put(self.kernels, key, K_fft)
+        else:
+            self.hits += 1
+            self.kernels.move_to_end(key)
+        return K_fft * hx * hx
+
+    def get_fftw_plans(self, shape, real=False):
+        """
+        Returns an aligned input array and FFTW plans of the forward and backward transforms
+        of this array. The plans are created once per shape and reused.
+
+        :param shape: shape of the padded grid
+        :param real: if True, the input array is real and the real-to-complex transforms are planned
+        :return: array, pyfftw.FFTW, pyfftw.FFTW
+        """
+        key = (tuple(shape), real)
+        plans = self.plans.get(key)
+        if plans is None:
+            nthreads = max(int(conf.OCELOT_NUM_THREADS), 1)
+            if self.wisdom is not None:
+                pyfftw.import_wisdom(self.wisdom)
+            if real:
+                a = pyfftw.empty_aligned(shape, dtype='float64')
+                b = pyfftw.empty_aligned(tuple(shape[:2]) + (shape[2] // 2 + 1,), dtype='complex128')
+            else:
+                a = pyfftw.empty_aligned(shape, dtype='complex128')
+                b = pyfftw.empty_aligned(shape, dtype='complex128')
+            fft_forward = pyfftw.FFTW(a, b, axes=(0, 1, 2), direction='FFTW_FORWARD',
+                                      flags=(self.planner_effort,), threads=nthreads)
+            fft_backward = pyfftw.FFTW(b, a, axes=(0, 1, 2), direction='FFTW_BACKWARD',
+                                       flags=(self.planner_effort,), threads=nthreads)
+            self.wisdom = pyfftw.export_wisdom()
+            plans = (a, fft_forward, fft_backward)
+            self._put(self.plans, key, plans)
+        else:
+            self.plans.move_to_end(key)
+        return plans
+
+
 class SpaceCharge(PhysProc):
     """
     Space Charge physics process
@@ -80,6 +377,21 @@ class SpaceCharge(PhysProc):
     Attributes:
         self.step = 1 [in Navigator.unit_step] - step of the Space Charge kick applying
         self.nmesh_xyz = [63, 63, 63] - 3D mesh
+        self.deposition = "ngp" - charge deposition and field interpolation scheme:
+                          "ngp" - nearest grid point deposition and linear interpolation of the field,
+                          "cic" - cloud-in-cell deposition and linear interpolation of the field,
+                          "tsc" - triangular-shaped-cloud deposition and quadratic interpolation of the field.
+                          Higher order schemes have lower numerical noise for the same number of particles.
+        self.solver = "fft" - "fft": complex FFTs on the grid (2Nx-1, 2Ny-1, 2Nz-1),
+                              "rfft": real-to-complex FFTs with the padded sizes >= 2N-1 chosen for fast FFT lengths,
+                              it needs about two times less memory
+        self.mesh_percentile = None - if None the mesh covers all particles. If set (e.g. 0.1) the mesh is defined
+                              by the [mesh_percentile, 100 - mesh_percentile] percentiles of the particle coordinates
+                              extended by the relative margin self.mesh_margin = 0.1.
+                              Particles out of the mesh (halo) are not deposited. They get the field of the point
+                              charge of the whole bunch (monopole approximation) and the core particles get the
+                              field of the halo charges at the core center of charge (uniform over the core).
+        self.solve_stats - dictionary with time [sec] and memory [bytes] of the last field calculation
 
     Description:
         The space charge forces are calculated by solving the Poisson equation in the bunch frame.
@@ -88,7 +400,15 @@ class SpaceCharge(PhysProc):
     by convolution of the free-space Green's function with the charge distribution.
     The convolution equation is solved with the help of the Fast Fourier Transform (FFT). The same algorithm for
     solution of the 3D Poisson equation is used, for example, in ASTRA
+
+    The FFTs of the Green's function and the FFTW plans are cached in SpaceCharge.kernel_cache (GreenFunctionCache),
+    which is shared by all SpaceCharge instances. The kernel can be reused only for the same ratios hy/hx and hz/hx
+    of the mesh steps. With kernel_rtol > 0 the steps hy and hz are slightly increased (not more than
+    by factor 1 + kernel_rtol) to the nearest ratios from a logarithmic grid, so the kernel is reused
+    when the bunch shape changes slowly.
     """
+    kernel_cache = GreenFunctionCache()
+
     def __init__(self, step=1, **kwargs):
         PhysProc.__init__(self)
         self.step = step # in unit step
@@ -100,6 +420,12 @@ class SpaceCharge(PhysProc):
         self.debug = False
         self.random_mesh = kwargs.get("random_mesh", False)  # if True mesh is shifted slightly on each step in order to reduce numerical noise
         self.random_seed = 10     # random seeding number. if None seeding is random
+        self.kernel_rtol = kwargs.get("kernel_rtol", 0.)  # relative tolerance of the mesh step ratios for the kernel reuse
+        self.deposition = kwargs.get("deposition", "ngp")  # charge deposition and field gather: "ngp", "cic" or "tsc"
+        self.solver = kwargs.get("solver", "fft")  # "fft" - complex FFTs, "rfft" - real-to-complex FFTs of fast lengths
+        self.mesh_percentile = kwargs.get("mesh_percentile", None)  # e.g. 0.1 - mesh from 0.1 and 99.9 percentiles
+        self.mesh_margin = kwargs.get("mesh_margin", 0.1)  # relative extension of the percentile based mesh
+        self.solve_stats = {}  # time and memory of the last solution of the Poisson equation
 
     def prepare(self, lat):
         self.check_step()
@@ -132,6 +458,44 @@ class SpaceCharge(PhysProc):
 
         return kern
 
+    def kernel_fft(self, shape, steps, padded_shape=None):
+        """
+        FFT of the integrated Green's function mirrored on the padded grid.
+        The mirrored kernel is symmetric, so its FFT is real.
+
+        :param shape: shape of the charge grid (Nx, Ny, Nz)
+        :param steps: mesh steps [hx, hy, hz]
+        :param padded_shape: shape (Mx, My, Mz) with M >= 2*N - 1. If set, the real-to-complex FFT is used.
+                             If None, the complex FFT on the grid (2*Nx-1, 2*Ny-1, 2*Nz-1) is used.
+        :return: array (2*Nx-1, 2*Ny-1, 2*Nz-1) or (Mx, My, Mz//2 + 1)
+        """
+        Nx, Ny, Nz = shape
+        Mx, My, Mz = padded_shape if padded_shape is not None else (2*Nx-1, 2*Ny-1, 2*Nz-1)
+        K1 = self.sym_kernel(shape, steps)
+        K2 = np.zeros((Mx, My, Mz))
+        K2[0:Nx, 0:Ny, 0:Nz] = K1
+        K2[0:Nx, 0:Ny, Mz-Nz+1:Mz] = K2[0:Nx, 0:Ny, Nz-1:0:-1] #z-mirror
+        K2[0:Nx, My-Ny+1:My,:] = K2[0:Nx, Ny-1:0:-1, :]        #y-mirror
+        K2[Mx-Nx+1:Mx, :, :] = K2[Nx-1:0:-1, :, :]             #x-mirror
+        if padded_shape is not None:
+            return np.real(rfftn(K2))
+        return np.real(fftn(K2))
+
+    def snap_steps(self, steps):
+        """
+        Increases the mesh steps hy and hz so that the ratios hy/hx and hz/hx are on a logarithmic grid
+        with the relative spacing self.kernel_rtol. Then the cached kernel can be reused.
+
+        :param steps: mesh steps [hx, hy, hz]
+        :return: mesh steps
+        """
+        if self.kernel_rtol <= 0:
+            return steps
+        log_q = np.log1p(self.kernel_rtol)
+        ratios = steps[1:] / steps[0]
+        steps[1:] = steps[0] * np.exp(np.ceil(np.log(ratios) / log_q) * log_q)
+        return steps
+
     def potential(self, q, steps):
         hx = steps[0]
         hy = steps[1]
@@ -139,71 +503,126 @@ class SpaceCharge(PhysProc):
         Nx = q.shape[0]
         Ny = q.shape[1]
         Nz = q.shape[2]
-        out = np.zeros((2*Nx-1, 2*Ny-1, 2*Nz-1))
-        out[:Nx, :Ny, :Nz] = q
-        K1 = self.sym_kernel(q.shape, steps)
-        K2 = np.zeros((2*Nx-1, 2*Ny-1, 2*Nz-1))
-        K2[0:Nx, 0:Ny, 0:Nz] = K1
-        K2[0:Nx, 0:Ny, Nz:2*Nz-1] = K2[0:Nx, 0:Ny, Nz-1:0:-1] #z-mirror
-        K2[0:Nx, Ny:2*Ny-1,:] = K2[0:Nx, Ny-1:0:-1, :]        #y-mirror
-        K2[Nx:2*Nx-1, :, :] = K2[Nx-1:0:-1, :, :]             #x-mirror
+        if self.solver == "rfft":
+            padded_shape = tuple(next_fast_len(2 * n - 1, real=True) for n in q.shape)
+        else:
+            padded_shape = None
+        K2_fft = self.kernel_cache.get_kernel_fft(q.shape, steps, self.kernel_fft, padded_shape)
         t0 = time.time()
         if pyfftw_flag:
-            nthreads = int(conf.OCELOT_NUM_THREADS)
-            if nthreads < 1:
-                nthreads = 1
-            K2_fft = pyfftw.builders.fftn(K2, axes=None, overwrite_input=False, planner_effort='FFTW_ESTIMATE',
-                                       threads=nthreads, auto_align_input=False, auto_contiguous=False, avoid_copy=True)
-            out_fft = pyfftw.builders.fftn(out, axes=None, overwrite_input=False, planner_effort='FFTW_ESTIMATE',
-                                          threads=nthreads, auto_align_input=False, auto_contiguous=False, avoid_copy=True)
-            out_ifft = pyfftw.builders.ifftn(out_fft()*K2_fft(), axes=None, overwrite_input=False, planner_effort='FFTW_ESTIMATE',
-                                          threads=nthreads, auto_align_input=False, auto_contiguous=False, avoid_copy=True)
-            out = np.real(out_ifft())
-
+            out, fft_forward, fft_backward = self.kernel_cache.get_fftw_plans(padded_shape if padded_shape else K2_fft.shape,
+                                                                              real=padded_shape is not None)
+            out[:] = 0.
+            out[:Nx, :Ny, :Nz] = q
+            out_fft = fft_forward()
+            out_fft *= K2_fft
+            out = np.real(fft_backward())
+            fft_nbytes = out.nbytes + out_fft.nbytes
+        elif padded_shape is not None:
+            out_fft = rfftn(q, padded_shape)
+            out_fft *= K2_fft
+            out = irfftn(out_fft, padded_shape)
+            fft_nbytes = out.nbytes + out_fft.nbytes
         else:
-            out = np.real(ifftn(fftn(out)*fftn(K2)))
+            out = np.zeros((2*Nx-1, 2*Ny-1, 2*Nz-1))
+            out[:Nx, :Ny, :Nz] = q
+            out_fft = fftn(out)
+            out = np.real(ifftn(out_fft*K2_fft))
+            fft_nbytes = 2 * out_fft.nbytes + out.nbytes
         t1 = time.time()
         logger.debug('fft time:' + str(t1-t0) + ' sec')
-        out[:Nx, :Ny, :Nz] = out[:Nx,:Ny,:Nz]/(4*pi*epsilon_0*hx*hy*hz)
-        return out[:Nx, :Ny, :Nz]
+        self.solve_stats["fft_time"] = t1 - t0
+        self.solve_stats["memory"] = q.nbytes + K2_fft.nbytes + fft_nbytes
+        return out[:Nx, :Ny, :Nz]/(4*pi*epsilon_0*hx*hy*hz)
 
     def el_field(self, X, Q, gamma, nxyz):
-        N = X.shape[0]
+        t0 = time.time()
         X[:, 2] = X[:, 2] * gamma
-        XX = np.max(X, axis=0) - np.min(X, axis=0)
+        halo = None
+        comm = self.comm
+        if self.mesh_percentile is not None and comm is not None:
+            logger.warning("SpaceCharge: mesh_percentile is not supported for the distributed ParticleArray")
+        elif self.mesh_percentile is not None:
+            X_lo, X_hi = np.percentile(X, [self.mesh_percentile, 100 - self.mesh_percentile], axis=0)
+            margin = (X_hi - X_lo) * self.mesh_margin
+            X_lo, X_hi = X_lo - margin, X_hi + margin
+            core = np.all((X >= X_lo) & (X <= X_hi), axis=1)
+            if not np.all(core):
+                halo = np.invert(core)
+        if comm is None:
+            # the mesh is defined by the core particles
+            X_core = X if halo is None else X[core]
+            XX = np.max(X_core, axis=0) - np.min(X_core, axis=0)
+        else:
+            XX = comm.max(X, axis=0) - comm.min(X, axis=0)
         if self.random_mesh:
-            XX = XX * np.random.uniform(low=1, high=1.1)
+            XX = XX * (np.random.uniform(low=1, high=1.1) if comm is None
+                       else comm.bcast(np.random.uniform(low=1, high=1.1)))
         logger.debug('mesh steps:' + str(XX))
         # here we use a fast 3D "near-point" interpolation
         # we need a stand-alone module with 1D,2D,3D parricles-to-grid functions
-        steps = XX / (nxyz - 3)
+        steps = self.snap_steps(XX / (nxyz - 3))
         X = X / steps
-        X_min = np.min(X, axis=0)
-        X_mid = np.dot(Q, X) / np.sum(Q)
+        if comm is None:
+            X_min = np.min(X if halo is None else X[core], axis=0)
+            X_mid = np.dot(Q, X) / np.sum(Q)
+        else:
+            X_min = comm.min(X, axis=0)
+            X_mid = comm.allreduce(np.dot(Q, X)) / comm.sum(Q)
         X_off = np.floor(X_min - X_mid) + X_mid
         if self.random_mesh:
-            X_off = X_off + np.random.uniform(low=-0.5, high=0.5)
+            X_off = X_off + (np.random.uniform(low=-0.5, high=0.5) if comm is None
+                             else comm.bcast(np.random.uniform(low=-0.5, high=0.5)))
         X = X - X_off
+        X_dep, Q_dep = (X, Q) if halo is None else (X[core], Q[core])
         nx = nxyz[0]
         ny = nxyz[1]
         nz = nxyz[2]
-        nzny = nz * ny
-        Xi = np.int_(np.floor(X) + 1)
-        inds = np.int_(Xi[:, 0] * nzny + Xi[:, 1] * nz + Xi[:, 2])  # 3d -> 1d
-        q = np.bincount(inds, Q, nzny * nx).reshape(nxyz)
+        order = DEPOSITION_ORDERS[self.deposition.lower()]
+        if order == 0:
+            nzny = nz * ny
+            Xi = np.int_(np.floor(X_dep) + 1)
+            inds = np.int_(Xi[:, 0] * nzny + Xi[:, 1] * nz + Xi[:, 2])  # 3d -> 1d
+            q = np.bincount(inds, Q_dep, nzny * nx).reshape(nxyz)
+        else:
+            # grid node i is at X = i - 0.5
+            q = deposit_charge(X_dep + 0.5, Q_dep, nxyz, order)
+        if comm is not None:
+            # every rank solves the Poisson equation for the global charge grid
+            q = comm.allreduce(q)
         p = self.potential(q, steps)
-        Ex = np.zeros(p.shape)
-        Ey = np.zeros(p.shape)
-        Ez = np.zeros(p.shape)
-        Ex[:nx - 1, :, :] = (p[:nx - 1, :, :] - p[1:nx, :, :]) / steps[0]
-        Ey[:, :ny - 1, :] = (p[:, :ny - 1, :] - p[:, 1:ny, :]) / steps[1]
-        Ez[:, :, :nz - 1] = (p[:, :, :nz - 1] - p[:, :, 1:nz]) / steps[2]
-        Exyz = np.zeros((N, 3))
-        Exyz[:, 0] = ndimage.map_coordinates(Ex, np.c_[X[:, 0], X[:, 1] + 0.5, X[:, 2] + 0.5].T, order=1) * gamma
-        Exyz[:, 1] = ndimage.map_coordinates(Ey, np.c_[X[:, 0] + 0.5, X[:, 1], X[:, 2] + 0.5].T, order=1) * gamma
-        Exyz[:, 2] = ndimage.map_coordinates(Ez, np.c_[X[:, 0] + 0.5, X[:, 1] + 0.5, X[:, 2]].T, order=1)
+        if halo is None:
+            Exyz = gather_field(X + 0.5, p, steps, order)
+        else:
+            Exyz = np.zeros((len(halo), 3))
+            Exyz[core] = gather_field(X_dep + 0.5, p, steps, order)
+            X = (X + X_off) * steps
+            Exyz[halo] = self.monopole_field(X[halo], X, Q)
+            # field of the halo charges at the core center of charge
+            X_c = np.dot(Q_dep, X[core]) / np.sum(Q_dep)
+            R = X_c - X[halo]
+            r3 = np.sum(R * R, axis=1) ** 1.5
+            Exyz[core] += np.dot(Q[halo] / r3, R) / (4 * pi * epsilon_0)
+        Exyz[:, 0:2] *= gamma
+        self.solve_stats["time"] = time.time() - t0
+        self.solve_stats["n_halo"] = 0 if halo is None else int(np.sum(halo))
+        logger.debug('space charge field: ' + str(self.solve_stats))
         return Exyz
 
+    def monopole_field(self, X, X_core, Q_core):
+        """
+        Electric field of the charges approximated by the point charge in their center of charge.
+
+        :param X: array (N, 3), positions where the field is calculated
+        :param X_core: array (M, 3), positions of the charges
+        :param Q_core: array (M, ), charges
+        :return: array (N, 3)
+        """
+        Q_tot = np.sum(Q_core)
+        X_c = np.dot(Q_core, X_core) / Q_tot
+        R = X - X_c
+        r3 = np.sum(R * R, axis=1) ** 1.5
+        return Q_tot / (4 * pi * epsilon_0) * R / r3[:, np.newaxis]
 
     def apply(self, p_array, zstep):
         logger.debug(" apply: zstep = " + str(zstep))
@@ -221,7 +640,7 @@ class SpaceCharge(PhysProc):
         xp = xxstg_2_xp_mad(p_array.rparticles, xp, gamref)
 
         # coordinate transformation to the velocity direction
-        t3 = np.mean(xp[3:6], axis=1)
+        t3 = np.mean(xp[3:6], axis=1) if self.comm is None else self.comm.mean(xp[3:6], axis=1)
         Pav = np.linalg.norm(t3)
         t3 = t3 / Pav
         ey = np.array([0, 1, 0])
@@ -255,7 +674,169 @@ class SpaceCharge(PhysProc):
         step = self.step
         nmesh_xyz = self.nmesh_xyz
         random_mesh = self.random_mesh
-        return f"<{cname}: {step=}, {nmesh_xyz=}, {random_mesh=}>"
+        deposition = self.deposition
+        return f"<{cname}: {step=}, {nmesh_xyz=}, {random_mesh=}, {deposition=}>"
+
+
+class SpaceChargeRZ(SpaceCharge):
+    """
+    Space Charge physics process for the round beams. Cheap alternative to the 3D SpaceCharge.
+
+    Attributes:
+        self.step = 1 [in Navigator.unit_step] - step of the Space Charge kick applying
+        self.nmesh_rz = [32, 64] - r-z mesh
+        self.asymmetry_tol = 0.1 - if the transverse asymmetry of the bunch 1 - sqrt(lambda_min/lambda_max),
+                                   where lambda are eigenvalues of the transverse covariance matrix, exceeds the
+                                   tolerance, the 3D solver of SpaceCharge with self.nmesh_xyz is used
+        self.rz_kernel_rtol = 0.03 - the longitudinal step is increased (not more than by factor 1 + rz_kernel_rtol)
+                                     to the nearest ratio hz/hr from a logarithmic grid, so the cached kernels
+                                     are reused (see SpaceCharge.snap_steps)
+        self.n_3d - number of kicks calculated with the 3D solver
+
+    Description:
+        The charge is deposited on the r-z grid around the transverse center of the bunch in the bunch frame.
+    The potential is the sum of the potentials of the charged rings of all cells. The ring Green's function
+    is averaged over the source cell with the Gauss-Legendre quadrature and convolved in z with the FFT
+    (open boundary conditions). The kick is applied in the same way as in SpaceCharge.
+
+    The Green's function scales as 1/hr, so the kernels are calculated for hr = 1 and cached with the key
+    (nr, nz, hz/hr) in SpaceChargeRZ.rz_kernel_cache (GreenFunctionCache), which is shared by all instances.
+    The snapping of hz/hr to the logarithmic grid lets the bunches with slowly changing aspect ratio reuse
+    the kernels.
+    """
+    rz_kernel_cache = GreenFunctionCache(maxsize=16)
+
+    def __init__(self, step=1, **kwargs):
+        SpaceCharge.__init__(self, step, **kwargs)
+        self.nmesh_rz = kwargs.get("nmesh_rz", [32, 64])
+        self.asymmetry_tol = kwargs.get("asymmetry_tol", 0.1)
+        self.rz_kernel_rtol = kwargs.get("rz_kernel_rtol", 0.03)
+        self.nquad = 4  # number of the quadrature points in r and z for the cell averaged Green's function
+        self.n_3d = 0
+
+    def ring_kernel_fft(self, nr, nz, hz):
+        """
+        FFT in z of the ring Green's function averaged over source cells, for the radial step hr = 1.
+        Observation points are in the cell centers. Green's function scales as 1/hr.
+        The z integral is calculated with the substitution z = d*sinh(u), d = |r - r'|,
+        which removes the peak of the integrand for the long cells (hz >> hr).
+
+        :param nr: number of radial cells
+        :param nz: number of longitudinal cells
+        :param hz: longitudinal step in units of the radial step
+        :return: array (nr, nr, nz_pad//2 + 1), nz_pad
+        """
+        cache = self.rz_kernel_cache
+        key = (nr, nz, self.nquad, float("%.12g" % hz))
+        kernel = cache.kernels.get(key)
+        if kernel is not None:
+            cache.hits += 1
+            cache.kernels.move_to_end(key)
+            return kernel
+        cache.misses += 1
+        nz_pad = next_fast_len(2 * nz - 1, real=True)
+        t_r, w_r = np.polynomial.legendre.leggauss(self.nquad)
+        # the kernel is even in z, it is calculated for m >= 0 and mirrored.
+        # 2*nquad points of the z quadrature for the nearest cells, 2 points are enough for the far cells
+        m_near = min(nz, 4)
+        quads = [(np.arange(m_near), np.polynomial.legendre.leggauss(2 * self.nquad)),
+                 (np.arange(m_near, nz), np.polynomial.legendre.leggauss(2))]
+        # axes: observation cell, source cell, z cell, source point in r, quadrature point in z
+        r = (np.arange(nr) + 0.5)[:, None, None, None, None]
+        # source points within the cells and weights ~ r' (uniform volume density)
+        r_src = np.arange(nr)[:, None] + 0.5 + 0.5 * t_r
+        w_src = w_r * r_src / np.sum(w_r * r_src, axis=1)[:, None]
+        r_src = r_src[None, :, None, :, None]
+        d = np.abs(r - r_src)
+        G = np.zeros((nr, nr, nz_pad))
+        for m, (t_z, w_z) in quads:
+            m = m[None, None, :, None, None]
+            u1 = np.arcsinh((m - 0.5) * hz / d)
+            u2 = np.arcsinh((m + 0.5) * hz / d)
+            u = 0.5 * (u1 + u2) + 0.5 * (u2 - u1) * t_z
+            z = d * np.sinh(u)
+            d2 = (r + r_src) ** 2 + z ** 2
+            f = 2. / pi * ellipk(4 * r * r_src / d2) / np.sqrt(d2) * d * np.cosh(u)
+            # average over the source cell: sum over u quadrature, divide by hz
+            f = np.dot(f, w_z) * 0.5 * (u2 - u1)[..., 0] / hz
+            G[:, :, m[0, 0, :, 0, 0]] = np.einsum("ijmk,jk->ijm", f, w_src)
+        G[:, :, nz_pad - nz + 1:] = G[:, :, nz - 1:0:-1]
+        G /= (4 * pi * epsilon_0)
+        G_fft = np.fft.rfft(G, axis=2)
+        cache._put(cache.kernels, key, (G_fft, nz_pad))
+        return G_fft, nz_pad
+
+    def asymmetry(self, X, Q):
+        """
+        Transverse asymmetry of the bunch 1 - sqrt(lambda_min/lambda_max), where lambda are eigenvalues
+        of the transverse covariance matrix. 0 for a round bunch.
+        """
+        q_sum = np.sum(Q)
+        dx = X[:, 0] - np.dot(Q, X[:, 0]) / q_sum
+        dy = X[:, 1] - np.dot(Q, X[:, 1]) / q_sum
+        q_dx = Q * dx
+        cxy = np.dot(q_dx, dy)
+        cov = np.array([[np.dot(q_dx, dx), cxy], [cxy, np.dot(Q * dy, dy)]]) / q_sum
+        lambdas = np.linalg.eigvalsh(cov)
+        if lambdas[1] <= 0:
+            return 0.
+        return 1. - np.sqrt(max(lambdas[0], 0.) / lambdas[1])
+
+    def el_field(self, X, Q, gamma, nxyz):
+        # the r-z solver works only with the whole bunch on one process
+        if self.comm is not None or self.asymmetry(X, Q) > self.asymmetry_tol:
+            self.n_3d += 1
+            return SpaceCharge.el_field(self, X, Q, gamma, nxyz)
+        t0 = time.time()
+        nr, nz = self.nmesh_rz
+        X[:, 2] = X[:, 2] * gamma
+        xy_c = np.dot(Q, X[:, 0:2]) / np.sum(Q)
+        dx = X[:, 0] - xy_c[0]
+        dy = X[:, 1] - xy_c[1]
+        r = np.sqrt(dx * dx + dy * dy)
+        z = X[:, 2]
+        hr = np.max(r) / (nr - 1)
+        z_min = np.min(z)
+        hz = (np.max(z) - z_min) / (nz - 1)
+        if self.rz_kernel_rtol > 0:
+            log_q = np.log1p(self.rz_kernel_rtol)
+            hz = hr * np.exp(np.ceil(np.log(hz / hr) / log_q) * log_q)
+        z0 = z_min - 0.5 * hz
+        ir = np.int_(r / hr)
+        iz = np.int_((z - z0) / hz)
+        q = np.bincount(ir * nz + iz, Q, nr * nz).reshape(nr, nz)
+
+        G_fft, nz_pad = self.ring_kernel_fft(nr, nz, hz / hr)
+        q_fft = np.fft.rfft(q, nz_pad, axis=1)
+        phi = np.fft.irfft(np.einsum("ijk,jk->ik", G_fft, q_fft), nz_pad, axis=1)[:, :nz] / hr
+
+        r_grid = (np.arange(nr) + 0.5) * hr
+        Er_r = -np.gradient(phi, hr, axis=0) / r_grid[:, None]
+        Ez = -np.gradient(phi, hz, axis=1)
+        # bilinear interpolation from the cell centers, the field is constant out of the grid
+        cr = np.clip(r / hr - 0.5, 0, nr - 1)
+        cz = np.clip((z - z0) / hz - 0.5, 0, nz - 1)
+        ir = np.minimum(np.int_(cr), nr - 2)
+        iz = np.minimum(np.int_(cz), nz - 2)
+        tr = cr - ir
+        tz = cz - iz
+        k = ir * nz + iz
+        Exyz = np.zeros((X.shape[0], 3))
+        for i, F in [(0, Er_r), (2, Ez)]:
+            F = F.ravel()
+            Exyz[:, i] = (F[k] * (1 - tz) + F[k + 1] * tz) * (1 - tr) + (F[k + nz] * (1 - tz) + F[k + nz + 1] * tz) * tr
+        Exyz[:, 1] = Exyz[:, 0] * dy * gamma
+        Exyz[:, 0] *= dx * gamma
+        self.solve_stats["time"] = time.time() - t0
+        logger.debug('space charge rz field: ' + str(self.solve_stats))
+        return Exyz
+
+    def __repr__(self) -> str:
+        cname = type(self).__name__
+        step = self.step
+        nmesh_rz = self.nmesh_rz
+        asymmetry_tol = self.asymmetry_tol
+        return f"<{cname}: {step=}, {nmesh_rz=}, {asymmetry_tol=}>"
 
 
 class LSC(PhysProc):
@@ -290,6 +871,9 @@ class LSC(PhysProc):
     -----------
     [1] Geloni et al., NIM A 578 (2007) 34-46. https://arxiv.org/abs/physics/0612077
     """
+    # only the momenta are kicked, see PhysProc.changes_coordinates
+    changes_coordinates = False
+
     def __init__(self, step=1, **kwargs):
         PhysProc.__init__(self, step)
         self.step_profile = kwargs.get("step_profile", False)
@@ -557,32 +1141,43 @@ class LSC(PhysProc):
 
         logger.debug(" LSC applied, dz =" + str(dz))
         tau = p_array.tau()
-        mean_tau = np.mean(tau)
-        sigma_tau = np.std(tau)
+        comm = self.comm
+        if comm is None:
+            mean_tau, sigma_tau = self.projection(("tau_mean_std",), lambda: (np.mean(tau), np.std(tau)))
+        else:
+            mean_tau, sigma_tau = self.projection(("tau_mean_std",), lambda: (comm.mean(tau), comm.std(tau)))
 
         slice_min = mean_tau + sigma_tau * self.bounds[0]
         slice_max = mean_tau + sigma_tau * self.bounds[1]
 
         indx = np.where((tau >= slice_min) & (tau < slice_max))
 
-        if self.step_profile:
+        if comm is not None:
+            x_sl = p_array.x()[indx]
+            y_sl = p_array.y()[indx]
+            if self.step_profile:
+                sigma = min(comm.max(x_sl) - comm.min(x_sl), comm.max(y_sl) - comm.min(y_sl)) / 2
+            else:
+                sigma = (comm.std(x_sl) + comm.std(y_sl)) / 2.
+        elif self.step_profile:
             rb = min(np.max(p_array.x()[indx]) - np.min(p_array.x()[indx]),
                      np.max(p_array.y()[indx]) - np.min(p_array.y()[indx]))/2
             sigma = rb
         else:
             sigma = (np.std(p_array.x()[indx]) + np.std(p_array.y()[indx]))/2.
             # sigma = min(np.std(p_array.x()[indx]), np.std(p_array.y()[indx]))
-        q = np.sum(p_array.q_array)
+        q = np.sum(p_array.q_array) if comm is None else comm.sum(p_array.q_array)
         gamma = p_array.E / m_e_GeV
         v = np.sqrt(1 - 1 / gamma ** 2) * speed_of_light
-        B = s_to_cur(p_array.tau(), sigma_tau * self.smooth_param, q, v)
+        B = self.projection(("s_to_cur", self.smooth_param, v),
+                            lambda: s_to_cur(tau, sigma_tau * self.smooth_param, q, v, comm=comm))
         bunch = B[:, 1] / (q * speed_of_light)
         x = B[:, 0]
 
         W = - self.wake_lsc(x, bunch, gamma, sigma, dz, K_max, fill_factor) * q
 
-        indx = np.argsort(p_array.tau(), kind="quicksort")
-        tau_sort = p_array.tau()[indx]
+        indx = self.projection(("argsort", "tau"), lambda: np.argsort(tau, kind="quicksort"))
+        tau_sort = tau[indx]
         dE = np.interp(tau_sort, x, W)
 
         pc_ref = np.sqrt(p_array.E ** 2 / m_e_GeV ** 2 - 1) * m_e_GeV
@@ -151,6 +151,7 @@ def transfer_maps_mult_full_py(Ba, Ra, Ta, Bb, Rb, Tb):
 
 
 transfer_maps_mult = transfer_maps_mult_py if nb_flag is not True else nb.jit(transfer_maps_mult_py, nopython=True)
+transfer_maps_mult_full = transfer_maps_mult_full_py if nb_flag is not True else nb.jit(transfer_maps_mult_full_py, nopython=True)
 
 
 def transfer_map_rotation(R, T, tilt):
@@ -6,8 +6,9 @@ import os
 from dataclasses import dataclass, astuple
 import copy
 import logging
-from time import time
+from time import time, perf_counter
 import multiprocessing as mp
+from multiprocessing import shared_memory
 from typing import Union, List, Tuple, Optional, Any, Iterable
 
 from scipy.stats import truncnorm
@@ -20,8 +21,9 @@ from ocelot.cpbd.beam import *
 from ocelot.cpbd.errors import *
 from ocelot.cpbd.elements import *
 from ocelot.cpbd.io import is_an_mpi_process, ParameterScanFile
-from ocelot.cpbd.physics_proc import CopyBeam
+from ocelot.cpbd.physics_proc import CopyBeam, BeamProjections
 from ocelot.cpbd.navi import Navigator
+from ocelot.cpbd.ring_tracking import RingTracker, naff_tune
 
 _logger = logging.getLogger(__name__)
 
@@ -149,34 +151,60 @@ def harmonic_position(data1D, nu = None, diap = 0.1, nearest = False):
     return nearest_nu
 
 
-def freq_analysis(track_list, lat, nturns, harm=True, diap=0.10, nearest=False, nsuperperiods=1):
-
-    def beta_freq(lat):
+def beta_freq(lat, nsuperperiods=1):
+    """
+    fractional parts of the linear tunes folded into [0, 0.5]
+    """
+    tws = twiss(lat, Twiss())
+    nux = tws[-1].mux/2./pi*nsuperperiods
+    nuy = tws[-1].muy/2./pi*nsuperperiods
+    print ("freq. analysis: Qx = ", nux, " Qy = ", nuy)
+    nux = abs(int(nux+0.5) - nux)
+    nuy = abs(int(nuy+0.5) - nuy)
+    print("freq. analysis: nux = ", nux)
+    print("freq. analysis: nuy = ", nuy)
+    return nux, nuy
+
+
+def freq_analysis(track_list, lat, nturns, harm=True, diap=0.10, nearest=False, nsuperperiods=1, method="naff"):
+    """
+    Tunes of the particles which survived nturns (pxy.mux, pxy.muy in [0, 0.5]) from the saved turn-by-turn
+    coordinates (see track_nturns with save_track=True).
 
-        tws = twiss(lat, Twiss())
-        nux = tws[-1].mux/2./pi*nsuperperiods
-        nuy = tws[-1].muy/2./pi*nsuperperiods
-        print ("freq. analysis: Qx = ", nux, " Qy = ", nuy)
-        nux = abs(int(nux+0.5) - nux)
-        nuy = abs(int(nuy+0.5) - nuy)
-        print("freq. analysis: nux = ", nux)
-        print("freq. analysis: nuy = ", nuy)
-        return nux, nuy
+    :param track_list: list of Track_info
+    :param lat: MagneticLattice
+    :param nturns: number of turns
+    :param harm: search the tunes near the linear tunes, otherwise the highest peak of the spectrum is taken
+                 which can be a line of the coupled motion, e.g. nux + nuy
+    :param diap: range of the search around the linear tunes
+    :param nearest: take the harmonic nearest to the linear tunes
+    :param nsuperperiods: number of superperiods
+    :param method: "naff" - NAFF for all particles at once (see naff_tune), "fft" - peak of the FFT spectrum
+    :return: track_list
+    """
+    stable = [pxy for pxy in track_list if pxy.turn == nturns - 1]
+    if len(stable) > 0 and len(stable[0].p_list) == 1:
+        print ("For frequency analysis coordinates are needed for each turns. Check tracking option 'save_track' must be True ")
+        return track_list
 
     nux, nuy = None, None
     if harm is True:
-        nux, nuy = beta_freq(lat)
-    #fma(pxy_list, nux = nux, nuy = nuy)
-    for n, pxy in enumerate(track_list):
-        if pxy.turn == nturns-1:
-            if len(pxy.p_list) == 1:
-                #print len(pxy.p_list)
-                print ("For frequency analysis coordinates are needed for each turns. Check tracking option 'save_track' must be True ")
-                return track_list
-            x = [p[0] for p in pxy.p_list]
-            y = [p[2] for p in pxy.p_list]
-            pxy.mux = harmonic_position(x, nux, diap, nearest)
-            pxy.muy = harmonic_position(y, nuy, diap, nearest)
+        nux, nuy = beta_freq(lat, nsuperperiods)
+
+    if method == "naff":
+        if len(stable) > 0:
+            p_lists = np.array([pxy.p_list for pxy in stable])
+            mux = naff_tune(p_lists[:, :, 0], nu0=nux, diap=diap, nearest=nearest)
+            muy = naff_tune(p_lists[:, :, 2], nu0=nuy, diap=diap, nearest=nearest)
+            for pxy, mux_i, muy_i in zip(stable, mux, muy):
+                pxy.mux, pxy.muy = mux_i, muy_i
+        return track_list
+
+    for pxy in stable:
+        x = [p[0] for p in pxy.p_list]
+        y = [p[2] for p in pxy.p_list]
+        pxy.mux = harmonic_position(x, nux, diap, nearest)
+        pxy.muy = harmonic_position(y, nuy, diap, nearest)
 
     return track_list
 
@@ -285,28 +313,33 @@ def ellipse_track_list(beam, n_t_sigma = 3, num = 1000, type = "contour"):
 
 
 def track_nturns(lat, nturns, track_list, nsuperperiods=1, save_track=True, print_progress=True):
-    xlim, ylim, px_lim, py_lim = aperture_limit(lat, xlim = 1, ylim = 1)
-    navi = Navigator(lat)
-
-    t_maps = navi.get_map(lat.totalLen)
-    track_list_const = copy.copy(track_list)
+    """
+    Tracking of the particles from track_list through nturns (see RingTracker). After tracking pxy.turn is the last
+    turn which the particle survived and, if save_track, pxy.p_list contains the coordinates after every turn.
+
+    :param lat: MagneticLattice of one superperiod
+    :param nturns: number of turns
+    :param track_list: list of Track_info
+    :param nsuperperiods: number of superperiods
+    :param save_track: save the coordinates of the particles after every turn
+    :param print_progress: print the turn number
+    :return: np.array of Track_info
+    """
+    tracker = RingTracker(lat, nsuperperiods=nsuperperiods, aperture=aperture_limit(lat, xlim=1, ylim=1),
+                          record_step=1 if save_track else 0)
     p_array = ParticleArray()
-    p_list = [p.particle for p in track_list]
-    p_array.list2array(p_list)
+    p_array.list2array([pxy.particle for pxy in track_list])
+    tracker.track(p_array.rparticles, nturns, energy=p_array.E, print_progress=print_progress)
+    if save_track:
+        _, record = tracker.get_record()
 
-    for i in range(nturns):
-        if print_progress: print(i)
-        for n in range(nsuperperiods):
-            for tm in t_maps:
-                tm.apply(p_array)
-            p_indx = p_array.rm_tails(xlim, ylim, px_lim, py_lim)
-
-            track_list = np.delete(track_list, p_indx)
-        for n, pxy in enumerate(track_list):
-            pxy.turn = i
-            if save_track:
-                pxy.p_list.append(p_array.rparticles[:, n].tolist())
-    return np.array(track_list_const)
+    for n, pxy in enumerate(track_list):
+        loss_turn = tracker.loss_turn[n]
+        pxy.turn = int(max(nturns - 1 if loss_turn < 0 else loss_turn - 1, 0))
+        if save_track:
+            nrecords = nturns + 1 if loss_turn < 0 else loss_turn + 1
+            pxy.p_list += record[1:nrecords, :, n].tolist()
+    return np.array(track_list)
 
 
 def track_nturns_mpi(mpi_comm, lat, nturns, track_list, errors=None, nsuperperiods=1, save_track=True):
@@ -368,21 +401,48 @@ def track_nturns_mpi(mpi_comm, lat, nturns, track_list, errors=None, nsuperperio
         return track_list
 
 
-def fma(lat, nturns, x_array, y_array, nsuperperiods = 1):
+def fma(lat, nturns, x_array, y_array, nsuperperiods=1, return_diffusion=False):
+    """
+    Frequency map analysis. The particles are distributed over the MPI processes, tracked with RingTracker and
+    their tunes are found with NAFF around the linear tunes (see RingTracker.frequency_map).
+
+    :param lat: MagneticLattice of one superperiod
+    :param nturns: number of turns
+    :param x_array: initial horizontal coordinates
+    :param y_array: initial vertical coordinates
+    :param nsuperperiods: number of superperiods
+    :param return_diffusion: return also the tune diffusion between the two halves of the tracking,
+                             log10(sqrt(dmux**2 + dmuy**2)), NaN for lost particles
+    :return: ctr_da, mux, muy (and diffusion) - arrays (ny, nx) on the rank 0, mux = muy = -0.001 for lost particles
+    """
     from mpi4py import MPI
     mpi_comm = MPI.COMM_WORLD
+    size = mpi_comm.Get_size()
     rank = mpi_comm.Get_rank()
     track_list = create_track_list(x_array, y_array, p_array=[0])
-    track_list = track_nturns_mpi(mpi_comm, lat, nturns, track_list, nsuperperiods=nsuperperiods)
+    chunk = [track_list[i] for i in np.array_split(np.arange(len(track_list)), size)[rank]]
+
+    p_array = ParticleArray()
+    p_array.list2array([pxy.particle for pxy in chunk])
+    tracker = RingTracker(lat, nsuperperiods=nsuperperiods, aperture=aperture_limit(lat, xlim=1, ylim=1),
+                          record_step=1)
+    tracker.track(p_array.rparticles, nturns, energy=p_array.E)
+    mux, muy, diffusion = tracker.frequency_map(nu0=beta_freq(lat, nsuperperiods), diap=0.1)
+    lost = tracker.loss_turn >= 0
+    mux[lost] = -0.001
+    muy[lost] = -0.001
+    for pxy, loss_turn in zip(chunk, tracker.loss_turn):
+        pxy.turn = int(max(nturns - 1 if loss_turn < 0 else loss_turn - 1, 0))
+    results = mpi_comm.gather(np.array([contour_da(chunk, nturns), mux, muy, diffusion]), root=0)
+
     if rank == 0:
         nx = len(x_array)
         ny = len(y_array)
-        ctr_da = contour_da(track_list, nturns)
-        #ctr_da = tra.countour_da()
-        track_list = freq_analysis(track_list, lat, nturns, harm = True)
-        da_mux = np.array(map(lambda pxy: pxy.mux, track_list))
-        da_muy = np.array(map(lambda pxy: pxy.muy, track_list))
-        return ctr_da.reshape(ny,nx), da_mux.reshape(ny,nx), da_muy.reshape(ny,nx)
+        ctr_da, da_mux, da_muy, diffusion = np.concatenate(results, axis=1).reshape(4, ny, nx)
+        ctr_da = ctr_da.astype(int)
+        if return_diffusion:
+            return ctr_da, da_mux, da_muy, diffusion
+        return ctr_da, da_mux, da_muy
 
 
 def da_mpi(lat, nturns, x_array, y_array, errors=None, nsuperperiods=1):
@@ -394,7 +454,7 @@ def da_mpi(lat, nturns, x_array, y_array, errors=None, nsuperperiods=1):
     track_list = track_nturns_mpi(mpi_comm, lat, nturns, track_list, errors=errors, nsuperperiods=nsuperperiods, save_track=False)
 
     if rank == 0:
-        da = np.array(map(lambda track: track.turn, track_list))#.reshape((len(y_array), len(x_array)))
+        da = np.array([track.turn for track in track_list])
         nx = len(x_array)
         ny = len(y_array)
         return da.reshape(ny, nx)
@@ -416,7 +476,7 @@ def tracking_step(lat, particle_list, dz, navi):
     if navi.z0 + dz > navi.lat.totalLen:
         dz = navi.lat.totalLen - navi.z0
 
-    t_maps = navi.get_map(dz)
+    t_maps = navi.get_map(dz, energy=getattr(particle_list, "E", None))
     for tm in t_maps:
         start = time()
         tm.apply(particle_list)
@@ -425,6 +485,10 @@ def tracking_step(lat, particle_list, dz, navi):
     return
 
 
+def _add_timing(timings, name, start):
+    timings[name] = timings.get(name, 0.) + perf_counter() - start
+
+
 def track(
         lattice,
         p_array,
@@ -437,6 +501,8 @@ def track(
         slice=None,
         twiss_disp_correction=False,
         get_twiss=None,
+        timings=None,
+        comm=None,
         ) -> Tuple[Union[List[Twiss], pd.DataFrame], ParticleArray]:
 
     """
@@ -451,6 +517,10 @@ def track(
     :param slice: str or None, optional. Reference slice when bounds is set. If None, uses mean(tau). If 'Imax', uses maximum current slice.
     :param twiss_disp_correction: bool, optional, If True, estimate and subtract linear dispersion from the statistics of the particle array. Default is False.
     :param get_twiss: function, optional, function for twiss calculation. Default is `get_envelope`
+    :param timings: dict or None, optional. If dict, the wall time [s] spent in every Transformation class,
+                    PhysProc subclass and in the twiss calculation is accumulated in it, e.g. {"SecondTM": 1.2, "CSR": 10.5, ...}
+    :param comm: None or ParticleComm, if p_array is distributed between MPI ranks (see parallel.track_mpi),
+                 the tracking stops when the global number of particles is 0
     :return: twiss_list, ParticleArray. In case calc_tws=False, twiss_list is list of empty Twiss classes.
     """
     if navi is None:
@@ -463,20 +533,40 @@ def track(
     tw0 = get_twiss(p_array, bounds=bounds, slice=slice, auto_disp=twiss_disp_correction) if calc_tws else Twiss()
     tws_track = [tw0]
     L = 0.
+    projections = BeamProjections()
 
-    for t_maps, dz, proc_list, phys_steps in navi.get_next_step():
+    for t_maps, dz, proc_list, phys_steps in navi.get_next_step(p_array):
         for tm in t_maps:
-            tm.apply(p_array)
+            if timings is None:
+                tm.apply(p_array)
+            else:
+                start = perf_counter()
+                tm.apply(p_array)
+                _add_timing(timings, tm.__class__.__name__, start)
             _logger.debug("tracking_step -> tm.class: %s  l = %s", tm.__class__.__name__, tm.length)
 
+        projections.invalidate()
         for p, z_step in zip(proc_list, phys_steps):
             p.z0 = navi.z0
-            p.apply(p_array, z_step)
-
-        if p_array.n == 0:
+            p.projections = projections
+            if timings is None:
+                p.apply(p_array, z_step)
+            else:
+                start = perf_counter()
+                p.apply(p_array, z_step)
+                _add_timing(timings, p.__class__.__name__, start)
+            p.projections = None
+            if p.changes_coordinates:
+                projections.invalidate()
+
+        # with MPI all ranks must stop together, otherwise the others hang in the collective reductions
+        if (p_array.n if comm is None else comm.sum(p_array.n)) == 0:
             _logger.debug(" Tracking stop: p_array.n = 0")
             return tws_track, p_array
+        start = perf_counter()
         tw = get_twiss(p_array, bounds=bounds, slice=slice, auto_disp=twiss_disp_correction) if calc_tws else Twiss()
+        if timings is not None and calc_tws:
+            _add_timing(timings, "get_twiss", start)
         L += dz
         tw.s += L
         tws_track.append(tw)
@@ -655,15 +745,29 @@ class ParameterScanner:
             raise ValueError(f"Parameter values len != [parray0]")
         return self.parray0 # Then it is an iterable of ParticleArray instances
 
-    def scan(self, filename: str, nproc: int = 1):
+    def scan(self, filename: str, nproc: int = 1, backend: str = "pickle"):
         """Run the parameter scan, possibly across multiple cores.  MPI is
-        automatically detected if used, where nproc will then have no effect.
+        automatically detected if used, where nproc and backend will then have no effect.
 
 
         :param nproc: Number of processes to spawn.  If set to -1, then spawn a
         number of cores equal to the number of CPUs on this computer.
+        :param backend: "pickle" (default): the prepared navigators and copies of the
+        input ParticleArrays are pickled to the workers and the results are pickled back
+        and written by the main process.  "shared": the input particles are placed in
+        shared memory, the scanner is sent once to each worker, the workers prepare
+        their navigators (prepare_navigator) and write their results directly into the
+        pre-allocated datasets of the output file.
 
         """
+        if backend not in ("pickle", "shared"):
+            raise ValueError(f"Unknown ParameterScanner backend: {backend}")
+
+        if backend == "shared" and not is_an_mpi_process():
+            with ParameterScanFile(filename, "w") as psf:
+                psf.init_from_parameter_scanner(self)
+            self._run_shared(filename, nproc)
+            return
 
         # Map of scanned parameter values to corresponding track arg pack to be
         # run.
@@ -676,6 +780,30 @@ class ParameterScanner:
             else:
                 self._run_pool(args, psf, nproc)
 
+    def _run_shared(self, filename, nproc: int) -> None:
+        if nproc == -1:
+            nproc = min(self.njobs, mp.cpu_count())
+
+        # The same ParticleArray instance is placed only once in shared memory.
+        parray0s = self._prepare_parray0s()
+        shared = {}
+        for parray0 in parray0s:
+            if id(parray0) not in shared:
+                shared[id(parray0)] = SharedParticleArray.from_parray(parray0)
+        shared_parray0s = [shared[id(parray0)] for parray0 in parray0s]
+
+        # Only the scanner without the input particles is sent to the workers.
+        scanner = copy.copy(self)
+        scanner.parray0 = None
+        lock = mp.Lock()
+        try:
+            with mp.Pool(nproc, initializer=_init_shared_scan_worker,
+                         initargs=(scanner, shared_parray0s, str(filename), lock)) as p:
+                p.map(_run_shared_scan_job, range(self.njobs))
+        finally:
+            for sh in shared.values():
+                sh.unlink()
+
     def _run_pool(self, track_payloads: Iterable[TrackPayload], psf, nproc: int) -> None:
         # TODO Better:
         # https://stackoverflow.com/questions/15704010/write-data-to-hdf-file-using-multiprocessing
@@ -778,6 +906,83 @@ class TrackPayload:
         return payload.run_and_get_dumps()
 
 
+@dataclass
+class SharedParticleArray:
+    """ParticleArray with rparticles and q_array placed in shared memory.
+    Only the names of the shared memory blocks are pickled to the workers."""
+    rparticles_name: str
+    q_array_name: str
+    n: int
+    rparticles_dtype: str
+    q_array_dtype: str
+    E: float
+    s: float
+
+    @classmethod
+    def from_parray(cls, parray: ParticleArray) -> SharedParticleArray:
+        n = parray.rparticles.shape[1]
+        shm_r = shared_memory.SharedMemory(create=True, size=max(1, parray.rparticles.nbytes))
+        shm_q = shared_memory.SharedMemory(create=True, size=max(1, parray.q_array.nbytes))
+        np.ndarray((6, n), dtype=parray.rparticles.dtype, buffer=shm_r.buf)[:] = parray.rparticles
+        np.ndarray(n, dtype=parray.q_array.dtype, buffer=shm_q.buf)[:] = parray.q_array
+        sh = cls(shm_r.name, shm_q.name, n, parray.rparticles.dtype.str, parray.q_array.dtype.str,
+                 parray.E, parray.s)
+        # The creating process keeps the blocks open until unlink().
+        sh._shm = (shm_r, shm_q)
+        return sh
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop("_shm", None)
+        return state
+
+    def to_parray(self) -> ParticleArray:
+        """Return a ParticleArray with a private copy of the shared particles."""
+        parray = ParticleArray(n=self.n)
+        shm_r = shared_memory.SharedMemory(name=self.rparticles_name)
+        shm_q = shared_memory.SharedMemory(name=self.q_array_name)
+        try:
+            parray.rparticles = np.ndarray((6, self.n), dtype=self.rparticles_dtype, buffer=shm_r.buf).copy()
+            parray.q_array = np.ndarray(self.n, dtype=self.q_array_dtype, buffer=shm_q.buf).copy()
+        finally:
+            shm_r.close()
+            shm_q.close()
+        parray.E = self.E
+        parray.s = self.s
+        return parray
+
+    def unlink(self) -> None:
+        for shm in self._shm:
+            shm.close()
+            shm.unlink()
+
+
+_shared_scan_state = None
+
+
+def _init_shared_scan_worker(scanner, shared_parray0s, filename, lock):
+    global _shared_scan_state
+    _shared_scan_state = (scanner, shared_parray0s, filename, lock)
+
+
+def _run_shared_scan_job(job_index):
+    scanner, shared_parray0s, filename, lock = _shared_scan_state
+    parray0 = shared_parray0s[job_index].to_parray()
+    navigator = scanner.prepare_navigator(scanner.parameter_values[job_index], parray0, job_index)
+    scanner._attach_dump_processes_to_markers([navigator])
+    payload = TrackPayload(navigator.lat, parray0.copy(), navigator, job_index=job_index)
+    parray1, dumps = payload.run_and_get_dumps()
+
+    # h5py files can not be written by several processes at the same time
+    with lock:
+        with ParameterScanFile(filename, "r+") as psf:
+            psf.write_parray0(job_index, parray0)
+            psf.write_parray1(job_index, parray1)
+            for dump in dumps:
+                psf.write_parray_marker(job_index, dump.name, dump.parray)
+    return job_index
+
+
 class UnitStepScanner(ParameterScanner):
     """Simple ParameterScanner subclass for scanning the Navigator unit step."""
     def prepare_navigator(self, unit_step: float, _parray0, _job_index) -> Navigator:
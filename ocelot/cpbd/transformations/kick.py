@@ -1,3 +1,5 @@
+import logging
+
 import numpy as np
 
 from ocelot.cpbd.high_order import m_e_GeV
@@ -6,6 +8,158 @@ from ocelot.cpbd.transformations.transfer_map import TransferMap
 from ocelot.cpbd.transformations.transformation import Transformation, TMTypes
 from ocelot.cpbd.elements.element import Element
 
+_logger = logging.getLogger(__name__)
+
+try:
+    import numba as nb
+    nb_flag = True
+except ImportError:
+    _logger.debug("kick.py: module NUMBA is not installed. Install it to speed up calculation")
+    nb_flag = False
+
+_W1 = 1. / (2. - 2. ** (1. / 3.))
+_W0 = 1. - 2. * _W1
+
+# drift and kick coefficients of the symplectic splitting of one slice: drift[0], kick[0], drift[1], ... drift[n]
+KICK_INTEGRATORS = {"leapfrog": (np.array([0.5, 0.5, 0., 0.]), np.array([1., 0., 0.])),
+                    "yoshida4": (np.array([_W1 / 2., (_W0 + _W1) / 2., (_W0 + _W1) / 2., _W1 / 2.]),
+                                 np.array([_W1, _W0, _W1]))}
+
+
+def kick_coefficients(energy):
+    """
+    :param energy: beam energy in [GeV]
+    :return: beta, 1/(beta*gamma)**2 used in the kick map
+    """
+    gamma = energy / m_e_GeV
+    coef = 0.
+    beta = 1.
+    if gamma != 0:
+        gamma2 = gamma * gamma
+        beta = 1. - 0.5 / gamma2
+        coef = 1. / (beta * beta * gamma2)
+    return beta, coef
+
+
+def kick_slices_py(x, ls, angle, k1, k2, k3, beta, coef, nkick, drifts, kicks, nstages):
+    """
+    In-place map of one particle through nkick slices of the length ls, every slice is drift - kick - drift
+    (nstages = 1) or the symplectic splitting with nstages kicks.
+
+    :param x: array (6) of the particle coordinates
+    :param ls: slice length
+    :param angle, k1, k2, k3: integrated strengths of one slice: angle, k1*ls, k2*ls/2, k3*ls/6
+    :param beta, coef: see kick_coefficients()
+    :param nkick: number of slices
+    :param drifts: drift coefficients, see KICK_INTEGRATORS
+    :param kicks: kick coefficients, see KICK_INTEGRATORS
+    :param nstages: number of kicks per slice
+    """
+    dl = ls / 2.
+    for i in range(nkick):
+        for s in range(nstages + 1):
+            x[0] += x[1] * (drifts[s] * ls)
+            x[2] += x[3] * (drifts[s] * ls)
+            if s == nstages:
+                break
+            w = kicks[s]
+            xk, yk = x[0], x[2]
+            re2, im2 = xk * xk - yk * yk, 2. * xk * yk
+            re3, im3 = re2 * xk - im2 * yk, re2 * yk + im2 * xk
+            x[1] -= w * (-angle * x[5] + k1 * xk + k2 * re2 + k3 * re3)
+            x[3] += w * (k1 * yk + k2 * im2 + k3 * im3)
+            x[4] += w * angle * xk / beta
+        x[4] -= x[5] * dl * coef
+
+
+def kick_particles_py(X, dx, dy, tilt, ls, angle, k1, k2, k3, beta, coef, nkick, drifts, kicks, nstages):
+    """
+    In-place kick map of the particles X (6, N) with the misalignment (dx, dy) and the tilt fused into one loop over
+    the particles, see kick_slices_py().
+    """
+    cs, sn = np.cos(tilt), np.sin(tilt)
+    offset = dx != 0 or dy != 0 or tilt != 0
+    for n in _prange(X.shape[1]):
+        x = X[:, n]
+        if offset:
+            a, b = x[0] - dx, x[2] - dy
+            x[0], x[2] = cs * a + sn * b, -sn * a + cs * b
+            a, b = x[1], x[3]
+            x[1], x[3] = cs * a + sn * b, -sn * a + cs * b
+        kick_slices(x, ls, angle, k1, k2, k3, beta, coef, nkick, drifts, kicks, nstages)
+        if offset:
+            a, b = x[0], x[2]
+            x[0], x[2] = cs * a - sn * b + dx, sn * a + cs * b + dy
+            a, b = x[1], x[3]
+            x[1], x[3] = cs * a - sn * b, sn * a + cs * b
+    return X
+
+
+def kick_particles_numpy(X, dx, dy, tilt, ls, angle, k1, k2, k3, beta, coef, nkick, drifts, kicks, nstages):
+    """
+    The same as kick_particles_py() with numpy operations on the rows of X and four work arrays.
+    """
+    if dx != 0 or dy != 0 or tilt != 0:
+        X = transform_vec_ent(X, dx, dy, tilt)
+    x, px, y, py, tau, p = X
+    re2, im2, u, v = np.empty((4, X.shape[1]))
+    dl = ls / 2.
+    for i in range(nkick):
+        for s in range(nstages + 1):
+            np.multiply(px, drifts[s] * ls, out=u)
+            x += u
+            np.multiply(py, drifts[s] * ls, out=u)
+            y += u
+            if s == nstages:
+                break
+            w = kicks[s]
+            np.multiply(x, x, out=re2)
+            np.multiply(y, y, out=u)
+            re2 -= u
+            np.multiply(x, y, out=im2)
+            im2 *= 2.
+            # px: -angle*p + k1*x + k2*re2 + k3*(re2*x - im2*y)
+            np.multiply(re2, x, out=u)
+            np.multiply(im2, y, out=v)
+            u -= v
+            u *= k3
+            np.multiply(re2, k2, out=v)
+            u += v
+            np.multiply(x, k1, out=v)
+            u += v
+            np.multiply(p, angle, out=v)
+            u -= v
+            u *= w
+            px -= u
+            # py: k1*y + k2*im2 + k3*(re2*y + im2*x)
+            np.multiply(re2, y, out=u)
+            np.multiply(im2, x, out=v)
+            u += v
+            u *= k3
+            np.multiply(im2, k2, out=v)
+            u += v
+            np.multiply(y, k1, out=v)
+            u += v
+            u *= w
+            py += u
+            np.multiply(x, w * angle / beta, out=u)
+            tau += u
+        np.multiply(p, dl * coef, out=u)
+        tau -= u
+    if dx != 0 or dy != 0 or tilt != 0:
+        X = transform_vec_ext(X, dx, dy, tilt)
+    return X
+
+
+if nb_flag:
+    _prange = nb.prange
+    kick_slices = nb.njit(kick_slices_py)
+    kick_particles = nb.njit(parallel=True)(kick_particles_py)
+else:
+    _prange = range
+    kick_slices = kick_slices_py
+    kick_particles = kick_particles_numpy
+
 
 class KickTM(Transformation):
     """
@@ -20,12 +174,20 @@ class KickTM(Transformation):
         - `create_kick_exit_params(self) -> KickParams`: Defines the parameters for the exit edge.
 
     Attributes:
-        (Add any attributes here if applicable, e.g., main parameters or edge-related configurations.)
+        nkick (int): number of slices of the element, parameter 'nkick', default 1.
+        integrator (str): splitting of a slice, parameter 'integrator', see KICK_INTEGRATORS:
+            - "leapfrog": drift - kick - drift (default),
+            - "yoshida4": 4th order symplectic splitting (Yoshida) with three kicks, fewer slices are needed
+              for the same accuracy, e.g. elem.set_tm(KickTM, nkick=2, integrator="yoshida4").
     """
     def __init__(self, create_tm_param_func, delta_e_func, tm_type: TMTypes, length: float, delta_length: float = 0.0, **params) -> None:    
         super().__init__(create_tm_param_func, delta_e_func, tm_type, length, delta_length)
         nkick = params.get('nkick')
         self.nkick = nkick if nkick else 1
+        self.integrator = params.get('integrator', "leapfrog")
+        if self.integrator not in KICK_INTEGRATORS:
+            raise ValueError(f"unknown integrator '{self.integrator}', use one of {list(KICK_INTEGRATORS)}")
+        self.nstages = 1 if self.integrator == "leapfrog" else 3
 
     @classmethod
     def from_element(cls, element: Element, tm_type: TMTypes = TMTypes.MAIN, delta_l=None, **params):
@@ -63,59 +225,22 @@ class KickTM(Transformation):
         """
         does not work for dipole
         """
-        gamma = energy / m_e_GeV
-        coef = 0.
-        beta = 1.
-        if gamma != 0:
-            gamma2 = gamma * gamma
-            beta = 1. - 0.5 / gamma2
-            coef = 1. / (beta * beta * gamma2)
-        l = l / nkick
-        angle = angle / nkick
-
-        dl = l / 2.
-        k1 = k1 * l
-        k2 = k2 * l / 2.
-        k3 = k3 * l / 6.
-
-        for i in range(nkick):
-            x = X[0] + X[1] * dl
-            y = X[2] + X[3] * dl
-
-            p = -angle * X[5] + 0j
-            xy1 = x + 1j * y
-            xy2 = xy1 * xy1
-            xy3 = xy2 * xy1
-            p += k1 * xy1 + k2 * xy2 + k3 * xy3
-            X[1] = X[1] - np.real(p)
-            X[3] = X[3] + np.imag(p)
-            X[4] = X[4] + np.real(angle * xy1) / beta - X[5] * dl * coef
-
-            X[0] = x + X[1] * dl
-            X[2] = y + X[3] * dl
-            # X[4] -= X[5] * dl * coef
+        beta, coef = kick_coefficients(energy)
+        drifts, kicks = KICK_INTEGRATORS[self.integrator]
+        ls = l / nkick
+        kick_particles(X, 0., 0., 0., ls, angle / nkick, k1 * ls, k2 * ls / 2., k3 * ls / 6., beta, coef, nkick,
+                       drifts, kicks, self.nstages)
         return X
 
     def kick_apply(self, X, energy):
         params = self.get_params()
-        angle = params.angle
-        k1 = params.k1
-        k2 = params.k2
-        k3 = params.k3
-        tilt = params.tilt
-        
-        dx = params.dx
-        dy = params.dy
-
+        beta, coef = kick_coefficients(energy)
+        drifts, kicks = KICK_INTEGRATORS[self.integrator]
         nkick = self.nkick
         l = self.delta_length if self.delta_length is not None else self.length
-
-        if dx != 0 or dy != 0 or tilt != 0:
-            X = transform_vec_ent(X, dx, dy, tilt)
-        self.kick(X, l, angle, k1, k2, k3, energy, nkick=nkick)
-        if dx != 0 or dy != 0 or tilt != 0:
-            X = transform_vec_ext(X, dx, dy, tilt)
-
+        ls = l / nkick
+        X = kick_particles(X, params.dx, params.dy, params.tilt, ls, params.angle / nkick, params.k1 * ls,
+                           params.k2 * ls / 2., params.k3 * ls / 6., beta, coef, nkick, drifts, kicks, self.nstages)
         return X
 
     def map_function(self, X, energy: float):
@@ -4,7 +4,13 @@ Created on 17.05.2016
 Added wake table WakeTableDechirperOffAxis on 11.2019
 @authors: S. Tomin and I. Zagorodnov
 """
+import os
+import hashlib
+import tempfile
+from collections import OrderedDict
+
 import numpy as np
+from scipy.fft import rfft, irfft, next_fast_len
 
 from ocelot.adaptors import *
 from ocelot.adaptors.astra2ocelot import *
@@ -117,6 +123,38 @@ def wake_convolution(xb, bunch, xw, wake):
     return xW[0:nb], Wake[0:nb]
 
 
+def wake_spectrum(h, nb, xw, wake):
+    """
+    Spectrum of the wake sampled on the equidistant grid, see fft_wake_convolution()
+
+    :param h: grid step
+    :param nb: number of grid points
+    :param xw: coordinates of the tabulated wake
+    :param wake: tabulated wake
+    :return: spectrum, rfft of the zero padded sampled wake
+    """
+    wake1 = np.interp(np.arange(nb) * h, xw, wake, 0, 0)
+    wake1[0] = wake1[0] * 0.5
+    return rfft(wake1, next_fast_len(2 * nb - 1))
+
+
+def fft_wake_convolution(h, bunch, spectrum):
+    """
+    The same as wake_convolution() with the precomputed wake spectrum, O(N log N) instead of O(N^2)
+
+    :param h: grid step of the bunch
+    :param bunch: bunch profile on the equidistant grid
+    :param spectrum: wake_spectrum(h, len(bunch), xw, wake)
+    :return: convolution on the grid of the bunch
+    """
+    nb = bunch.shape[0]
+    nfft = next_fast_len(2 * nb - 1)
+    W = irfft(rfft(bunch, nfft) * spectrum, nfft)[0:nb] * h
+    # the wake is causal, ahead of the bunch it is exactly zero and not the FFT round-off
+    W[0:np.argmax(bunch != 0)] = 0.
+    return W
+
+
 def project_on_grid_py(Ro, I0, dI0, q_array):
     """
     Simple function to project particles charge on grid
@@ -139,7 +177,7 @@ def project_on_grid_py(Ro, I0, dI0, q_array):
 project_on_grid = project_on_grid_py if not nb_flag else nb.jit(project_on_grid_py, nopython=True)
 
 
-def s2current(s_array, q_array, n_points, filter_order, mean_vel):
+def s2current(s_array, q_array, n_points, filter_order, mean_vel, comm=None):
     """
     I = s2current(P0,q,Ns,NF)
     :param s_array: s-vector, coordinates in longitudinal direction
@@ -147,10 +185,15 @@ def s2current(s_array, q_array, n_points, filter_order, mean_vel):
     :param n_points: number of sampling points
     :param filter_order: filter order
     :param mean_vel: mean velocity
+    :param comm: None or ParticleComm, if the particles are distributed between MPI ranks
     :return:
     """
-    s0 = np.min(s_array)
-    s1 = np.max(s_array)
+    if comm is None:
+        s0 = np.min(s_array)
+        s1 = np.max(s_array)
+    else:
+        s0 = float(comm.min(s_array))
+        s1 = float(comm.max(s_array))
     NF2 = int(np.floor(filter_order / 2.))
     n_points = n_points + 2 * NF2
 
@@ -166,6 +209,8 @@ def s2current(s_array, q_array, n_points, filter_order, mean_vel):
     Ro = np.zeros(n_points)
     # with numba project charge on grid
     Ro = project_on_grid(Ro, I0, dI0, q_array)
+    if comm is not None:
+        Ro = comm.allreduce(Ro)
 
     if filter_order > 0:
         triang_filter(Ro, filter_order)
@@ -175,6 +220,47 @@ def s2current(s_array, q_array, n_points, filter_order, mean_vel):
     return I
 
 
+# memo of the calculated wake tables, see cached_wake_tables()
+_wake_tables_memo = OrderedDict()
+WAKE_TABLES_MEMO_SIZE = 64
+
+
+def cached_wake_tables(name, geometry, calculate, cache_dir=None):
+    """
+    Memoization of the analytic wake tables. The tables are kept in memory (the last WAKE_TABLES_MEMO_SIZE geometries)
+    and, if cache_dir is given, in the files in cache_dir, so gap scans reuse the tables calculated before,
+    also in other processes.
+
+    :param name: name of the wake table type, e.g. class name
+    :param geometry: tuple of the parameters which define the tables, e.g. (b, a, width, t, p, length, sigma)
+    :param calculate: function without arguments, returns wake_horz, wake_vert
+    :param cache_dir: None or directory of the on-disk cache
+    :return: wake_horz, wake_vert
+    """
+    key = hashlib.sha1(repr((name, tuple(float(x) for x in geometry))).encode()).hexdigest()
+    tables = _wake_tables_memo.get(key)
+    path = None if cache_dir is None else os.path.join(cache_dir, "wake_table_" + key + ".npz")
+    if tables is None and path is not None and os.path.isfile(path):
+        with np.load(path) as data:
+            tables = (data["wake_horz"], data["wake_vert"])
+    if tables is None:
+        tables = calculate()
+        if path is not None:
+            # write into a temporary file and rename it to avoid reading of partially written files by other processes
+            os.makedirs(cache_dir, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=cache_dir, suffix=".tmp")
+            with os.fdopen(fd, "wb") as f:
+                np.savez(f, wake_horz=tables[0], wake_vert=tables[1])
+            os.replace(tmp, path)
+    for table in tables:
+        table.setflags(write=False)
+    _wake_tables_memo[key] = tables
+    _wake_tables_memo.move_to_end(key)
+    while len(_wake_tables_memo) > WAKE_TABLES_MEMO_SIZE:
+        _wake_tables_memo.popitem(last=False)
+    return tables
+
+
 class WakeTable:
     """
     WakeTable(wake_file) - load and prepare wake table
@@ -298,13 +384,17 @@ class WakeTableDechirperOffAxis(WakeTable):
     :param length: length of the corrugated structure in [m]
     :param sigma: characteristic (rms) longitudinal beam size in [m]
     :param orient: "horz" or "vert" plate orientation
+    :param cache_dir: None or directory of the on-disk cache of the tables, see cached_wake_tables()
     :return: hor_wake_table, vert_wake_table
     """
 
     def __init__(self, b=500 * 1e-6, a=0.01, width=0.02, t=0.25 * 1e-3, p=0.5 * 1e-3, length=1, sigma=30e-6,
-                 orient="horz"):
+                 orient="horz", cache_dir=None):
         WakeTable.__init__(self)
-        weke_horz, wake_vert = self.calculate_wake_tables(b=b, a=a, width=width, t=t, p=p, length=length, sigma=sigma)
+        weke_horz, wake_vert = cached_wake_tables(
+            type(self).__name__, (b, a, width, t, p, length, sigma),
+            lambda: self.calculate_wake_tables(b=b, a=a, width=width, t=t, p=p, length=length, sigma=sigma),
+            cache_dir=cache_dir)
         if orient == "horz":
             self.TH = self.process_wake_table(weke_horz)
         else:
@@ -349,54 +439,34 @@ class WakeTableDechirperOffAxis(WakeTable):
         s0r_igor = s0r_bane * np.pi / 4
         s0 = 4 * s0r_igor
 
-        W = np.zeros(ns)
-
-        dWdx0 = np.zeros(ns)
-        dWdy0 = np.zeros(ns)
-        dWdx = np.zeros(ns)
-        dWdy = np.zeros(ns)
-        ddWdx0dx0 = np.zeros(ns)  # h11
-        ddWdy0dx0 = np.zeros(ns)  # h12=0
-        ddWdxdx0 = np.zeros(ns)
-        ddWdxdy0 = np.zeros(ns)  # h13 h23=0
-        ddWdydx0 = np.zeros(ns)
-        ddWdydy0 = np.zeros(ns)
-        ddWdydx = np.zeros(ns)  # %h14=0 h24 h34=0
-
-        Fz = np.zeros((Nm, ns))
-        Fyd = np.zeros((Nm, ns))
         A = Z0 * c / (2 * a) * L
-        for i in np.arange(Nm):
-            m = i + 1
-            M = np.pi / D * m
-            X = M * a
-            dx = np.sin(M * x0) * np.sin(M * x)
-            # to avoid overflow
-            coeff = X / (np.cosh(X) * np.sinh(X)) if X < 350. else 0.
-            Wcc = A * coeff * np.exp(-(s / s0) ** 0.5 * (X / np.tanh(X)))
-            Wss = A * coeff * np.exp(-(s / s0) ** 0.5 * (X * np.tanh(X)))
-
-            Fz[i, :] = Wcc * np.cosh(M * y) * np.cosh(M * y0) + Wss * np.sinh(M * y) * np.sinh(M * y0)
-
-            dW = Fz[i, :] * dx
-            W = W + dW
-            ddx0 = np.cos(M * x0) * np.sin(M * x)
-            dWdx0 = dWdx0 + M * Fz[i, :] * ddx0
-            ddy0 = Wcc * np.cosh(M * y) * np.sinh(M * y0) + Wss * np.sinh(M * y) * np.cosh(M * y0)
-            dWdy0 = dWdy0 + M * ddy0 * dx
-            ddx = np.sin(M * x0) * np.cos(M * x)
-            dWdx = dWdx + M * Fz[i, :] * ddx
-            ddy = Wcc * np.sinh(M * y) * np.cosh(M * y0) + Wss * np.cosh(M * y) * np.sinh(M * y0)
-            dWdy = dWdy + M * ddy * dx
-            Fyd[i, :] = M * ddy * dx
-            ddWdx0dx0 = ddWdx0dx0 - M ** 2 * dW
-            ddWdy0dx0 = ddWdy0dx0 + M ** 2 * (ddy0 * ddx0)
-            ddWdxdx0 = ddWdxdx0 + M ** 2 * Fz[i, :] * np.cos(M * x0) * np.cos(M * x)
-            ddWdxdy0 = ddWdxdy0 + M ** 2 * ddy0 * ddx
-            ddWdydx0 = ddWdydx0 + M ** 2 * ddy * ddx0
-            ddWdydy0 = ddWdydy0 + M ** 2 * (
-                    Wcc * np.sinh(M * y) * np.sinh(M * y0) + Wss * np.cosh(M * y) * np.cosh(M * y0)) * dx
-            ddWdydx = ddWdydx + M ** 2 * ddy * ddx
+        # all modes at once, the wakes are sums over modes of Wcc and Wss with the mode coefficients
+        M = np.pi / D * np.arange(1, Nm + 1)
+        # to avoid overflow, the modes with M * a >= 350 are neglected
+        M = M[M * a < 350.]
+        X = M * a
+        coeff = A * X / (np.cosh(X) * np.sinh(X))
+        sqrt_s = (s / s0) ** 0.5
+        Wcc = np.exp(-np.outer(X / np.tanh(X), sqrt_s))
+        Wss = np.exp(-np.outer(X * np.tanh(X), sqrt_s))
+
+        chy, shy = coeff * np.cosh(M * y), coeff * np.sinh(M * y)
+        chy0, shy0 = np.cosh(M * y0), np.sinh(M * y0)
+        dx = np.sin(M * x0) * np.sin(M * x)
+        ddx0 = np.cos(M * x0) * np.sin(M * x)
+        ddx = np.sin(M * x0) * np.cos(M * x)
+        # (Wcc, Wss) coefficients of Fz, ddy0, ddy and d^2/dy dy0
+        fz = (chy * chy0, shy * shy0)
+        fy0 = (chy * shy0, shy * chy0)
+        fy = (shy * chy0, chy * shy0)
+        fyy0 = (shy * shy0, chy * chy0)
+        terms = [(fz, dx), (fz, M * ddx0), (fy0, M * dx), (fz, M * ddx), (fy, M * dx),
+                 (fz, -M ** 2 * dx), (fy0, M ** 2 * ddx0), (fz, M ** 2 * np.cos(M * x0) * np.cos(M * x)),
+                 (fy0, M ** 2 * ddx), (fy, M ** 2 * ddx0), (fyy0, M ** 2 * dx), (fy, M ** 2 * ddx)]
+        Ccc = np.array([f[0] * g for f, g in terms])
+        Css = np.array([f[1] * g for f, g in terms])
+        (W, dWdx0, dWdy0, dWdx, dWdy, ddWdx0dx0, ddWdy0dx0, ddWdxdx0, ddWdxdy0, ddWdydx0, ddWdydy0,
+         ddWdydx) = np.dot(Ccc, Wcc) + np.dot(Css, Wss)
 
         W = W * 2 / D * 1e6
         h00 = W
@@ -562,9 +632,11 @@ class WakeTableParallelPlate(WakeTable):
     strcutres based on 1st order analytical results. Here 1st order adds an exponential decay term
     to the 0th order results.
     """
-    def __init__(self, b=500e-6, a=500e-6, t=250e-6, p=500e-6, length=1, sigma=30e-6, orient="horz"):
+    def __init__(self, b=500e-6, a=500e-6, t=250e-6, p=500e-6, length=1, sigma=30e-6, orient="horz", cache_dir=None):
         WakeTable.__init__(self)
-        wake_horz, wake_vert = self.calculate_wake_table(b, a, t, p, length, sigma)
+        wake_horz, wake_vert = cached_wake_tables(type(self).__name__, (b, a, t, p, length, sigma),
+                                                  lambda: self.calculate_wake_table(b, a, t, p, length, sigma),
+                                                  cache_dir=cache_dir)
         if orient == "horz":
             self.TH = self.process_wake_table(wake_horz)
         else:
@@ -854,9 +926,11 @@ class WakeTableParallelPlate3(WakeTable3):
     strcutres based on 1st order analytical results. Here 1st order adds an exponential decay term
     to the 0th order results. This calss should be used with Wake3().
     """
-    def __init__(self, b=500e-6, a=500e-6, t=250e-6, p=500e-6, length=1, sigma=30e-6, orient="horz"):
+    def __init__(self, b=500e-6, a=500e-6, t=250e-6, p=500e-6, length=1, sigma=30e-6, orient="horz", cache_dir=None):
         WakeTable3.__init__(self)
-        wake_horz, wake_vert = self.calculate_wake_table(b, a, t, p, length, sigma)
+        wake_horz, wake_vert = cached_wake_tables(type(self).__name__, (b, a, t, p, length, sigma),
+                                                  lambda: self.calculate_wake_table(b, a, t, p, length, sigma),
+                                                  cache_dir=cache_dir)
         if orient == "horz":
             self.TH = self.process_wake_table(wake_horz)
         else:
@@ -1043,8 +1117,13 @@ class Wake(PhysProc):
     wake_table = None - wake table [WakeTable()]
     factor = 1. - scaling coefficient
     TH - list from WakeTable, (T, H): T- table of wakes coefs, H - matrix of the coefs place in T
+    spectrum_rtol = 0. - the spectra of the tabulated wakes on the grid of the current profile are reused
+                        while the grid step changes less than spectrum_rtol (relative), 0 - only the same grid
     """
 
+    # only the momenta are kicked, see PhysProc.changes_coordinates
+    changes_coordinates = False
+
     def __init__(self, step=1, **kwargs):
         PhysProc.__init__(self)
         self.w_sampling = kwargs.get("w_sampling", 500)  # wake sampling
@@ -1054,6 +1133,8 @@ class Wake(PhysProc):
         self.factor = kwargs.get("factor", 1.)
         self.step = step
         self.TH = kwargs.get("TH", None)
+        self.spectrum_rtol = kwargs.get("spectrum_rtol", 0.)
+        self.spectra = {}
 
     def add_wake(self, I, T):
         """
@@ -1070,11 +1151,12 @@ class Wake(PhysProc):
             d1_bunch = Der(x, bunch)
         nb = x.shape[0]
         W = np.zeros(nb)
+        h = x[1] - x[0]
         if N0 > 0:
-            x, ww = wake_convolution(x, bunch, W0[:, 0], W0[:, 1])
+            ww = fft_wake_convolution(h, bunch, self.get_spectrum(W0, h, nb))
             W = W - ww[0:nb] / c
         if N1 > 0:
-            x, ww = wake_convolution(x, d1_bunch, W1[:, 0], W1[:, 1])
+            ww = fft_wake_convolution(h, d1_bunch, self.get_spectrum(W1, h, nb))
             # W = W - ww[0:nb]
             W = W + ww[0:nb]
         if R != 0:
@@ -1087,6 +1169,48 @@ class Wake(PhysProc):
             W = W - int_bunch * Cinv / c
         return x, W
 
+    def get_spectrum(self, W, h, nb):
+        """
+        Spectrum of the tabulated wake W on the grid of the current profile. The spectrum is calculated once
+        and is reused until the number of points changes or the grid step h changes by more than spectrum_rtol
+
+        :param W: tabulated wake [s, W] from the wake table
+        :param h: grid step of the current profile
+        :param nb: number of points of the current profile
+        :return: spectrum, see wake_spectrum()
+        """
+        cached = self.spectra.get(id(W))
+        if cached is not None:
+            W0, h0, nb0, spectrum = cached
+            if W0 is W and nb0 == nb and abs(h - h0) <= self.spectrum_rtol * h0:
+                return spectrum
+        spectrum = wake_spectrum(h, nb, W[:, 0], W[:, 1])
+        self.spectra[id(W)] = (W, h, nb, spectrum)
+        return spectrum
+
+    def get_current(self, weight, qn, Z, Ns, NF):
+        """
+        Generalized current s2current(Z, qn(), Ns, NF), shared with the other wakes of the tracking step
+
+        :param weight: name of the transverse weight of the charges, e.g. "x" for q * X
+        :param qn: function without arguments which returns the weighted charges
+        :param Z: longitudinal coordinates of the particles
+        :param Ns: number of sampling points
+        :param NF: filter order
+        :return: current [s, I]
+        """
+        return self.projection(("s2current", weight, Ns, NF),
+                               lambda: s2current(Z, qn(), Ns, NF, speed_of_light, comm=self.comm))
+
+    def get_wake(self, weight, I, T, Ns, NF):
+        """
+        add_wake(I, T) of the generalized current I = get_current(weight, ..., Ns, NF),
+        shared with the other wakes of the tracking step which use the same wake table
+
+        :return: x, W
+        """
+        return self.projection(("wake", weight, Ns, NF, id(T)), lambda: self.add_wake(I, T))
+
     def add_total_wake(self, X, Y, Z, q, TH, Ns, NF):
         T, H = TH
         c = speed_of_light
@@ -1095,51 +1219,47 @@ class Wake(PhysProc):
         Y2 = Y ** 2
         XY = X * Y
         # generalized currents;
-        I00 = s2current(Z, q, Ns, NF, c)
+        I00 = self.get_current("1", lambda: q, Z, Ns, NF)
         Nw = I00.shape[0]
         if (H[0, 2] > 0) or (H[2, 3] > 0) or (H[2, 4] > 0):
-            qn = q * Y
-            I01 = s2current(Z, qn, Ns, NF, c)
+            I01 = self.get_current("y", lambda: q * Y, Z, Ns, NF)
         if (H[0, 1] > 0) or (H[1, 3] > 0) or (H[1, 4] > 0):
-            qn = q * X
-            I10 = s2current(Z, qn, Ns, NF, c)
+            I10 = self.get_current("x", lambda: q * X, Z, Ns, NF)
         if H[1, 2] > 0:
-            qn = q * XY
-            I11 = s2current(Z, qn, Ns, NF, c)
+            I11 = self.get_current("xy", lambda: q * XY, Z, Ns, NF)
         if H[1, 1] > 0:
-            qn = q * (X2 - Y2)
-            I20_02 = s2current(Z, qn, Ns, NF, c)
+            I20_02 = self.get_current("x2-y2", lambda: q * (X2 - Y2), Z, Ns, NF)
         # longitudinal wake
         # mn=0
-        x, Wz = self.add_wake(I00, T[int(H[0, 0])])
+        x, Wz = self.get_wake("1", I00, T[int(H[0, 0])], Ns, NF)
         if H[0, 1] > 0:
-            x, w = self.add_wake(I10, T[int(H[0, 1])])
+            x, w = self.get_wake("x", I10, T[int(H[0, 1])], Ns, NF)
             Wz = Wz + w
         if H[0, 2] > 0:
-            x, w = self.add_wake(I01, T[int(H[0, 2])])
+            x, w = self.get_wake("y", I01, T[int(H[0, 2])], Ns, NF)
             Wz = Wz + w
         if H[1, 1] > 0:
-            x, w = self.add_wake(I20_02, T[int(H[1, 1])])
+            x, w = self.get_wake("x2-y2", I20_02, T[int(H[1, 1])], Ns, NF)
             Wz = Wz + w
         if H[1, 2] > 0:
-            x, w = self.add_wake(I11, T[int(H[1, 2])])
+            x, w = self.get_wake("xy", I11, T[int(H[1, 2])], Ns, NF)
             Wz = Wz + 2 * w
         Pz = np.interp(Z, x, Wz, 0, 0)
         Py = np.zeros(Np)
         Px = np.zeros(Np)
         # mn=01
-        Wz[0:Nw] = 0
+        Wz = np.zeros(Nw)
         Wy = np.zeros(Nw)
         if H[0, 4] > 0:
-            x, w = self.add_wake(I00, T[int(H[0, 4])])
+            x, w = self.get_wake("1", I00, T[int(H[0, 4])], Ns, NF)
             Wz = Wz + w
             Wy = Wy + w
         if H[1, 4] > 0:
-            x, w = self.add_wake(I10, T[int(H[1, 4])])
+            x, w = self.get_wake("x", I10, T[int(H[1, 4])], Ns, NF)
             Wz = Wz + 2 * w
             Wy = Wy + 2 * w
         if H[2, 4] > 0:
-            x, w = self.add_wake(I01, T[int(H[2, 4])])
+            x, w = self.get_wake("y", I01, T[int(H[2, 4])], Ns, NF)
             Wz = Wz + 2 * w
             Wy = Wy + 2 * w
         Pz = Pz + np.interp(Z, x, Wz, 0, 0) * Y
@@ -1147,18 +1267,18 @@ class Wake(PhysProc):
         Wy = -Int1h(h, Wy)
         Py = Py + np.interp(Z, x, Wy, 0, 0)
         # mn=10
-        Wz[0:Nw] = 0
+        Wz = np.zeros(Nw)
         Wx = np.zeros(Nw)
         if H[0, 3] > 0:
-            x, w = self.add_wake(I00, T[int(H[0, 3])])
+            x, w = self.get_wake("1", I00, T[int(H[0, 3])], Ns, NF)
             Wz = Wz + w
             Wx = Wx + w
         if H[1, 3] > 0:
-            x, w = self.add_wake(I10, T[int(H[1, 3])])
+            x, w = self.get_wake("x", I10, T[int(H[1, 3])], Ns, NF)
             Wz = Wz + 2 * w
             Wx = Wx + 2 * w
         if H[2, 3] > 0:
-            x, w = self.add_wake(I01, T[int(H[2, 3])])
+            x, w = self.get_wake("y", I01, T[int(H[2, 3])], Ns, NF)
             Wz = Wz + 2 * w
             Wx = Wx + 2 * w
         Wx = -Int1h(h, Wx)
@@ -1166,7 +1286,7 @@ class Wake(PhysProc):
         Px = Px + np.interp(Z, x, Wx, 0, 0)
         # mn=11
         if H[3, 4] > 0:
-            x, w = self.add_wake(I00, T[int(H[3, 4])])
+            x, w = self.get_wake("1", I00, T[int(H[3, 4])], Ns, NF)
             Wx = -2 * Int1h(h, w)
             p = np.interp(Z, x, Wx, 0, 0)
             Px = Px + p * Y
@@ -1174,13 +1294,13 @@ class Wake(PhysProc):
             Pz = Pz + 2 * np.interp(Z, x, w, 0, 0) * XY
         # mn=02,20
         if H[3, 3] > 0:
-            x, w = self.add_wake(I00, T[int(H[3, 3])])
+            x, w = self.get_wake("1", I00, T[int(H[3, 3])], Ns, NF)
             Pz = Pz + np.interp(Z, x, w, 0, 0) * (X2 - Y2)
             Wx = -2 * Int1h(h, w)
             p = np.interp(Z, x, Wx, 0, 0)
             Px = Px + p * X
             Py = Py - p * Y
-        I00[:, 0] = - I00[:, 0]
+        I00 = I00 * np.array([-1., 1.])
         # Z=-Z
         return Px, Py, Pz, I00
 
@@ -1190,6 +1310,7 @@ class Wake(PhysProc):
             _logger.info("Wake.wake_table is None! Please specify the WakeTable()")
         else:
             self.TH = self.wake_table.TH
+        self.spectra = {}
 
     def get_long_wake(self, current_profile):
         """
@@ -1258,6 +1379,7 @@ class Wake3(Wake):
     wake_table = None - wake table [WakeTable3()]
     factor = 1. - scaling coefficient
     TH - list from WakeTable, (T, H): T- table of wakes coefs, H - matrix of the coefs place in T
+    spectrum_rtol = 0. - see Wake
     """
 
     def __init__(self, step=1):
@@ -1269,6 +1391,8 @@ class Wake3(Wake):
         self.factor = 1.
         self.step = step
         self.TH = None
+        self.spectrum_rtol = 0.
+        self.spectra = {}
 
     def add_total_wake(self, X, Y, Z, q, TH, Ns, NF):
         T, H = TH
@@ -1282,94 +1406,84 @@ class Wake3(Wake):
         X2Y = X**2 * Y
         XY2 = X * Y**2
         # generalized currents;
-        I00 = s2current(Z, q, Ns, NF, c)
+        I00 = self.get_current("1", lambda: q, Z, Ns, NF)
         Nw = I00.shape[0]
         if (H[0, 0, 2] > 0) or (H[0, 2, 3] > 0) or (H[0, 2, 4] > 0) or (H[2, 3, 3] > 0) or (H[2, 3, 4] > 0) or (H[2, 4, 4] > 0):
-            qn = q * Y
-            I01 = s2current(Z, qn, Ns, NF, c)
+            I01 = self.get_current("y", lambda: q * Y, Z, Ns, NF)
         if (H[0, 0, 1] > 0) or (H[0, 1, 3] > 0) or (H[0, 1, 4] > 0) or (H[1, 3, 3] > 0) or (H[1, 3, 4] > 0) or (H[1, 4, 4] > 0):
-            qn = q * X
-            I10 = s2current(Z, qn, Ns, NF, c)
+            I10 = self.get_current("x", lambda: q * X, Z, Ns, NF)
         if (H[0, 1, 2] > 0) or (H[1, 2, 3] > 0) or (H[1, 2, 4] > 0):
-            qn = q * XY
-            I11 = s2current(Z, qn, Ns, NF, c)
+            I11 = self.get_current("xy", lambda: q * XY, Z, Ns, NF)
         if H[0, 1, 1] > 0:
-            qn = q * (X2 - Y2)
-            I20_02 = s2current(Z, qn, Ns, NF, c)
+            I20_02 = self.get_current("x2-y2", lambda: q * (X2 - Y2), Z, Ns, NF)
         if (H[1, 1, 3] > 0) or (H[1, 1, 4] > 0):
-            qn = q * X2
-            I20 = s2current(Z, qn, Ns, NF, c)
+            I20 = self.get_current("x2", lambda: q * X2, Z, Ns, NF)
         if (H[2, 2, 3] > 0) or (H[2, 2, 4] > 0):
-            qn = q * Y2
-            I02 = s2current(Z, qn, Ns, NF, c)
+            I02 = self.get_current("y2", lambda: q * Y2, Z, Ns, NF)
         if H[1, 1, 1] > 0:
-            qn = q * X3
-            I30 = s2current(Z, qn, Ns, NF, c)
+            I30 = self.get_current("x3", lambda: q * X3, Z, Ns, NF)
         if H[1, 1, 2] > 0:
-            qn = q * X2Y
-            I21 = s2current(Z, qn, Ns, NF, c)           
+            I21 = self.get_current("x2y", lambda: q * X2Y, Z, Ns, NF)
         if H[1, 2, 2] > 0:
-            qn = q * XY2
-            I12 = s2current(Z, qn, Ns, NF, c)
+            I12 = self.get_current("xy2", lambda: q * XY2, Z, Ns, NF)
         if H[2, 2, 2] > 0:
-            qn = q * Y3
-            I03 = s2current(Z, qn, Ns, NF, c)
+            I03 = self.get_current("y3", lambda: q * Y3, Z, Ns, NF)
             
         # longitudinal wake
         # mn=0
-        x, Wz = self.add_wake(I00, T[int(H[0, 0, 0])])
+        x, Wz = self.get_wake("1", I00, T[int(H[0, 0, 0])], Ns, NF)
         if H[0, 0, 1] > 0:
-            x, w = self.add_wake(I10, T[int(H[0, 0, 1])])
+            x, w = self.get_wake("x", I10, T[int(H[0, 0, 1])], Ns, NF)
             Wz = Wz + w
         if H[0, 0, 2] > 0:
-            x, w = self.add_wake(I01, T[int(H[0, 0, 2])])
+            x, w = self.get_wake("y", I01, T[int(H[0, 0, 2])], Ns, NF)
             Wz = Wz + w
         if H[0, 1, 1] > 0:
-            x, w = self.add_wake(I20_02, T[int(H[0, 1, 1])])
+            x, w = self.get_wake("x2-y2", I20_02, T[int(H[0, 1, 1])], Ns, NF)
             Wz = Wz + w
         if H[0, 1, 2] > 0:
-            x, w = self.add_wake(I11, T[int(H[0, 1, 2])])
+            x, w = self.get_wake("xy", I11, T[int(H[0, 1, 2])], Ns, NF)
             Wz = Wz + 2 * w
         if H[1, 1, 1] > 0:
-            x, w = self.add_wake(I30, T[int(H[1, 1, 1])])
+            x, w = self.get_wake("x3", I30, T[int(H[1, 1, 1])], Ns, NF)
             Wz = Wz + w
         if H[1, 1, 2] > 0:
-            x, w = self.add_wake(I21, T[int(H[1, 1, 2])])
+            x, w = self.get_wake("x2y", I21, T[int(H[1, 1, 2])], Ns, NF)
             Wz = Wz + 3 * w
         if H[1, 2, 2] > 0:
-            x, w = self.add_wake(I12, T[int(H[1, 2, 2])])
+            x, w = self.get_wake("xy2", I12, T[int(H[1, 2, 2])], Ns, NF)
             Wz = Wz + 3 * w
         if H[2, 2, 2] > 0:
-            x, w = self.add_wake(I03, T[int(H[2, 2, 2])])
+            x, w = self.get_wake("y3", I03, T[int(H[2, 2, 2])], Ns, NF)
             Wz = Wz + w     
         Pz = np.interp(Z, x, Wz, 0, 0)
         Py = np.zeros(Np)
         Px = np.zeros(Np)
         # mn=01
-        Wz[0:Nw] = 0
+        Wz = np.zeros(Nw)
         Wy = np.zeros(Nw)
         if H[0, 0, 4] > 0:
-            x, w = self.add_wake(I00, T[int(H[0, 0, 4])])
+            x, w = self.get_wake("1", I00, T[int(H[0, 0, 4])], Ns, NF)
             Wz = Wz + w
             Wy = Wy + w
         if H[0, 1, 4] > 0:
-            x, w = self.add_wake(I10, T[int(H[0, 1, 4])])
+            x, w = self.get_wake("x", I10, T[int(H[0, 1, 4])], Ns, NF)
             Wz = Wz + 2 * w
             Wy = Wy + 2 * w
         if H[0, 2, 4] > 0:
-            x, w = self.add_wake(I01, T[int(H[0, 2, 4])])
+            x, w = self.get_wake("y", I01, T[int(H[0, 2, 4])], Ns, NF)
             Wz = Wz + 2 * w
             Wy = Wy + 2 * w
         if H[1, 1, 4] > 0:
-            x, w = self.add_wake(I20, T[int(H[1, 1, 4])])
+            x, w = self.get_wake("x2", I20, T[int(H[1, 1, 4])], Ns, NF)
             Wz = Wz + 3 * w
             Wy = Wy + 3 * w
         if H[1, 2, 4] > 0:
-            x, w = self.add_wake(I11, T[int(H[1, 2, 4])])
+            x, w = self.get_wake("xy", I11, T[int(H[1, 2, 4])], Ns, NF)
             Wz = Wz + 6 * w
             Wy = Wy + 6 * w            
         if H[2, 2, 4] > 0:
-            x, w = self.add_wake(I02, T[int(H[2, 2, 4])])
+            x, w = self.get_wake("y2", I02, T[int(H[2, 2, 4])], Ns, NF)
             Wz = Wz + 3 * w
             Wy = Wy + 3 * w            
         Pz = Pz + np.interp(Z, x, Wz, 0, 0) * Y
@@ -1377,51 +1491,51 @@ class Wake3(Wake):
         Wy = -Int1h(h, Wy)
         Py = Py + np.interp(Z, x, Wy, 0, 0)
         # mn=10
-        Wz[0:Nw] = 0
+        Wz = np.zeros(Nw)
         Wx = np.zeros(Nw)
         if H[0, 0, 3] > 0:
-            x, w = self.add_wake(I00, T[int(H[0, 0, 3])])
+            x, w = self.get_wake("1", I00, T[int(H[0, 0, 3])], Ns, NF)
             Wz = Wz + w
             Wx = Wx + w
         if H[0, 1, 3] > 0:
-            x, w = self.add_wake(I10, T[int(H[0, 1, 3])])
+            x, w = self.get_wake("x", I10, T[int(H[0, 1, 3])], Ns, NF)
             Wz = Wz + 2 * w
             Wx = Wx + 2 * w
         if H[0, 2, 3] > 0:
-            x, w = self.add_wake(I01, T[int(H[0, 2, 3])])
+            x, w = self.get_wake("y", I01, T[int(H[0, 2, 3])], Ns, NF)
             Wz = Wz + 2 * w
             Wx = Wx + 2 * w
         if H[1, 1, 3] > 0:
-            x, w = self.add_wake(I20, T[int(H[1, 1, 3])])
+            x, w = self.get_wake("x2", I20, T[int(H[1, 1, 3])], Ns, NF)
             Wz = Wz + 3 * w
             Wx = Wx + 3 * w            
         if H[1, 2, 3] > 0:
-            x, w = self.add_wake(I11, T[int(H[1, 2, 3])])
+            x, w = self.get_wake("xy", I11, T[int(H[1, 2, 3])], Ns, NF)
             Wz = Wz + 6 * w
             Wx = Wx + 6 * w                     
         if H[2, 2, 3] > 0:
-            x, w = self.add_wake(I02, T[int(H[2, 2, 3])])
+            x, w = self.get_wake("y2", I02, T[int(H[2, 2, 3])], Ns, NF)
             Wz = Wz + 3 * w
             Wx = Wx + 3 * w     
         Wx = -Int1h(h, Wx)
         Pz = Pz + np.interp(Z, x, Wz, 0, 0) * X
         Px = Px + np.interp(Z, x, Wx, 0, 0)
         # mn=11
-        Wz[0:Nw] = 0
-        Wx[0:Nw] = 0
-        Wy[0:Nw] = 0
+        Wz = np.zeros(Nw)
+        Wx = np.zeros(Nw)
+        Wy = np.zeros(Nw)
         if H[0, 3, 4] > 0:
-            x, w = self.add_wake(I00, T[int(H[0, 3, 4])])
+            x, w = self.get_wake("1", I00, T[int(H[0, 3, 4])], Ns, NF)
             Wz = Wz + 2 * w
             Wx = Wx + 2 * w
             Wy = Wy + 2 * w
         if H[1, 3, 4] > 0:
-            x, w = self.add_wake(I10, T[int(H[1, 3, 4])])
+            x, w = self.get_wake("x", I10, T[int(H[1, 3, 4])], Ns, NF)
             Wz = Wz + 6 * w
             Wx = Wx + 6 * w
             Wy = Wy + 6 * w
         if H[2, 3, 4] > 0:
-            x, w = self.add_wake(I01, T[int(H[2, 3, 4])])
+            x, w = self.get_wake("y", I01, T[int(H[2, 3, 4])], Ns, NF)
             Wz = Wz + 6 * w
             Wx = Wx + 6 * w
             Wy = Wy + 6 * w            
@@ -1432,35 +1546,35 @@ class Wake3(Wake):
         Pz = Pz + np.interp(Z, x, Wz, 0, 0) * XY
         # mn=02,20
         if H[0, 3, 3] > 0:
-            x, w = self.add_wake(I00, T[int(H[0, 3, 3])])
+            x, w = self.get_wake("1", I00, T[int(H[0, 3, 3])], Ns, NF)
             Pz = Pz + np.interp(Z, x, w, 0, 0) * (X2 - Y2)
             Wx = -2 * Int1h(h, w)
             p = np.interp(Z, x, Wx, 0, 0)
             Px = Px + p * X
             Py = Py - p * Y
         # other terms for 02
-        Wz[0:Nw] = 0
-        Wy[0:Nw] = 0
+        Wz = np.zeros(Nw)
+        Wy = np.zeros(Nw)
         if H[1, 4, 4] > 0:
-            x, w = self.add_wake(I10, T[int(H[1, 4, 4])])
+            x, w = self.get_wake("x", I10, T[int(H[1, 4, 4])], Ns, NF)
             Wz = Wz + 3 * w
             Wy = Wy + 6 * w
         if H[2, 4, 4] > 0:
-            x, w = self.add_wake(I01, T[int(H[2, 4, 4])])
+            x, w = self.get_wake("y", I01, T[int(H[2, 4, 4])], Ns, NF)
             Wz = Wz + 3 * w
             Wy = Wy + 6 * w
         Wy = -Int1h(h, Wy)
         Py = Py + np.interp(Z, x, Wy, 0, 0) * Y
         Pz = Pz + np.interp(Z, x, Wz, 0, 0) * Y2
         # other terms for 20
-        Wz[0:Nw] = 0
-        Wx[0:Nw] = 0
+        Wz = np.zeros(Nw)
+        Wx = np.zeros(Nw)
         if H[1, 3, 3] > 0:
-            x, w = self.add_wake(I10, T[int(H[1, 3, 3])])
+            x, w = self.get_wake("x", I10, T[int(H[1, 3, 3])], Ns, NF)
             Wz = Wz + 3 * w
             Wx = Wx + 6 * w
         if H[2, 3, 3] > 0:
-            x, w = self.add_wake(I01, T[int(H[2, 3, 3])])
+            x, w = self.get_wake("y", I01, T[int(H[2, 3, 3])], Ns, NF)
             Wz = Wz + 3 * w
             Wx = Wx + 6 * w
         Wx = -Int1h(h, Wx)
@@ -1468,7 +1582,7 @@ class Wake3(Wake):
         Pz = Pz + np.interp(Z, x, Wz, 0, 0) * X2        
         # mn=12
         if H[3, 4, 4] > 0:
-            x, w = self.add_wake(I00, T[int(H[3, 4, 4])])
+            x, w = self.get_wake("1", I00, T[int(H[3, 4, 4])], Ns, NF)
             Wz = 3 * w
             Wx = 3 * w
             Wy = 6 * w            
@@ -1479,7 +1593,7 @@ class Wake3(Wake):
             Pz = Pz + np.interp(Z, x, Wz, 0, 0) * XY2
         # mn=21
         if H[3, 3, 4] > 0:
-            x, w = self.add_wake(I00, T[int(H[3, 3, 4])])
+            x, w = self.get_wake("1", I00, T[int(H[3, 3, 4])], Ns, NF)
             Wz = 3 * w
             Wx = 6 * w
             Wy = 3 * w            
@@ -1490,7 +1604,7 @@ class Wake3(Wake):
             Pz = Pz + np.interp(Z, x, Wz, 0, 0) * X2Y        
         # mn=30
         if H[3, 3, 3] > 0:
-            x, w = self.add_wake(I00, T[int(H[3, 3, 3])])
+            x, w = self.get_wake("1", I00, T[int(H[3, 3, 3])], Ns, NF)
             Wz = w
             Wx = 3 * w         
             Wx = -Int1h(h, Wx)
@@ -1498,14 +1612,14 @@ class Wake3(Wake):
             Pz = Pz + np.interp(Z, x, Wz, 0, 0) * X3
         # mn=03
         if H[4, 4, 4] > 0:
-            x, w = self.add_wake(I00, T[int(H[4, 4, 4])])
+            x, w = self.get_wake("1", I00, T[int(H[4, 4, 4])], Ns, NF)
             Wz =  w
             Wy = 3 * w            
             Wy = -Int1h(h, Wy)
             Py = Py + np.interp(Z, x, Wy, 0, 0) * Y2
             Pz = Pz + np.interp(Z, x, Wz, 0, 0) * Y3        
 
-        I00[:, 0] = - I00[:, 0]
+        I00 = I00 * np.array([-1., 1.])
         # Z=-Z
         return Px, Py, Pz, I00
 
@@ -449,75 +449,156 @@ def wrap_gintegrator(Nmotion, Xscr, Yscr, Erad, motion, screen, n_end, gamma, ha
     return screen
 
 
+def radiation_kernel_py(Xscr, Yscr, Erad, Distance, gammas, starts, nseg, x, y, z, bx, by, XbetaI2, YbetaI2, Bx, By,
+                        arReEx, arImEx, arReEy, arImEy, arPhase):
+    """
+    SR fields of many electrons for all screen points. The same integration as in gintegrator_over_traj_py()
+    but every screen point (over energy, y and x) is integrated over all trajectories in one (parallel) iteration
+    and the fields are accumulated in local variables, so no temporary screens are needed.
+
+    :param Xscr: array of nx horizontal screen coordinates in [mm]
+    :param Yscr: array of ny vertical screen coordinates in [mm]
+    :param Erad: array of ne photon energies in [eV]
+    :param Distance: distance to the screen in [mm]
+    :param gammas: array, Lorentz factors of the motions
+    :param starts: array, starts[m]:starts[m + 1] are the points of the motion m in the concatenated motion arrays
+    :param nseg: number of consecutive motions (trajectory segments) of one electron
+    :param x, y, z, bx, by, XbetaI2, YbetaI2, Bx, By: concatenated motion arrays (see traj2motion)
+    :param arReEx, arImEx, arReEy, arImEy: field arrays of ne*ny*nx points, the fields are added to them
+    :param arPhase: initial phase of the electrons, the phase advances of all electrons are added to it
+    :return:
+    """
+    q = 0.5866740802042227  # speed_of_light/m_e_eV/1000  // e/mc = (mm*T)^-1
+    hc = 1.239841874330e-3  # h_eV_s*speed_of_light*1000  // mm
+    k2q3 = 1.1547005383792517  # 2./sqrt(3)
+    nx = len(Xscr)
+    ny = len(Yscr)
+    nmotions = len(gammas)
+    for j in _prange(len(Erad) * ny * nx):
+        xscr = Xscr[j % nx]
+        yscr = Yscr[(j // nx) % ny]
+        erad = Erad[j // (ny * nx)]
+        phase_in = arPhase[j]
+        phase0 = phase_in
+        re_x = 0.
+        im_x = 0.
+        re_y = 0.
+        im_y = 0.
+        dphase = 0.
+        for m in range(nmotions):
+            if m % nseg == 0:
+                phase0 = phase_in
+            i0 = starts[m]
+            size = starts[m + 1] - i0
+            nmotion = (size + 1) // 3
+            half_step = (z[i0 + size - 1] - z[i0]) / 2. / (nmotion - 1)
+            gamma = gammas[m]
+            gamma2 = gamma * gamma
+            len_const = Distance - z[i0]
+            phase_const = np.pi * erad / (gamma2 * hc)
+            pr_x_const = xscr - x[i0]
+            pr_y_const = yscr - y[i0]
+            phase_const_in = (pr_x_const * pr_x_const + pr_y_const * pr_y_const) / len_const
+            for i in range(1, 3 * nmotion - 2):
+                k = i0 + i
+                if (i - 1) % 3 == 1:
+                    w = 0.8888888888888889 * half_step
+                else:
+                    w = 0.5555555555555556 * half_step
+                len_z = Distance - z[k]
+                pr_x = xscr - x[k]
+                pr_y = yscr - y[k]
+                tx = gamma * (pr_x / len_z - bx[k])
+                ty = gamma * (pr_y / len_z - by[k])
+                tx2 = tx * tx
+                ty2 = ty * ty
+                tyx = 2. * tx * ty
+
+                rad_const = w * q * k2q3 * Distance / len_z / ((1. + tx2 + ty2) * (1. + tx2 + ty2))
+                rad_x = rad_const * (By[k] * (1. - tx2 + ty2) + Bx[k] * tyx - 2. * tx / q / len_z)
+                rad_y = -rad_const * (Bx[k] * (1. + tx2 - ty2) + By[k] * tyx + 2. * ty / q / len_z)
+
+                phase_cur = (pr_x * pr_x + pr_y * pr_y) / len_z
+                phase = phase_const * (
+                    z[k] - z[i0] + gamma2 * (XbetaI2[k] + YbetaI2[k] + phase_cur - phase_const_in)) + phase0
+                cosf = np.cos(phase)
+                sinf = np.sin(phase)
+                re_x += rad_x * cosf
+                im_x += rad_x * sinf
+                re_y += rad_y * cosf
+                im_y += rad_y * sinf
+            if 3 * nmotion - 3 == size - 2:
+                k = i0 + size - 1
+                len_z = Distance - z[k]
+                pr_x = xscr - x[k]
+                pr_y = yscr - y[k]
+                phase0 += phase_const * (z[k] - z[i0] + gamma2 * (
+                    XbetaI2[k] + YbetaI2[k] + pr_x * pr_x / len_z + pr_y * pr_y / len_z - phase_const_in))
+            if m % nseg == nseg - 1:
+                dphase += phase0 - phase_in
+        arReEx[j] += re_x
+        arImEx[j] += im_x
+        arReEy[j] += re_y
+        arImEy[j] += im_y
+        arPhase[j] += dphase
+
+
+if nb_flag:
+    _prange = nb.prange
+    radiation_kernel = nb.njit(parallel=True)(radiation_kernel_py)
+else:
+    _prange = range
+    radiation_kernel = None
+
+
+def radiation_fields(gammas, motions, screen, nseg=1):
+    """
+    Calculates SR fields of the electrons and adds them to the screen field arrays (screen.arReEx, ...) in place,
+    without copies of the screen. With numba all screen points are calculated in parallel by radiation_kernel,
+    otherwise gintegrator_over_traj_py() is applied to all screen points at once for every motion.
+
+    :param gammas: list of Lorentz factors, one per motion
+    :param motions: list of Motion (see traj2motion), nseg consecutive trajectory segments for every electron
+    :param screen: Screen, screen.arPhase is the initial phase of the electrons, phase advances of all electrons
+                   are added to it
+    :param nseg: number of trajectory segments of one electron
+    :return: screen
+    """
+    gammas = np.asarray(gammas, dtype=float)
+    Xscr = np.asarray(screen.Xph, dtype=float)
+    Yscr = np.asarray(screen.Yph, dtype=float)
+    Erad = np.asarray(screen.Eph, dtype=float)
+    fields = [screen.arReEx, screen.arImEx, screen.arReEy, screen.arImEy, screen.arPhase]
+    names = ["x", "y", "z", "bx", "by", "XbetaI2", "YbetaI2", "Bx", "By"]
+
+    if radiation_kernel is not None:
+        starts = np.cumsum([0] + [len(motion.z) for motion in motions])
+        arrays = [np.ascontiguousarray(np.concatenate([np.ravel(getattr(motion, name)) for motion in motions]),
+                                       dtype=float) for name in names]
+        radiation_kernel(Xscr, Yscr, Erad, float(screen.Distance), gammas, starts, nseg, *arrays, *fields)
+        return screen
+
+    Erad_pix, Yscr_pix, Xscr_pix = [a.ravel() for a in np.meshgrid(Erad, Yscr, Xscr, indexing="ij")]
+    phase_in = np.copy(screen.arPhase)
+    for m, (gamma, motion) in enumerate(zip(gammas, motions)):
+        if m % nseg == 0:
+            phase = np.copy(phase_in)
+        size = len(motion.z)
+        Nmotion = int((size + 1) / 3)
+        half_step = (motion.z[-1] - motion.z[0]) / 2. / (Nmotion - 1)
+        arrays = [np.ravel(getattr(motion, name)) for name in names]
+        gintegrator_over_traj_py(Nmotion, Xscr_pix, Yscr_pix, Erad_pix, size - 2, gamma, half_step, screen.Distance,
+                                 *arrays, *fields[:4], phase)
+        if m % nseg == nseg - 1:
+            screen.arPhase += phase - phase_in
+    return screen
+
+
 def radiation_py(gamma, traj, screen):
     """
     screen format     screen->ReEx[ypoint*xpoint*je + xpoint*jy + jx] += EreX;
     """
-
-    motion = traj2motion(traj)
-
-    size = len(motion.z)
-    Nmotion = int((size + 1) / 3)
-    half_step = (motion.z[-1] - motion.z[0]) / 2. / (Nmotion - 1)
-
-    n_end = len(motion.z) - 2
-    Xscr = np.linspace(screen.x_start, screen.x_start + screen.x_step * (screen.nx - 1), num=screen.nx)
-    Yscr = np.linspace(screen.y_start, screen.y_start + screen.y_step * (screen.ny - 1), num=screen.ny)
-    Yscr = Yscr.reshape((screen.ny, 1))
-    Erad = np.linspace(screen.e_start, screen.e_start + screen.e_step * (screen.ne - 1), num=screen.ne)
-    Erad = Erad.reshape((screen.ne, 1))
-
-    shape_array = [screen.ne, screen.ny, screen.nx]
-    if 1 in shape_array:
-        if screen.ny > 1 and screen.ne > 1:
-            Yscr = Yscr.reshape((1, screen.ny))
-        shape_array.remove(1)
-        screen.arReEx = screen.arReEx.reshape(shape_array)
-        screen.arImEx = screen.arImEx.reshape(shape_array)
-        screen.arReEy = screen.arReEy.reshape(shape_array)
-        screen.arImEy = screen.arImEy.reshape(shape_array)
-        screen.arPhase = screen.arPhase.reshape(shape_array)
-
-        wrap_gintegrator(Nmotion, Xscr, Yscr, Erad, motion, screen, n_end, gamma, half_step)
-        # print("phase", screen.arPhase )
-        # for n in range(Nmotion-1):
-        #     screen = gintegrator(Xscr, Yscr, Erad, motion, screen, n, n_end, gamma, half_step)
-        screen.arReEx = screen.arReEx.flatten()
-        screen.arImEx = screen.arImEx.flatten()
-        screen.arReEy = screen.arReEy.flatten()
-        screen.arImEy = screen.arImEy.flatten()
-        screen.arPhase = screen.arPhase.flatten()
-    else:
-        print("SR 3D calculation")
-        arReEx = np.array([])
-        arImEx = np.array([])
-        arReEy = np.array([])
-        arImEy = np.array([])
-        screen_segment = copy.deepcopy(screen)
-
-        n_pl = screen.ny * screen.nx
-        for i, erad in enumerate(Erad):
-            arPhase = screen.arPhase[i * n_pl:(i + 1) * n_pl]
-            screen_segment.arReEx = np.zeros((screen.ny, screen.nx))
-            screen_segment.arImEx = np.zeros((screen.ny, screen.nx))
-            screen_segment.arReEy = np.zeros((screen.ny, screen.nx))
-            screen_segment.arImEy = np.zeros((screen.ny, screen.nx))
-
-            screen_segment.arPhase = arPhase.reshape((screen.ny, screen.nx))
-
-            # for n in range(Nmotion-1):
-            #    screen_segment = gintegrator(Xscr, Yscr, erad, motion, screen_segment, n, n_end, gamma, half_step)
-            wrap_gintegrator(Nmotion, Xscr, Yscr, erad, motion, screen_segment, n_end, gamma, half_step)
-
-            arReEx = np.append(arReEx, screen_segment.arReEx.flatten())
-            arImEx = np.append(arImEx, screen_segment.arImEx.flatten())
-            arReEy = np.append(arReEy, screen_segment.arReEy.flatten())
-            arImEy = np.append(arImEy, screen_segment.arImEy.flatten())
-            screen.arPhase[i * n_pl:(i + 1) * n_pl] = screen_segment.arPhase.flatten()[:]
-        screen.arReEx[:] += arReEx[:]
-        screen.arImEx[:] += arImEx[:]
-        screen.arReEy[:] += arReEy[:]
-        screen.arImEy[:] += arImEy[:]
+    radiation_fields([gamma], [traj2motion(traj)], screen)
     return 1
 
 
@@ -564,20 +645,13 @@ def calculate_radiation(lat, screen, ebeam, energy_loss=False, quantum_diff=Fals
     # print("traj time exec:", time.time() - start)
     # plt.plot(U[0][4::9, :], U[0][::9, :])
     # plt.show()
+    gammas = []
+    motions = []
     for i in range(p_array.n):
-        # print("%i/%i" % (i, p_array.n))
-        screen_copy = copy.deepcopy(screen)
-        screen_copy.nullify()
-        # wlengthes = h_eV_s*speed_of_light/screen_copy.Eph
-        # screen_copy.arPhase[:] = tau0[i]/wlengthes*2*np.pi
         for u, e in zip(U, E):
-            gamma = (1 + p_array.p()[i]) * e / m_e_GeV
-            radiation_py(gamma, u[:, i], screen_copy)
-        screen.arReEx += screen_copy.arReEx
-        screen.arImEx += screen_copy.arImEx
-        screen.arReEy += screen_copy.arReEy
-        screen.arImEy += screen_copy.arImEy
-        screen.arPhase += screen_copy.arPhase
+            gammas.append((1 + p_array.p()[i]) * e / m_e_GeV)
+            motions.append(traj2motion(u[:, i]))
+    radiation_fields(gammas, motions, screen, nseg=len(U))
     gamma_mean = (1 + np.mean(p_array.p())) * p_array.E / m_e_GeV
     screen.distPhoton(gamma_mean, current=ebeam.I)
     screen.Ef_electron = E[-1]
@@ -621,9 +695,9 @@ def coherent_radiation(lat, screen, p_array, energy_loss=False, quantum_diff=Fal
     U, E = track4rad_beam(p_array, lat, energy_loss=energy_loss, quantum_diff=quantum_diff, accuracy=accuracy)
     # plt.plot(U[0][4::9, :], U[0][::9, :])
     # plt.show()
+    screen_copy = copy.deepcopy(screen)
     for i in range(p_array.n):
         # print("%i/%i" % (i, p_array.n))
-        screen_copy = copy.deepcopy(screen)
         screen_copy.nullify()
 
         wlengthes = h_eV_s * speed_of_light / screen_copy.Eph
@@ -11,6 +11,9 @@ from ocelot.cpbd.beam import (cov_matrix_from_twiss,
                               twiss_iterable_to_df,
                               generate_parray,
                               s_to_cur,
+                              global_slice_analysis,
+                              slice_sums_np,
+                              slice_sums_py,
                               )
 from ocelot.common.globals import m_e_GeV, speed_of_light
 
@@ -159,6 +162,31 @@ def test_get_twiss_from_slice():
                       [tws1.beta_x, tws1.beta_y, tws1.alpha_x, tws1.alpha_y,  tws1.emit_x, tws1.emit_y, tws1.E],
                       rtol=1e-01, atol=1e-05).all()
 
+
+def test_global_slice_analysis_histogram():
+    np.random.seed(0)
+    parray = generate_parray(sigma_tau=1e-4, sigma_p=1e-3, chirp=0.01, nparticles=300000, energy=0.5)
+    parray.rparticles[0] += 0.1 * parray.rparticles[4]
+    slc_sort = global_slice_analysis(parray, method="sort")
+    slc = global_slice_analysis(parray, method="histogram")
+
+    np.testing.assert_allclose(slc.s, slc_sort.s)
+    np.testing.assert_allclose(slc.I, slc_sort.I)
+    core = slice(300, 700)
+    for name in ["ex", "ey", "se", "sig_x", "beta_x"]:
+        np.testing.assert_allclose(getattr(slc, name)[core], getattr(slc_sort, name)[core], rtol=0.02)
+    np.testing.assert_allclose(slc.me[core], slc_sort.me[core], rtol=1e-4)
+
+
+def test_slice_sums_single_pass():
+    parray = generate_parray(sigma_tau=1e-4, nparticles=3000, energy=0.5)
+    shift = np.array([0., 0., 0., 0., 0., 5e8, 1e-5])
+    sums = slice_sums_np(parray.rparticles, 0.5, -4e-4, 1e-5, 80, shift)
+    assert np.sum(sums[:, 0]) == 3000
+    np.testing.assert_allclose(np.sum(slice_sums_py(parray.rparticles, 0.5, -4e-4, 1e-5, 80, shift, 3), axis=0),
+                               sums, rtol=1e-10)
+
+
 def test_parray_I():
     tws0 = Twiss()
     tws0.E = 0.5
@@ -0,0 +1,69 @@
+import copy
+import pickle
+
+import numpy as np
+
+from ocelot.cpbd.csr import CSR, CSRCache
+from ocelot.cpbd.magnetic_lattice import MagneticLattice
+from ocelot.cpbd.elements import Drift, SBend, Marker
+from ocelot.common.globals import m_e_GeV
+
+
+def make_csr(cache=None):
+    b1 = SBend(l=0.5, angle=0.1)
+    b2 = SBend(l=0.5, angle=-0.1)
+    lat = MagneticLattice([Marker(), Drift(l=0.1), b1, Drift(l=1.), b2, Drift(l=0.5), Marker()])
+    csr = CSR(cache=cache, traj_step=0.0005)
+    csr.indx0, csr.indx1 = 0, len(lat.sequence) - 1
+    csr.prepare(lat)
+    return csr
+
+
+def test_csr_cache_kernel_tables():
+    cache = CSRCache()
+    csr = make_csr()
+    csr_cached = make_csr(cache)
+    np.testing.assert_array_equal(csr_cached.csr_traj, csr.csr_traj)
+    gamma = 1. / m_e_GeV
+    i = csr.csr_traj.shape[1] - 200
+    # the table calculated for the longer mesh is reused for the shorter ones
+    for Ndw in [[100, 2e-5], [100, 1e-5], [60, 1.3e-5]]:
+        np.testing.assert_array_equal(csr_cached.CSR_K1(i, csr_cached.csr_traj, Ndw, gamma),
+                                      csr.CSR_K1(i, csr.csr_traj, Ndw, gamma))
+    assert cache.misses == 1 and cache.hits == 2
+    # the longer mesh requires recalculation
+    K1 = csr_cached.CSR_K1(i, csr_cached.csr_traj, [200, 2e-5], gamma)
+    np.testing.assert_array_equal(K1, csr.CSR_K1(i, csr.csr_traj, [200, 2e-5], gamma))
+    assert cache.misses == 2
+    assert copy.deepcopy(csr_cached).cache is cache
+
+
+def test_csr_cache_on_disk(tmp_path):
+    cache = CSRCache(cache_dir=str(tmp_path))
+    csr = make_csr(cache)
+    gamma = 1. / m_e_GeV
+    idx = [300, 800, csr.csr_traj.shape[1] - 1]
+    K1 = [csr.CSR_K1(i, csr.csr_traj, [100, 2e-5], gamma) for i in idx]
+    csr.finalize()
+
+    # a new process gets only the location of the cache
+    cache2 = pickle.loads(pickle.dumps(cache))
+    assert len(cache2.trajectories) == 0 and len(cache2.kernel_tables) == 0
+    csr2 = make_csr(cache2)
+    np.testing.assert_array_equal(csr2.csr_traj, csr.csr_traj)
+    for i, k1 in zip(idx, K1):
+        np.testing.assert_array_equal(csr2.CSR_K1(i, csr2.csr_traj, [100, 2e-5], gamma), k1)
+    assert cache2.misses == 0 and cache2.hits == 3
+
+
+def test_csr_k1_block():
+    csr = make_csr()
+    gamma = 1. / m_e_GeV
+    n = csr.csr_traj.shape[1]
+    # observers in the bend, in the drift and in the second bend
+    for itr in [np.arange(300, 400, 3), np.arange(1500, 1580, 2), np.arange(n - 300, n - 1, 7)]:
+        K1 = 0
+        for i in itr:
+            K1 += csr.CSR_K1(i, csr.csr_traj, [100, 2e-5], gamma)
+        np.testing.assert_allclose(csr.CSR_K1_block(itr, csr.csr_traj, [100, 2e-5], gamma), K1,
+                                   rtol=1e-9, atol=1e-9 * np.max(np.abs(K1)))
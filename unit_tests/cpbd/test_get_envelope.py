@@ -2,7 +2,7 @@ import numpy as np
 import matplotlib.pyplot as plt
 from ocelot.cpbd.magnetic_lattice import MagneticLattice
 from ocelot.cpbd.elements import Drift, Bend, Marker
-from ocelot.cpbd.beam import Twiss, generate_parray
+from ocelot.cpbd.beam import Twiss, generate_parray, beam_moments_np, beam_moment_sums_py
 from ocelot.cpbd.track import track
 from ocelot.cpbd.optics import twiss
 from ocelot.cpbd.navi import Navigator
@@ -154,8 +154,34 @@ def test_twiss_with_custom_function():
     np.testing.assert_allclose(tws_track_end.emit_yn, tws_ref.emit_yn, rtol=0.02)
 
 
+def test_beam_moments_single_pass_sums():
+    parray = generate_parray(sigma_x=1e-4, sigma_px=2e-5, sigma_tau=1e-4, sigma_p=1e-3, chirp=0.01, nparticles=2000)
+    rp = parray.rparticles
+    D = np.array([1e-3, 2e-4, 0., 1e-4])
+    n, mean, cov = beam_moments_np(rp, D=D, tau_bounds=(-1e-4, 1e-4))
+
+    # reference: the corrected coordinates as in the former get_envelope()
+    inds = (-1e-4 <= rp[4]) & (rp[4] <= 1e-4)
+    x, px, y, py, tau, p = rp[:, inds]
+    x, px, y, py = x - D[0] * p, px - D[1] * p, y - D[2] * p, py - D[3] * p
+    px = px * (1. - p - 0.5 * p * p + 0.5 * px * px + 0.5 * py * py)
+    py = py * (1. - p - 0.5 * p * p + 0.5 * px * px + 0.5 * py * py)
+    ref = np.array([x, px, y, py, tau, p])
+    assert n == np.sum(inds)
+    np.testing.assert_allclose(mean, np.mean(ref, axis=1), rtol=1e-10)
+    np.testing.assert_allclose(cov, np.cov(ref, bias=True), rtol=1e-8, atol=1e-25)
+
+    counts, sums, prods = beam_moment_sums_py(rp, D, -1e-4, 1e-4, True, rp[:, 0].copy(), 3)
+    assert np.sum(counts) == n
+    s1 = np.sum(sums, axis=0) / n
+    s2 = np.sum(prods, axis=0) / n
+    s2 = np.triu(s2) + np.triu(s2, 1).T
+    np.testing.assert_allclose(rp[:, 0] + s1, mean, rtol=1e-10)
+    np.testing.assert_allclose(s2 - np.outer(s1, s1), cov, rtol=1e-8, atol=1e-25)
+
+
 if __name__ == "__main__":
     test_twiss_dispersion_correction()
     print("Twiss dispersion correction test passed.")
     test_twiss_with_custom_function()
-    print("Custom get_twiss function test passed.")
\ No newline at end of file
+    print("Custom get_twiss function test passed.")
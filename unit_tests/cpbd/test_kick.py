@@ -0,0 +1,80 @@
+import numpy as np
+import pytest
+
+from ocelot.cpbd.elements import Sextupole, Octupole
+from ocelot.cpbd.transformations import KickTM
+from ocelot.cpbd.tm_utils import transform_vec_ent, transform_vec_ext
+from ocelot.cpbd.beam import Particle
+
+
+def kick_reference(X, l, angle, k1, k2, k3, energy, nkick, dx, dy, tilt):
+    X = transform_vec_ent(X, dx, dy, tilt)
+    gamma2 = (energy / 0.51099895e-3) ** 2
+    beta = 1. - 0.5 / gamma2
+    coef = 1. / (beta * beta * gamma2)
+    l, angle = l / nkick, angle / nkick
+    dl = l / 2.
+    k1, k2, k3 = k1 * l, k2 * l / 2., k3 * l / 6.
+    for i in range(nkick):
+        x = X[0] + X[1] * dl
+        y = X[2] + X[3] * dl
+        xy1 = x + 1j * y
+        p = -angle * X[5] + k1 * xy1 + k2 * xy1 ** 2 + k3 * xy1 ** 3
+        X[1] = X[1] - np.real(p)
+        X[3] = X[3] + np.imag(p)
+        X[4] = X[4] + np.real(angle * xy1) / beta - X[5] * dl * coef
+        X[0] = x + X[1] * dl
+        X[2] = y + X[3] * dl
+    return transform_vec_ext(X, dx, dy, tilt)
+
+
+def kick_tm(nkick, integrator="leapfrog"):
+    sext = Sextupole(l=0.3, k2=300., tilt=0.03)
+    sext.dx, sext.dy = 1e-4, -2e-4
+    sext.set_tm(KickTM, nkick=nkick, integrator=integrator)
+    return sext.tms[0]
+
+
+def make_particles():
+    np.random.seed(0)
+    return np.random.randn(6, 1000) * np.array([[1e-3], [1e-4], [1e-3], [1e-4], [1e-4], [1e-3]])
+
+
+@pytest.mark.parametrize("nkick", [1, 7])
+def test_kick_leapfrog(nkick):
+    X0 = make_particles()
+    X = X0.copy()
+    kick_tm(nkick).map_function(X, energy=2.)
+    X_ref = kick_reference(X0.copy(), 0.3, 0., 0., 300., 0., 2., nkick, 1e-4, -2e-4, 0.03)
+    np.testing.assert_allclose(X, X_ref, rtol=1e-12, atol=1e-16)
+
+    oct = Octupole(l=0.2, k3=5000.)
+    oct.set_tm(KickTM, nkick=nkick)
+    X = X0.copy()
+    oct.tms[0].map_function(X, energy=2.)
+    X_ref = kick_reference(X0.copy(), 0.2, 0., 0., 0., 5000., 2., nkick, 0., 0., 0.)
+    np.testing.assert_allclose(X, X_ref, rtol=1e-12, atol=1e-16)
+
+    p = Particle(x=1e-3, y=-2e-3, px=1e-4, E=2.)
+    kick_tm(nkick).apply(p)
+    X = X0[:, :1].copy()
+    X[:, 0] = [1e-3, 1e-4, -2e-3, 0., 0., 0.]
+    kick_tm(nkick).map_function(X, energy=2.)
+    np.testing.assert_allclose([p.x, p.px, p.y, p.py, p.tau, p.p], X[:, 0], rtol=1e-14)
+
+
+def test_kick_yoshida():
+    X0 = make_particles()
+    X_exact = X0.copy()
+    kick_tm(2000).map_function(X_exact, energy=2.)
+
+    def error(nkick, integrator):
+        X = X0.copy()
+        kick_tm(nkick, integrator).map_function(X, energy=2.)
+        return np.max(np.abs(X[:4] - X_exact[:4]))
+
+    # 4th order convergence and the same accuracy as leapfrog with 5 times more slices
+    assert error(5, "yoshida4") / error(10, "yoshida4") > 10
+    assert error(2, "yoshida4") < error(10, "leapfrog")
+    with pytest.raises(ValueError):
+        kick_tm(2, "rk4")
@@ -0,0 +1,142 @@
+import importlib
+
+import numpy as np
+import pytest
+from scipy.optimize import least_squares
+
+from ocelot.cpbd.beam import Twiss
+from ocelot.cpbd.elements import Drift, Quadrupole, SBend, Cavity, Marker
+from ocelot.cpbd.magnetic_lattice import MagneticLattice
+from ocelot.cpbd.optics import twiss, twiss_blocks
+from ocelot.cpbd.match import MatchOptics, match, element_derivatives
+
+# ocelot.cpbd.match is shadowed by the function match in the package namespace
+match_module = importlib.import_module("ocelot.cpbd.match")
+
+
+def make_lattice():
+    qf = Quadrupole(l=0.3, k1=1.2, tilt=0.01)
+    qd = Quadrupole(l=0.3, k1=-1.2)
+    b = SBend(l=1.5, angle=0.01, e1=0.001)
+    d = Drift(l=0.35)
+    cav = Cavity(l=1, v=0.02, phi=10, freq=1.3e9)
+    cell = [Marker(), qf, d, b, d, qd, d, b, d, cav, d, qf, d, qd, d]
+    return MagneticLattice(cell * 5), qf, qd, d
+
+
+def make_twiss():
+    tws0 = Twiss()
+    tws0.beta_x = 10.
+    tws0.beta_y = 5.
+    tws0.alpha_x = -1.
+    tws0.alpha_y = 0.5
+    tws0.Dx = 0.01
+    tws0.E = 0.5
+    tws0.s = 0.
+    return tws0
+
+
+def test_match_optics_update():
+    lat, qf, qd, d = make_lattice()
+    tws0 = make_twiss()
+    optics = MatchOptics(lat, tws0)
+    optics.evaluate(tws0)
+    for elem, attr in [(qd, "k1"), (d, "l")]:
+        setattr(elem, attr, getattr(elem, attr) * 1.1)
+        first = optics.update_elements([elem])
+        assert first == optics.element_rows(elem)[0] - 1
+        table = optics.evaluate(tws0, first=first)
+        tws = twiss(lat, tws0)
+        for name in ["beta_x", "alpha_x", "beta_y", "alpha_y", "Dx", "Dxp", "mux", "muy", "s", "E"]:
+            np.testing.assert_allclose(getattr(table, name), [getattr(tw, name) for tw in tws], rtol=1e-10, atol=1e-12)
+
+
+def test_match_last_constraint():
+    lat, qf, qd, d = make_lattice()
+    tws0 = make_twiss()
+    m = Marker()
+    lat = MagneticLattice(lat.sequence[:30] + [m] + lat.sequence[30:])
+    row = MatchOptics(lat, tws0).element_rows(m)[0]
+    qf.k1, qd.k1 = 1.25, -1.1
+    tws = twiss(lat, tws0)
+    assert tws[row].id == m.id
+    beta_x, beta_y = tws[row].beta_x, tws[row].beta_y
+
+    qf.k1, qd.k1 = 1.2, -1.2
+    res = match(lat, {m: {"beta_x": beta_x, "beta_y": beta_y}}, [qf, qd], tws0, verbose=False)
+    np.testing.assert_allclose(res, [1.25, -1.1], rtol=1e-3)
+
+    qf.k1, qd.k1 = 1.2, -1.2
+    match(lat, {m: {"beta_x": beta_x, "beta_y": beta_y}}, [qf, qd], tws0, verbose=False, method="lsq")
+    tws = twiss(lat, tws0)
+    np.testing.assert_allclose([tws[row].beta_x, tws[row].beta_y], [beta_x, beta_y], rtol=1e-8)
+
+
+def test_match_optics_derivatives():
+    lat, qf, qd, d = make_lattice()
+    tws0 = make_twiss()
+    names = ["beta_x", "alpha_x", "beta_y", "alpha_y", "Dx", "Dxp", "mux", "muy", "s"]
+    for elem, attr in [(qf, "k1"), (d, "l"), (lat.sequence[3], "angle")]:
+        optics = MatchOptics(lat, tws0)
+        table = optics.evaluate(tws0)
+        dmaps = {}
+        for e, (start, count) in zip(lat.sequence, optics.elem_rows):
+            if e is elem:
+                dR, dl = element_derivatives(e, attr, optics.energies[start:start + count])
+                dMx, dMy = twiss_blocks(dR, optics.k[start:start + count])
+                dMx[:, 2, 2] = dMy[:, 2, 2] = 0.
+                for m in range(count):
+                    dmaps[start + m] = (dMx[m], dMy[m], dl[m])
+        optics.prepare_derivatives()
+        der = optics.derivatives(np.arange(len(table)), dmaps, {})
+
+        x0 = getattr(elem, attr)
+        h = 1e-6
+        setattr(elem, attr, x0 + h)
+        tws_p = twiss(lat, tws0)
+        setattr(elem, attr, x0 - h)
+        tws_m = twiss(lat, tws0)
+        setattr(elem, attr, x0)
+        for name in names:
+            num = (np.array([getattr(tw, name) for tw in tws_p]) - [getattr(tw, name) for tw in tws_m]) / (2 * h)
+            np.testing.assert_allclose(der[name], num, rtol=1e-5, atol=1e-6 * np.max(np.abs(num)) + 1e-9)
+
+
+def test_match_lsq_periodic():
+    qf = Quadrupole(l=0.3, k1=1.)
+    qd = Quadrupole(l=0.3, k1=-1.)
+    d = Drift(l=1.)
+    end = Marker()
+    lat = MagneticLattice([qf, d, qd, d, end])
+    tws0 = Twiss()
+    tws0.E = 1.
+    match(lat, {end: {"mux": 0.9, "muy": 0.8}, "periodic": True}, [qf, qd], tws0, verbose=False, method="lsq")
+    tws = twiss(lat, lat.periodic_twiss(tws0))
+    np.testing.assert_allclose([tws[-1].mux, tws[-1].muy], [0.9, 0.8], rtol=1e-8)
+
+
+def test_match_lsq_relative_constraint_negative(monkeypatch):
+    # a negative value with the '->' constraint gets the additional penalty as in errf
+    lat, qf, qd, d = make_lattice()
+    tws0 = make_twiss()
+    m1, m2 = Marker(), Marker()
+    lat = MagneticLattice([m1] + lat.sequence[:10] + [m2] + lat.sequence[10:])
+    rows = MatchOptics(lat, tws0).element_rows
+    row1, row2 = rows(m1)[0], rows(m2)[0]
+    tws = twiss(lat, tws0)
+    val, target = tws[row2].alpha_x, tws[row1].alpha_x + 0.3
+    assert val < 0
+
+    calls = []
+
+    def least_squares_spy(fun, x0, jac, **kwargs):
+        calls.append((fun(x0), jac(x0)))
+        return least_squares(fun, x0, jac=jac, **kwargs)
+
+    monkeypatch.setattr(match_module, "least_squares", least_squares_spy)
+    match(lat, {m2: {"alpha_x": ['->', m1, 0.3]}}, [qf, qd], tws0, verbose=False, method="lsq")
+    res, J = calls[0]
+    np.testing.assert_allclose(res, [val - target] * 2, rtol=1e-10)
+    np.testing.assert_array_equal(J[0], J[1])
+    tws = twiss(lat, tws0)
+    assert tws[row2].alpha_x == pytest.approx(tws[row1].alpha_x + 0.3, abs=1e-5)
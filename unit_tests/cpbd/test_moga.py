@@ -0,0 +1,59 @@
+import pytest
+import numpy as np
+
+try:
+    from ocelot.cpbd.moga import Moga, SerialEvaluator, PoolEvaluator
+    MISSING_DEAP_DEPENDENCY = False
+except ImportError:
+    MISSING_DEAP_DEPENDENCY = True
+REASON = "Missing optional dependency deap"
+
+
+def fit_func(x0, iter_data, args):
+    x = np.array(x0)
+    return np.sum(x ** 2), np.sum((x - args[0]) ** 2)
+
+
+def run_moga(evaluator, checkpoint_file=None, memo_decimals=12):
+    opt = Moga(bounds=[(-1., 1.)] * 3)
+    opt.set_params(n_pop=20, n_gen=4, seed=1, log_file=None, plt_file=None, evaluator=evaluator,
+                   memo_decimals=memo_decimals, checkpoint_file=checkpoint_file)
+    opt.log_print = False
+    # with low mutation probability some children are copies of their parents
+    res = opt.nsga2(fit_func, fit_func_args=[0.5], cxpb=0.5, mutpb=0.2)
+    return opt, [ind.fitness.values for ind in res]
+
+
+@pytest.mark.skipif(MISSING_DEAP_DEPENDENCY, reason=REASON)
+def test_moga_memo_and_checkpoint(tmp_path):
+    class CountEvaluator(SerialEvaluator):
+        def __init__(self):
+            self.n_eval = 0
+
+        def __call__(self, evaluate, tasks, iteration, args):
+            self.n_eval += len(tasks)
+            return SerialEvaluator.__call__(self, evaluate, tasks, iteration, args)
+
+    evaluator = CountEvaluator()
+    checkpoint_file = str(tmp_path / "moga.pkl")
+    opt, fits = run_moga(evaluator, checkpoint_file=checkpoint_file)
+    assert opt.n_memo_hits > 0
+    assert evaluator.n_eval == len(opt.memo)
+
+    evaluator_no_memo = CountEvaluator()
+    _, fits_no_memo = run_moga(evaluator_no_memo, memo_decimals=None)
+    assert evaluator_no_memo.n_eval > evaluator.n_eval
+    np.testing.assert_allclose(fits, fits_no_memo)
+
+    data = Moga(bounds=[(-1., 1.)] * 3).load_checkpoint(checkpoint_file)
+    assert data["iteration"] == 4
+    assert len(data["population"]) == 20
+    for x, fit in zip(data["population"], data["fitness"]):
+        np.testing.assert_allclose(fit, fit_func(x, None, [0.5]))
+
+
+@pytest.mark.skipif(MISSING_DEAP_DEPENDENCY, reason=REASON)
+def test_moga_pool_evaluator():
+    _, fits = run_moga(SerialEvaluator())
+    _, fits_pool = run_moga(PoolEvaluator(nproc=2))
+    np.testing.assert_allclose(fits_pool, fits)
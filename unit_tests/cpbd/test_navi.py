@@ -0,0 +1,119 @@
+import copy
+
+import pytest
+import numpy as np
+
+from ocelot.cpbd.navi import Navigator, merge_transfer_maps
+from ocelot.cpbd.magnetic_lattice import MagneticLattice
+from ocelot.cpbd.elements import Drift, Quadrupole, SBend, Marker, Cavity
+from ocelot.cpbd.transformations import SecondTM, TransferMap
+from ocelot.cpbd.physics_proc import PhysProc
+from ocelot.cpbd.beam import generate_parray
+from ocelot.cpbd.track import track
+
+
+def make_lattice(method):
+    d = Drift(l=0.5)
+    qf = Quadrupole(l=0.2, k1=1.2, tilt=0.1)
+    qd = Quadrupole(l=0.2, k1=-1.2)
+    b = SBend(l=0.5, angle=0.05, e1=0.01, e2=0.02)
+    cell = [Marker(), d, qf, d, b, d, qd, d, Cavity(l=1, v=0.02, phi=10, freq=1.3e9), d] * 3
+    return MagneticLattice(cell, method={"global": method})
+
+
+def track_with_navi(lat, parray0, merge_maps):
+    navi = Navigator(lat, unit_step=0.3, merge_maps=merge_maps)
+    navi.add_physics_proc(PhysProc(step=3), lat.sequence[0], lat.sequence[-1])
+    _, parray = track(lat, copy.deepcopy(parray0), navi, print_progress=False, calc_tws=False)
+    return parray, navi
+
+
+def test_merge_transfer_maps_keeps_other_tms():
+    lat = make_lattice(TransferMap)
+    tms = []
+    for elem in lat.sequence:
+        tms += elem.get_section_tms(delta_l=elem.l)
+    merged = merge_transfer_maps(tms)
+    # CavityTMs break the runs of TransferMaps
+    n_cavity_tms = len([tm for tm in tms if type(tm) != TransferMap])
+    assert len(merged) == n_cavity_tms + 3 + 1
+    assert [tm for tm in merged if type(tm) != TransferMap] == [tm for tm in tms if type(tm) != TransferMap]
+    assert np.isclose(np.sum([tm.length for tm in merged]), lat.totalLen)
+
+
+@pytest.mark.parametrize("method, rtol", [(TransferMap, 1e-12), (SecondTM, 1e-2)])
+def test_track_with_merged_maps(method, rtol):
+    lat = make_lattice(method)
+    parray0 = generate_parray(nparticles=1000, energy=0.5)
+
+    parray, _ = track_with_navi(lat, parray0, merge_maps=False)
+    parray_merged, navi = track_with_navi(lat, parray0, merge_maps=True)
+
+    assert len(navi._merged_maps) > 0
+    np.testing.assert_allclose(parray_merged.E, parray.E)
+    np.testing.assert_allclose(parray_merged.s, parray.s)
+    np.testing.assert_allclose(parray_merged.rparticles, parray.rparticles, rtol=rtol, atol=1e-10)
+
+
+def test_merged_maps_rebuilt_after_element_change():
+    lat = make_lattice(TransferMap)
+    parray0 = generate_parray(nparticles=1000, energy=0.5)
+    navi = Navigator(lat, unit_step=0.3, merge_maps=True)
+    track(lat, copy.deepcopy(parray0), navi, print_progress=False, calc_tws=False)
+
+    for elem in lat.sequence:
+        if isinstance(elem, Quadrupole):
+            elem.k1 *= 1.1
+    navi.reset_position()
+    _, parray_merged = track(lat, copy.deepcopy(parray0), navi, print_progress=False, calc_tws=False)
+    parray, _ = track_with_navi(lat, parray0, merge_maps=False)
+    np.testing.assert_allclose(parray_merged.rparticles, parray.rparticles, atol=1e-12)
+
+
+def test_track_timings():
+    lat = make_lattice(SecondTM)
+    parray0 = generate_parray(nparticles=1000, energy=0.5)
+    navi = Navigator(lat, unit_step=0.3)
+    navi.add_physics_proc(PhysProc(step=3), lat.sequence[0], lat.sequence[-1])
+    timings = {}
+    _, parray = track(lat, copy.deepcopy(parray0), navi, print_progress=False, timings=timings)
+    assert set(timings) == {"SecondTM", "CavityTM", "PhysProc", "get_twiss"}
+    assert all(t > 0 for t in timings.values())
+
+    navi.reset_position()
+    _, parray_ref = track(lat, copy.deepcopy(parray0), navi, print_progress=False)
+    np.testing.assert_allclose(parray.rparticles, parray_ref.rparticles)
+
+
+def test_section_maps_cache():
+    lat = make_lattice(SecondTM)
+    parray0 = generate_parray(nparticles=1000, energy=0.5)
+    navi = Navigator(lat, unit_step=0.3)
+    navi.add_physics_proc(PhysProc(step=3), lat.sequence[0], lat.sequence[-1])
+    navi.section_maps_size = 0
+    _, parray_ref = track(lat, copy.deepcopy(parray0), navi, print_progress=False, calc_tws=False)
+    assert len(navi._section_maps) == 0
+
+    parray, navi = track_with_navi(lat, parray0, merge_maps=False)
+    assert len(navi._section_maps) > 0
+    np.testing.assert_array_equal(parray.rparticles, parray_ref.rparticles)
+    navi.reset_position()
+    tms = navi.get_map(0.3, energy=0.5)
+    navi.reset_position()
+    assert all(tm1 is tm2 for tm1, tm2 in zip(tms, navi.get_map(0.3, energy=0.5)))
+    navi.reset_position()
+    assert all(tm1 is not tm2 for tm1, tm2 in zip(tms, navi.get_map(0.3, energy=1.)))
+
+    # the sections are rebuilt after an element change
+    for elem in lat.sequence:
+        if isinstance(elem, Quadrupole):
+            elem.k1 *= 1.1
+    navi.reset_position()
+    _, parray_cached = track(lat, copy.deepcopy(parray0), navi, print_progress=False, calc_tws=False)
+    parray, _ = track_with_navi(lat, parray0, merge_maps=False)
+    np.testing.assert_array_equal(parray_cached.rparticles, parray.rparticles)
+
+    navi.section_maps_size = 5
+    navi.reset_position()
+    navi.get_map(lat.totalLen)
+    assert len(navi._section_maps) == 5
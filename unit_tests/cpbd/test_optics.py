@@ -0,0 +1,64 @@
+import numpy as np
+
+from ocelot.cpbd.beam import Twiss, twiss_iterable_to_df
+from ocelot.cpbd.elements import Drift, Quadrupole, SBend, Cavity, Marker
+from ocelot.cpbd.magnetic_lattice import MagneticLattice
+from ocelot.cpbd.optics import twiss, twiss_table, prefix_products
+
+
+def make_lattice():
+    qf = Quadrupole(l=0.3, k1=1.2, tilt=0.01)
+    qd = Quadrupole(l=0.3, k1=-1.2)
+    b = SBend(l=1.5, angle=0.01, e1=0.001)
+    d = Drift(l=0.35)
+    cav = Cavity(l=1, v=0.02, phi=10, freq=1.3e9)
+    cell = [Marker(), qf, d, b, d, qd, d, b, d, cav, d, qf, d, qd, d]
+    return MagneticLattice(cell * 20)
+
+
+def trace_twiss(lat, tws0):
+    tws_list = [tws0]
+    tws = tws0
+    for e in lat.sequence:
+        for tm in e.first_order_tms:
+            tws = tm * tws
+            tws.id = e.id
+            tws_list.append(tws)
+    return tws_list
+
+
+def test_prefix_products():
+    rng = np.random.default_rng(0)
+    M = rng.normal(size=(13, 3, 3))
+    P = prefix_products(M)
+    Q = M[0]
+    for i in range(1, 13):
+        Q = M[i] @ Q
+        np.testing.assert_allclose(P[i], Q, rtol=1e-12)
+
+
+def test_twiss_table():
+    lat = make_lattice()
+    tws0 = Twiss(beta_x=10, beta_y=5, alpha_x=0.3, E=3, emit_xn=1e-6, emit_yn=1e-6, Dx=0.1)
+    tws_ref = trace_twiss(lat, tws0)
+    table = twiss_table(lat, tws0)
+
+    assert len(table) == len(tws_ref)
+    assert table[0] is tws0
+    df_ref = twiss_iterable_to_df(tws_ref)
+    df = table.to_df()
+    assert list(df.columns) == list(df_ref.columns)
+    for col in df_ref.columns:
+        if col == "id":
+            assert list(df[col]) == list(df_ref[col])
+        else:
+            np.testing.assert_allclose(df[col].values.astype(float), df_ref[col].values.astype(float),
+                                       rtol=1e-10, atol=1e-12)
+    np.testing.assert_allclose(table.gamma_x, [tw.gamma_x for tw in tws_ref], rtol=1e-10)
+    np.testing.assert_allclose(table.emit_x, [tw.emit_x for tw in tws_ref], rtol=1e-12)
+
+    tws = twiss(lat, tws0)
+    assert isinstance(tws, list)
+    assert np.isclose(tws[-1].beta_x, tws_ref[-1].beta_x, rtol=1e-10)
+    assert np.isclose(tws[-1].muy, tws_ref[-1].muy, rtol=1e-10)
+    assert tws[-1].id == tws_ref[-1].id
@@ -0,0 +1,86 @@
+import copy
+
+import pytest
+import numpy as np
+
+from ocelot.cpbd.parallel import ParticleComm, get_envelope_mpi, track_mpi, scatter_parray, gather_parray
+from ocelot.cpbd.beam import ParticleArray, generate_parray, get_envelope, s_to_cur
+from ocelot.cpbd.wake3D import s2current
+from ocelot.cpbd.sc import SpaceCharge, LSC
+from ocelot.cpbd.csr import CSR
+from ocelot.cpbd.physics_proc import EmptyProc
+from ocelot.cpbd.navi import Navigator
+from ocelot.cpbd.magnetic_lattice import MagneticLattice
+from ocelot.cpbd.elements import Drift, SBend, Quadrupole
+from ocelot.cpbd.track import track
+from ocelot.common.globals import speed_of_light
+
+TWISS_ATTRS = ["x", "px", "y", "py", "tau", "p", "xx", "xpx", "pxpx", "yy", "ypy", "pypy", "tautau", "pp",
+               "emit_x", "emit_y", "beta_x", "alpha_y", "eigemit_1", "Dx", "Dyp"]
+
+
+@pytest.mark.parametrize("kwargs", [{}, {"bounds": [-2, 2]}, {"bounds": [-1, 1], "slice": "Imax"},
+                                    {"auto_disp": True}])
+def test_get_envelope_mpi(kwargs):
+    parray = generate_parray(nparticles=20000, chirp=0.01, energy=0.5)
+    tws = get_envelope(parray, **kwargs)
+    tws_mpi = get_envelope_mpi(parray, ParticleComm(), **kwargs)
+    for attr in TWISS_ATTRS:
+        np.testing.assert_allclose(getattr(tws_mpi, attr), getattr(tws, attr), rtol=1e-9, atol=1e-18)
+
+
+def test_current_profiles_with_comm():
+    parray = generate_parray(nparticles=20000, energy=0.5)
+    comm = ParticleComm()
+    tau = parray.tau()
+    np.testing.assert_allclose(s2current(tau, parray.q_array, 300, 10, speed_of_light, comm=comm),
+                               s2current(tau, parray.q_array, 300, 10, speed_of_light))
+    np.testing.assert_allclose(s_to_cur(tau, 0.01 * np.std(tau), 1e-9, speed_of_light, comm=comm),
+                               s_to_cur(tau, 0.01 * np.std(tau), 1e-9, speed_of_light))
+
+
+def test_track_mpi_single_process():
+    b1 = SBend(l=0.5, angle=0.05)
+    b2 = SBend(l=0.5, angle=-0.05)
+    lat = MagneticLattice([Drift(l=0.5), Quadrupole(l=0.2, k1=1.), b1, Drift(l=1.), b2, Drift(l=0.5)])
+    parray0 = generate_parray(nparticles=20000, chirp=0.01, energy=0.2)
+
+    def navigator():
+        navi = Navigator(lat, unit_step=0.1)
+        navi.add_physics_proc(SpaceCharge(nmesh_xyz=[31, 31, 31]), lat.sequence[0], lat.sequence[1])
+        navi.add_physics_proc(CSR(energy=0.2), lat.sequence[2], lat.sequence[-1])
+        navi.add_physics_proc(LSC(), lat.sequence[0], lat.sequence[-1])
+        return navi
+
+    tws, parray = track(lat, copy.deepcopy(parray0), navigator(), print_progress=False)
+    comm = ParticleComm()
+    navi = navigator()
+    parray_local = scatter_parray(copy.deepcopy(parray0), comm)
+    tws_mpi, parray_mpi = track_mpi(lat, parray_local, navi, comm, print_progress=False)
+    parray_mpi = gather_parray(parray_mpi, comm)
+
+    assert all(p.comm is comm for p in navi.process_table.proc_list)
+    # the distributed CSR binning uses equidistant sub-bins, the rest is the same up to rounding
+    np.testing.assert_allclose(parray_mpi.rparticles, parray.rparticles, rtol=1e-4, atol=1e-9)
+    np.testing.assert_allclose([tw.emit_x for tw in tws_mpi], [tw.emit_x for tw in tws], rtol=1e-4)
+
+
+class OtherRanksComm(ParticleComm):
+    """serial ParticleComm which pretends that the other ranks hold n_other particles"""
+    def __init__(self, n_other):
+        ParticleComm.__init__(self)
+        self.n_other = n_other
+
+    def sum(self, a, axis=None):
+        return ParticleComm.sum(self, a, axis) + self.n_other
+
+
+@pytest.mark.parametrize("n_other, nsteps", [(0, 0), (100, 8)])
+def test_track_mpi_stops_on_global_loss(n_other, nsteps):
+    # the local particles are lost, the tracking goes on while other ranks have particles
+    lat = MagneticLattice([Drift(l=0.5), Quadrupole(l=0.2, k1=1.), Drift(l=0.3)])
+    navi = Navigator(lat, unit_step=0.1)
+    navi.add_physics_proc(EmptyProc(), lat.sequence[0], lat.sequence[-1])
+    tws, _ = track_mpi(lat, ParticleArray(n=0), navi, OtherRanksComm(n_other), print_progress=False,
+                       calc_tws=False)
+    assert len(tws) == 1 + nsteps
@@ -0,0 +1,87 @@
+import numpy as np
+import pytest
+
+from ocelot.cpbd.beam import Twiss
+from ocelot.cpbd.elements import Drift, Quadrupole, SBend, Hcor, Vcor, Monitor
+from ocelot.cpbd.magnetic_lattice import MagneticLattice
+from ocelot.cpbd.response_matrix import LinacSimRM, LinacAnalyticRM, RingAnalyticRM, MeasureResponseMatrix
+
+
+def make_lattice(ncells, k1, angle):
+    cell, hcors, vcors, bpms = [], [], [], []
+    for i in range(ncells):
+        hcor, vcor, bpm = Hcor(l=0.1 * (i % 2)), Vcor(), Monitor()
+        hcors.append(hcor)
+        vcors.append(vcor)
+        bpms.append(bpm)
+        cell += [Quadrupole(l=0.3, k1=k1, tilt=0.01 * (i % 2)), Drift(l=1.), hcor, vcor, bpm, Drift(l=0.5),
+                 Quadrupole(l=0.3, k1=-k1), Drift(l=1.), SBend(l=1., angle=angle), Drift(l=0.5),
+                 SBend(l=1., angle=angle)]
+    lat = MagneticLattice(cell)
+    s = 0.
+    for elem in lat.sequence:
+        s += elem.l
+        elem.s = s
+    return lat, hcors, vcors, bpms
+
+
+def test_linac_analytic_rm():
+    lat, hcors, vcors, bpms = make_lattice(5, k1=1.5, angle=0.01)
+    tws0 = Twiss()
+    tws0.E = 0.5
+    resp_sim = LinacSimRM(lat, hcors, vcors, bpms).calculate(tws0)
+    rm = LinacAnalyticRM(lat, hcors, vcors, bpms, block_size=3, nthread=2)
+    resp = rm.calculate(tws0)
+    np.testing.assert_allclose(resp, resp_sim, atol=1e-10 * np.max(np.abs(resp_sim)))
+
+    # cached while the lattice is the same
+    assert rm.calculate(tws0) is not resp
+    np.testing.assert_array_equal(rm.calculate(tws0), resp)
+    lat.sequence[11].k1 = 1.6
+    resp_new = rm.calculate(tws0)
+    np.testing.assert_allclose(resp_new, LinacSimRM(lat, hcors, vcors, bpms).calculate(tws0),
+                               atol=1e-10 * np.max(np.abs(resp_sim)))
+    assert np.max(np.abs(resp_new - resp)) > 1e-3
+
+
+def test_ring_analytic_rm():
+    lat, hcors, vcors, bpms = make_lattice(8, k1=0.4, angle=np.pi / 8)
+    resp = RingAnalyticRM(lat, hcors, vcors, bpms, block_size=5).calculate(Twiss())
+
+    rm = MeasureResponseMatrix(lat, hcors, vcors, bpms)
+    X0, Y0 = rm.read_virtual_orbit()
+    kick = 1e-6
+    for j, cor in [(0, hcors[0]), (5, hcors[5]), (8, vcors[0]), (11, vcors[3])]:
+        cor.angle = kick
+        lat.update_transfer_maps()
+        X1, Y1 = rm.read_virtual_orbit()
+        cor.angle = 0.
+        lat.update_transfer_maps()
+        np.testing.assert_allclose(resp[:, j], np.append(X1 - X0, Y1 - Y0) / kick, atol=1e-6)
+
+
+def make_lattice_repeated(ncells, shared):
+    cell = []
+    hcor, vcor, bpm = Hcor(), Vcor(), Monitor()
+    for i in range(ncells):
+        if not shared:
+            hcor, vcor, bpm = Hcor(), Vcor(), Monitor()
+        cell += [Quadrupole(l=0.3, k1=1.2), Drift(l=1.), hcor, vcor, bpm, Drift(l=0.5),
+                 Quadrupole(l=0.3, k1=-1.2), Drift(l=1.), SBend(l=1., angle=np.pi / ncells), Drift(l=0.5)]
+    lat = MagneticLattice(cell)
+    hcors = [elem for elem in lat.sequence if elem.__class__ == Hcor]
+    vcors = [elem for elem in lat.sequence if elem.__class__ == Vcor]
+    bpms = [elem for elem in lat.sequence if elem.__class__ == Monitor]
+    return lat, hcors, vcors, bpms
+
+
+@pytest.mark.parametrize("rm_class", [LinacAnalyticRM, RingAnalyticRM])
+def test_analytic_rm_repeated_elements(rm_class):
+    # the same corrector and bpm objects are in every cell, the rows are found by the position in the sequence
+    tws0 = Twiss()
+    tws0.E = 1.
+    resp_ref = rm_class(*make_lattice_repeated(6, shared=False)).calculate(tws0)
+    lat, hcors, vcors, bpms = make_lattice_repeated(6, shared=True)
+    assert len(set(map(id, bpms))) == 1
+    resp = rm_class(lat, hcors, vcors, bpms).calculate(tws0)
+    np.testing.assert_allclose(resp, resp_ref, atol=1e-12 * np.max(np.abs(resp_ref)))
@@ -0,0 +1,195 @@
+import json
+
+import numpy as np
+import pytest
+
+from ocelot.cpbd.elements import Drift, Quadrupole, SBend, Sextupole, Multipole
+from ocelot.cpbd.magnetic_lattice import MagneticLattice
+from ocelot.cpbd.transformations import TransferMap, SecondTM, KickTM
+from ocelot.cpbd.navi import Navigator
+from ocelot.cpbd.beam import ParticleArray, Twiss
+from ocelot.cpbd.ring_tracking import RingTracker, track_turns, naff_tune
+from ocelot.cpbd.optics import twiss
+from ocelot.cpbd.track import create_track_list, freq_analysis, fma, track_nturns, aperture_limit
+
+
+def make_lattice(sext_method, **kick_params):
+    sf = Sextupole(l=0.01, k2=150.0, tilt=0.02)
+    sd = Sextupole(l=0.01, k2=-150.0)
+    sd.dx = 1e-4
+    q1, q2, q3 = Quadrupole(l=0.4, k1=-1.3), Quadrupole(l=0.8, k1=1.4), Quadrupole(l=0.4, k1=-1.7)
+    b = SBend(l=2.7, k1=-.06, angle=np.pi / 8, e1=np.pi / 16, e2=np.pi / 16)
+    d1, d2, d3, d4, d5, d6 = [Drift(l=l) for l in [2.0, 0.6, 0.3, 0.7, 0.9, 0.2]]
+    cell = [d1, q1, d2, q2, d3, q3, d4, b, d5, sd, d5, sf, d6, Multipole(kn=[0., 0.01, 5., 30.]),
+            Quadrupole(l=0.5, k1=1.19250444829), d6, sf, d5, sd, d5, b, d4, q3, d3, q2, d2, q1, d1]
+    lat = MagneticLattice(cell, method={"global": TransferMap, Sextupole: sext_method})
+    if kick_params:
+        sf.set_tm(KickTM, **kick_params)
+        sd.set_tm(KickTM, **kick_params)
+    return lat
+
+
+def track_reference(lat, X0, nturns, nsuperperiods, limits, energy):
+    t_maps = Navigator(lat).get_map(lat.totalLen)
+    loss_turn = -np.ones(X0.shape[1], dtype=int)
+    X = X0.copy()
+    p_array = ParticleArray()
+    p_array.rparticles = X0.copy()
+    p_array.E = energy
+    with np.errstate(all="ignore"):
+        for turn in range(nturns):
+            for _ in range(nsuperperiods):
+                for tm in t_maps:
+                    tm.apply(p_array)
+                x = p_array.rparticles
+                lost = (loss_turn < 0) & ~np.all(np.abs(x[:4]) <= limits[[0, 2, 1, 3], np.newaxis], axis=0)
+                loss_turn[lost] = turn
+                X[:, lost] = x[:, lost]
+    X[:, loss_turn < 0] = p_array.rparticles[:, loss_turn < 0]
+    return X, loss_turn
+
+
+@pytest.mark.parametrize("sext_method, kick_params",
+                         [(KickTM, {}), (SecondTM, {}), (KickTM, {"nkick": 2, "integrator": "yoshida4"})])
+@pytest.mark.parametrize("compiled", [False, True])
+def test_ring_tracker(sext_method, kick_params, compiled):
+    if compiled and track_turns is None:
+        pytest.skip("numba is not installed")
+    lat = make_lattice(sext_method, **kick_params)
+    np.random.seed(1)
+    X0 = np.zeros((6, 60))
+    X0[0] = np.random.uniform(-0.01, 0.01, 60)
+    X0[2] = np.random.uniform(0, 0.005, 60)
+    X0[5] = np.random.uniform(-1e-3, 1e-3, 60)
+    aperture = (0.14, 0.12, 0.22, 0.23)
+    nturns = 24
+
+    X_ref, loss_ref = track_reference(lat, X0, nturns, 2, np.array(aperture), energy=3.)
+    tracker = RingTracker(lat, nsuperperiods=2, aperture=aperture, record_step=3)
+    tracker.compiled = compiled
+    X = tracker.track(X0, nturns, energy=3.)
+
+    assert 0 < np.sum(loss_ref >= 0) < 60
+    np.testing.assert_array_equal(tracker.loss_turn, loss_ref)
+    np.testing.assert_allclose(X, X_ref, rtol=1e-9, atol=1e-12)
+
+    turns, record = tracker.get_record()
+    np.testing.assert_array_equal(turns, np.arange(0, nturns + 1, 3))
+    np.testing.assert_array_equal(record[0], X0)
+    alive = loss_ref < 0
+    np.testing.assert_allclose(record[-1][:, alive], X_ref[:, alive], rtol=1e-9, atol=1e-12)
+    for k, turn in enumerate(turns):
+        assert np.all(np.isnan(record[k][:, (loss_ref >= 0) & (loss_ref < turn)]))
+
+    # the ring buffer keeps the last records
+    tracker = RingTracker(lat, nsuperperiods=2, aperture=aperture, record_step=3, nrecords=4)
+    tracker.compiled = compiled
+    tracker.track(X0, nturns, energy=3.)
+    turns_buf, record_buf = tracker.get_record()
+    np.testing.assert_array_equal(turns_buf, turns[-4:])
+    np.testing.assert_allclose(record_buf, record[-4:], rtol=1e-9, atol=1e-12)
+
+
+def test_naff_tune():
+    t = np.arange(512)
+    nu = np.array([0.1234567, 0.31, 0.4888])
+    signal = np.cos(2 * np.pi * nu[:, np.newaxis] * t + 0.3) + 0.1 * np.cos(4 * np.pi * nu[:, np.newaxis] * t)
+    np.testing.assert_allclose(naff_tune(signal), nu, atol=1e-7)
+    np.testing.assert_allclose(naff_tune(np.exp(-2j * np.pi * nu[:, np.newaxis] * t)), 1 - nu, atol=1e-10)
+    signal[1, 10] = np.nan
+    assert np.isnan(naff_tune(signal)[1])
+
+
+def make_fodo_ring():
+    qf, qd = Quadrupole(l=0.3, k1=1.2), Quadrupole(l=0.3, k1=-1.2)
+    cell = [qf, Drift(l=1.), SBend(l=1.5, angle=np.pi / 8), Drift(l=1.), qd, Drift(l=1.),
+            SBend(l=1.5, angle=np.pi / 8), Drift(l=1.)]
+    return MagneticLattice(cell)
+
+
+def test_frequency_map():
+    lat = make_fodo_ring()
+    tws = twiss(lat, Twiss())
+    X0 = np.zeros((6, 10))
+    X0[0] = np.linspace(1e-4, 1e-3, 10)
+    X0[2] = np.linspace(1e-4, 1e-3, 10)
+    tracker = RingTracker(lat, nsuperperiods=8, record_step=1)
+    tracker.track(X0, 256)
+    nux, nuy, diffusion = tracker.frequency_map(tws=tws[0])
+    np.testing.assert_allclose(nux, tws[-1].mux * 8 / (2 * np.pi) % 1, atol=1e-8)
+    np.testing.assert_allclose(nuy, tws[-1].muy * 8 / (2 * np.pi) % 1, atol=1e-8)
+    assert np.all(diffusion < -8)
+
+
+@pytest.mark.parametrize("method", ["naff", "fft"])
+def test_freq_analysis_coupled_motion(method):
+    # the coupling line nux - nuy is stronger than the betatron lines, harm=True searches around the linear tunes
+    lat = make_fodo_ring()
+    tws = twiss(lat, Twiss())
+    nux, nuy = (tws[-1].mux * 8 / (2 * np.pi)) % 1, (tws[-1].muy * 8 / (2 * np.pi)) % 1
+    nux, nuy = min(nux, 1 - nux), min(nuy, 1 - nuy)
+    nu_c = abs(nux - nuy)
+    nturns = 512
+    t = np.arange(nturns + 1)[:, np.newaxis]
+    track_list = create_track_list([1e-3], [1e-3], [0.])
+    coords = np.zeros((nturns + 1, 6))
+    coords[:, [0]] = 0.2e-3 * np.cos(2 * np.pi * nux * t) + 1e-3 * np.cos(2 * np.pi * nu_c * t)
+    coords[:, [2]] = 0.2e-3 * np.cos(2 * np.pi * nuy * t) + 1e-3 * np.cos(2 * np.pi * nu_c * t + 1.)
+    track_list[0].p_list = coords.tolist()
+    track_list[0].turn = nturns - 1
+    atol = 1e-6 if method == "naff" else 1. / nturns
+
+    pxy = freq_analysis(track_list, lat, nturns, harm=True, nsuperperiods=8, method=method)[0]
+    assert pxy.mux == pytest.approx(nux, abs=atol)
+    assert pxy.muy == pytest.approx(nuy, abs=atol)
+    if method == "naff":
+        pxy = freq_analysis(track_list, lat, nturns, harm=False, method=method)[0]
+        assert pxy.mux == pytest.approx(nu_c, abs=atol)
+        assert pxy.muy == pytest.approx(nu_c, abs=atol)
+
+
+def test_fma():
+    pytest.importorskip("mpi4py")
+    lat = make_fodo_ring()
+    tws = twiss(lat, Twiss())
+    nux, nuy = (tws[-1].mux * 8 / (2 * np.pi)) % 1, (tws[-1].muy * 8 / (2 * np.pi)) % 1
+    x_array, y_array = np.linspace(1e-4, 1e-3, 3), np.linspace(1e-4, 1e-3, 2)
+    ctr_da, mux, muy = fma(lat, 256, x_array, y_array, nsuperperiods=8)
+    assert mux.shape == muy.shape == ctr_da.shape == (2, 3)
+    assert np.all(ctr_da == 256)
+    np.testing.assert_allclose(mux, min(nux, 1 - nux), atol=1e-6)
+    np.testing.assert_allclose(muy, min(nuy, 1 - nuy), atol=1e-6)
+    ctr_da, mux_d, muy_d, diffusion = fma(lat, 256, x_array, y_array, nsuperperiods=8, return_diffusion=True)
+    np.testing.assert_array_equal(mux_d, mux)
+    assert np.all(diffusion < -6)
+
+
+def track_nturns_rm_tails(lat, nturns, track_list, nsuperperiods):
+    # previous implementation of track_nturns, the lost particles are deleted with ParticleArray.rm_tails
+    limits = aperture_limit(lat, xlim=1, ylim=1)
+    t_maps = Navigator(lat).get_map(lat.totalLen)
+    p_array = ParticleArray()
+    p_array.list2array([pxy.particle for pxy in track_list])
+    alive = np.arange(len(track_list))
+    turns = np.zeros(len(track_list), dtype=int)
+    for turn in range(nturns):
+        for _ in range(nsuperperiods):
+            for tm in t_maps:
+                tm.apply(p_array)
+            alive = np.delete(alive, p_array.rm_tails(*limits))
+        turns[alive] = turn
+    return turns
+
+
+def test_track_nturns_loss_turns():
+    lat = make_lattice(KickTM)
+    nturns = 40
+    turns_ref = track_nturns_rm_tails(lat, nturns, create_track_list(np.linspace(-0.03, 0.03, 15),
+                                                                     np.linspace(1e-4, 0.02, 8), [0.]), 4)
+    track_list = track_nturns(lat, nturns, create_track_list(np.linspace(-0.03, 0.03, 15), np.linspace(1e-4, 0.02, 8),
+                                                             [0.]), nsuperperiods=4, print_progress=False)
+    turns = [pxy.turn for pxy in track_list]
+    assert 0 < np.sum(turns_ref < nturns - 1) < len(turns_ref)
+    np.testing.assert_array_equal(turns, turns_ref)
+    assert all(type(turn) is int for turn in turns)
+    json.dumps(turns)
@@ -0,0 +1,163 @@
+import pytest
+import numpy as np
+
+from ocelot.cpbd.sc import SpaceCharge, SpaceChargeRZ, GreenFunctionCache, deposit_charge, deposit_charge_np
+
+
+def test_kernel_cache_scaling():
+    sc = SpaceCharge()
+    cache = GreenFunctionCache(maxsize=2)
+    shape = (7, 9, 11)
+    steps = np.array([2e-5, 3e-5, 7e-6])
+
+    K_fft = cache.get_kernel_fft(shape, steps, sc.kernel_fft)
+    np.testing.assert_allclose(K_fft, sc.kernel_fft(shape, steps), rtol=1e-10, atol=1e-12 * np.max(np.abs(K_fft)))
+    assert cache.misses == 1
+
+    # the same step ratios -> kernel is taken from the cache
+    cache.get_kernel_fft(shape, steps * 3., sc.kernel_fft)
+    assert cache.hits == 1 and cache.misses == 1
+
+    cache.get_kernel_fft((5, 5, 5), steps, sc.kernel_fft)
+    cache.get_kernel_fft((5, 5, 7), steps, sc.kernel_fft)
+    assert len(cache.kernels) == 2
+    assert (shape, 1.5, 0.35) not in cache.kernels
+
+
+def test_snap_steps():
+    sc = SpaceCharge(kernel_rtol=1e-2)
+    steps = np.array([1e-5, 2.2e-5, 0.61e-5])
+    snapped = sc.snap_steps(steps.copy())
+    assert snapped[0] == steps[0]
+    assert np.all(snapped[1:] >= steps[1:])
+    assert np.all(snapped[1:] <= steps[1:] * (1 + 1e-2))
+
+    snapped2 = sc.snap_steps(steps * [1, 1.001, 0.999])
+    np.testing.assert_allclose(snapped2[1:] / snapped2[0], snapped[1:] / snapped[0], rtol=1e-12)
+
+
+def test_potential_point_charge():
+    sc = SpaceCharge()
+    n = 15
+    q = np.zeros((n, n, n))
+    q[n // 2, n // 2, n // 2] = 1.
+    steps = np.array([1e-3, 1e-3, 1e-3])
+    p1 = sc.potential(q, steps)
+    p2 = sc.potential(q, steps)
+    np.testing.assert_allclose(p1, p2)
+    # far from the charge the potential is close to the point charge potential
+    eps0 = 8.8541878128e-12
+    r = 5 * steps[0]
+    np.testing.assert_allclose(p1[n // 2 + 5, n // 2, n // 2], 1 / (4 * np.pi * eps0 * r), rtol=1e-2)
+
+
+@pytest.mark.parametrize("order", [0, 1, 2])
+def test_deposit_charge(order):
+    rng = np.random.default_rng(0)
+    U = rng.uniform(1, 9, size=(500, 3))
+    Q = rng.uniform(0, 1, size=500)
+    nxyz = np.array([11, 12, 13])
+    q = deposit_charge(U, Q, nxyz, order)
+    np.testing.assert_allclose(q, deposit_charge_np(U, Q, nxyz, order), atol=1e-12)
+    np.testing.assert_allclose(np.sum(q), np.sum(Q))
+    # the first moment is conserved for CIC and TSC
+    if order > 0:
+        x_grid = np.arange(nxyz[0])[:, None, None]
+        np.testing.assert_allclose(np.sum(q * x_grid), np.dot(Q, U[:, 0]))
+
+
+@pytest.mark.parametrize("deposition", ["cic", "tsc"])
+def test_el_field_deposition(deposition):
+    rng = np.random.default_rng(1)
+    X = rng.normal(size=(20000, 3)) * [1e-4, 2e-4, 3e-4]
+    Q = np.ones(20000) * 1e-15
+    nxyz = np.array([31, 31, 31])
+    E_ngp = SpaceCharge(deposition="ngp").el_field(X.copy(), Q, 10., nxyz)
+    E = SpaceCharge(deposition=deposition).el_field(X.copy(), Q, 10., nxyz)
+    for i in range(3):
+        assert np.std(E[:, i] - E_ngp[:, i]) < 0.05 * np.std(E_ngp[:, i])
+
+
+def test_potential_rfft_solver():
+    rng = np.random.default_rng(2)
+    q = rng.random((10, 11, 12))
+    steps = np.array([1., 2., 3.])
+    p = SpaceCharge().potential(q, steps)
+    sc = SpaceCharge(solver="rfft")
+    p_rfft = sc.potential(q, steps)
+    np.testing.assert_allclose(p_rfft, p, rtol=1e-10)
+    assert sc.solve_stats["memory"] > 0
+
+
+def test_el_field_mesh_percentile():
+    rng = np.random.default_rng(3)
+    X = rng.normal(size=(20000, 3)) * [1e-4, 2e-4, 3e-4]
+    X[:10] *= 50
+    Q = np.ones(20000) * 1e-15
+    nxyz = np.array([31, 31, 31])
+    sc = SpaceCharge(mesh_percentile=0.5)
+    E = sc.el_field(X.copy(), Q, 1., nxyz)
+    assert sc.solve_stats["n_halo"] >= 10
+    # far halo particles see the point charge of the core
+    r = np.linalg.norm(X[0])
+    np.testing.assert_allclose(np.linalg.norm(E[0]), np.sum(Q) / (4 * np.pi * 8.8541878128e-12 * r ** 2), rtol=0.1)
+
+
+def test_el_field_mesh_percentile_halo_charge():
+    rng = np.random.default_rng(3)
+    X = rng.normal(size=(20000, 3)) * [1e-4, 2e-4, 3e-4]
+    Q = np.ones(20000) * 1e-15
+    nxyz = np.array([31, 31, 31])
+    E_ref = SpaceCharge(mesh_percentile=0.5).el_field(X.copy(), Q, 1., nxyz)
+    # a compact and heavy halo clump far from the bunch
+    X[:20] = [1e-2, 0., 0.]
+    Q[:20] = 5e-11
+    sc = SpaceCharge(mesh_percentile=0.5)
+    E = sc.el_field(X.copy(), Q, 1., nxyz)
+    assert sc.solve_stats["n_halo"] >= 20
+    # the core feels the field of the halo charge
+    E_halo = np.sum(Q[:20]) / (4 * np.pi * 8.8541878128e-12 * 1e-2 ** 2)
+    dE = np.median(E[1000:, 0] - E_ref[1000:, 0])
+    np.testing.assert_allclose(dE, -E_halo, rtol=0.05)
+
+
+@pytest.mark.parametrize("sigma_z", [3e-5, 3e-4, 3e-3])
+def test_space_charge_rz_round_beam(sigma_z):
+    rng = np.random.default_rng(4)
+    X = rng.normal(size=(50000, 3)) * [1e-4, 1e-4, sigma_z]
+    Q = np.ones(50000) * 1e-15
+    nxyz = np.array([63, 63, 63])
+    E_3d = SpaceCharge().el_field(X.copy(), Q, 5., nxyz)
+    sc_rz = SpaceChargeRZ()
+    E_rz = sc_rz.el_field(X.copy(), Q, 5., nxyz)
+    assert sc_rz.n_3d == 0
+    for i in range(3):
+        assert np.std(E_rz[:, i] - E_3d[:, i]) < 0.1 * np.std(E_3d[:, i])
+
+
+def test_space_charge_rz_kernel_cache():
+    X0 = np.random.default_rng(4).normal(size=(20000, 3)) * [1e-4, 1e-4, 3e-4]
+    Q = np.ones(20000) * 1e-15
+    nxyz = np.array([63, 63, 63])
+    SpaceChargeRZ.rz_kernel_cache.clear()
+    sc_rz = SpaceChargeRZ()
+    # the slowly changing aspect ratio (0.3 % per step) reuses the kernel
+    for scale_z in 1 + 3e-3 * np.arange(5):
+        sc_rz.el_field(X0 * [1, 1, scale_z], Q, 5., nxyz)
+    assert SpaceChargeRZ.rz_kernel_cache.misses <= 2
+    assert SpaceChargeRZ.rz_kernel_cache.hits >= 3
+    sc_rz.rz_kernel_rtol = 0.
+    misses = SpaceChargeRZ.rz_kernel_cache.misses
+    sc_rz.el_field(X0 * [1, 1, 1.0025], Q, 5., nxyz)
+    assert SpaceChargeRZ.rz_kernel_cache.misses == misses + 1
+
+
+def test_space_charge_rz_falls_back_to_3d():
+    rng = np.random.default_rng(5)
+    X = rng.normal(size=(10000, 3)) * [1e-4, 0.5e-4, 3e-4]
+    Q = np.ones(10000) * 1e-15
+    nxyz = np.array([31, 31, 31])
+    sc_rz = SpaceChargeRZ(asymmetry_tol=0.1)
+    E = sc_rz.el_field(X.copy(), Q, 5., nxyz)
+    assert sc_rz.n_3d == 1
+    np.testing.assert_allclose(E, SpaceCharge().el_field(X.copy(), Q, 5., nxyz))
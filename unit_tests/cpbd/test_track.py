@@ -165,3 +165,19 @@ def test_ParameterScanner_scan(pscanner, tmp_path):
 
     assert psf.marker_names == set(MARKER_NAMES)
     assert psf.parameter_values == PARAMETER_VALUES
+
+
+def test_ParameterScanner_scan_shared_backend(pscanner, tmp_path):
+    pscanner.scan(tmp_path / "pickle.hdf5", nproc=2)
+    pscanner.scan(tmp_path / FILENAME, nproc=2, backend="shared")
+    psf_ref = ParameterScanFile(tmp_path / "pickle.hdf5")
+    psf = ParameterScanFile(tmp_path / FILENAME)
+
+    for parray, parray_ref in zip(psf.parray0s(), psf_ref.parray0s()):
+        assert_parray_equality(parray, parray_ref)
+    for parray, parray_ref in zip(psf.parray1s(), psf_ref.parray1s()):
+        assert_parray_equality(parray, parray_ref)
+    for marker_name in MARKER_NAMES:
+        for parray, parray_ref in zip(psf.parray_markers(marker_name), psf_ref.parray_markers(marker_name)):
+            assert_parray_equality(parray, parray_ref)
+    assert psf.parameter_values == PARAMETER_VALUES
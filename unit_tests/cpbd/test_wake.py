@@ -0,0 +1,109 @@
+import copy
+
+import numpy as np
+
+from ocelot.cpbd.wake3D import Wake, WakeTableParallelPlate, wake_convolution, wake_spectrum, fft_wake_convolution
+from ocelot.cpbd.sc import LSC
+from ocelot.cpbd.physics_proc import BeamProjections
+from ocelot.cpbd.magnetic_lattice import MagneticLattice
+from ocelot.cpbd.elements import Drift, Marker
+from ocelot.cpbd.navi import Navigator
+from ocelot.cpbd.beam import generate_parray
+from ocelot.cpbd.track import track
+
+
+def make_wake(table, factor):
+    wake = Wake(step=1, wake_table=table, factor=factor)
+    wake.prepare(None)
+    wake.s_start = wake.s_stop = 0.
+    return wake
+
+
+def make_parray():
+    np.random.seed(10)
+    parray = generate_parray(sigma_x=20e-6, sigma_px=1e-6, sigma_tau=7.5e-6, sigma_p=1.5e-4, charge=0.25e-9,
+                             nparticles=20000, energy=14)
+    parray.rparticles[0] += 20 * parray.rparticles[4]
+    return parray
+
+
+def test_wake_shared_projections():
+    table = WakeTableParallelPlate(b=500e-6, a=0.01, t=0.25e-3, p=0.5e-3, length=1, sigma=12e-6, orient="horz")
+    parray0 = make_parray()
+
+    parray_ref = copy.deepcopy(parray0)
+    make_wake(table, 2.).apply(parray_ref, 1.)
+    LSC().apply(parray_ref, 1.)
+
+    parray = copy.deepcopy(parray0)
+    projections = BeamProjections()
+    for proc in [make_wake(table, 1.), make_wake(table, 1.), LSC(), LSC()]:
+        proc.projections = projections
+        proc.apply(parray, 0.5 if isinstance(proc, LSC) else 1.)
+    # the second Wake and LSC take all projections from the cache
+    assert projections.n_hits == projections.n_calls // 2
+    np.testing.assert_allclose(parray.rparticles, parray_ref.rparticles, rtol=1e-10, atol=1e-15)
+
+
+def test_track_with_shared_projections():
+    table = WakeTableParallelPlate(b=500e-6, a=0.01, t=0.25e-3, p=0.5e-3, length=1, sigma=12e-6, orient="horz")
+    m1, m2 = Marker(), Marker()
+    lat = MagneticLattice([m1, Drift(l=1), Drift(l=1), m2])
+    parray0 = make_parray()
+
+    navi = Navigator(lat, unit_step=0.5)
+    navi.add_physics_proc(make_wake(table, 1.), m1, m2)
+    navi.add_physics_proc(make_wake(table, 1.), m1, m2)
+    _, parray = track(lat, copy.deepcopy(parray0), navi, print_progress=False, calc_tws=False)
+
+    navi = Navigator(lat, unit_step=0.5)
+    navi.add_physics_proc(make_wake(table, 2.), m1, m2)
+    _, parray_ref = track(lat, copy.deepcopy(parray0), navi, print_progress=False, calc_tws=False)
+    np.testing.assert_allclose(parray.rparticles, parray_ref.rparticles, rtol=1e-10, atol=1e-15)
+
+
+def test_fft_wake_convolution():
+    nb = 3000
+    x = -1e-4 + np.arange(nb) * 2e-4 / nb
+    bunch = np.exp(-x ** 2 / (2 * 3e-5 ** 2)) * (x > -8e-5)
+    xw = np.linspace(0, 1e-3, 2000)
+    w = np.cos(xw * 1e4) * np.exp(-xw * 2e3)
+    _, ref = wake_convolution(x, bunch, xw, w)
+    res = fft_wake_convolution(x[1] - x[0], bunch, wake_spectrum(x[1] - x[0], nb, xw, w))
+    np.testing.assert_allclose(res, ref, rtol=0, atol=1e-12 * np.max(np.abs(ref)))
+    assert np.all(res[x <= -8e-5] == 0)
+
+
+def test_wake_spectrum_cache():
+    table = WakeTableParallelPlate(b=500e-6, a=0.01, t=0.25e-3, p=0.5e-3, length=1, sigma=12e-6, orient="horz")
+    wake = make_wake(table, 1.)
+    W0 = table.TH[0][int(table.TH[1][0, 0])][4]
+    spectrum = wake.get_spectrum(W0, 1e-7, 500)
+    assert wake.get_spectrum(W0, 1e-7, 500) is spectrum
+    assert wake.get_spectrum(W0, 1.0001e-7, 500) is not spectrum
+    wake.spectrum_rtol = 1e-3
+    assert wake.get_spectrum(W0, 1.0002e-7, 500) is wake.get_spectrum(W0, 1.0001e-7, 500)
+
+
+def test_cached_wake_tables(tmp_path):
+    from ocelot.cpbd import wake3D
+
+    geometry = dict(b=400e-6, a=0.002, width=0.012, t=0.25e-3, p=0.5e-3, length=1, sigma=20e-6)
+    wake3D._wake_tables_memo.clear()
+    table = wake3D.WakeTableDechirperOffAxis(cache_dir=str(tmp_path), **geometry)
+    wake3D.WakeTableDechirperOffAxis(**geometry)
+    assert len(wake3D._wake_tables_memo) == 1
+    assert len(list(tmp_path.glob("wake_table_*.npz"))) == 1
+
+    # the tables are read from cache_dir without calculation
+    wake3D._wake_tables_memo.clear()
+    calc = wake3D.WakeTableDechirperOffAxis.calculate_wake_tables
+    wake3D.WakeTableDechirperOffAxis.calculate_wake_tables = None
+    try:
+        table_disk = wake3D.WakeTableDechirperOffAxis(cache_dir=str(tmp_path), orient="vert", **geometry)
+    finally:
+        wake3D.WakeTableDechirperOffAxis.calculate_wake_tables = calc
+    wake_horz, wake_vert = calc(table, **geometry)
+    assert len(table_disk.TH[0]) == len(table.TH[0])
+    for T, T_ref in zip(table_disk.TH[0], wake3D.WakeTable().process_wake_table(wake_vert)[0]):
+        np.testing.assert_array_equal(T[4], T_ref[4])
@@ -10,6 +10,7 @@ REF_RES_DIR = FILE_DIR + '/ref_results/'
 from unit_tests.params import *
 from storage_ring_da_conf import *
 from ocelot.cpbd.chromaticity import *
+from ocelot.cpbd.ring_tracking import RingTracker
 
 
 def test_lattice_transfer_map(lattice, tws=None, update_ref_values=False):
@@ -106,7 +107,8 @@ def test_freq_analysis(lattice, tws, update_ref_values=False):
     """Frequency analysis function test"""
 
     pxy_list, nturns = track_nturns_wrapper(lattice)    
-    pxy_list = freq_analysis(pxy_list, lattice, nturns, harm=True)
+    ksi_x, ksi_y, nsuperperiods = compensate_chromaticity_wrapper(lattice)
+    pxy_list = freq_analysis(pxy_list, lattice, nturns, harm=True, nsuperperiods=nsuperperiods)
 
     da_mu = [{'turns': [pxy.mux, pxy.muy]} for pxy in pxy_list]
 
@@ -154,7 +156,14 @@ def track_nturns_wrapper(lattice):
         ksi_x, ksi_y, nsuperperiods = compensate_chromaticity_wrapper(lattice)
         pxy_list = create_track_list_wrapper()
         
-        pytest.srda_pxy_list = track_nturns(lattice, nturns, pxy_list, nsuperperiods=nsuperperiods, save_track=True, print_progress=False)
+        # the references are tracked with numpy, the compiled tracking rounds differently and the chaotic
+        # particles at the border of the DA are lost at other turns
+        compiled = RingTracker.compiled
+        RingTracker.compiled = False
+        try:
+            pytest.srda_pxy_list = track_nturns(lattice, nturns, pxy_list, nsuperperiods=nsuperperiods, save_track=True, print_progress=False)
+        finally:
+            RingTracker.compiled = compiled
         pytest.srda_istracked = True
 
     return pytest.srda_pxy_list, nturns
@@ -71,7 +71,7 @@ def test_freq_analysis(lattice, update_ref_values=False):
     """Frequency analysis function test"""
 
     mu_y_no_u = 0.304171994243
-    mu_y_ref = 0.30322265625
+    mu_y_ref = 0.303436164552
     mu_y_h_ref = 0.3034375
     mu_y_sim_ref = 0.000734494242981
     
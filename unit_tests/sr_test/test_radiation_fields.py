@@ -0,0 +1,76 @@
+import importlib
+
+import numpy as np
+import pytest
+
+from ocelot.cpbd.elements import Drift, Undulator
+from ocelot.cpbd.magnetic_lattice import MagneticLattice
+from ocelot.cpbd.beam import ParticleArray
+from ocelot.common.globals import m_e_GeV
+from ocelot.rad.screen import Screen
+
+# ocelot.rad exports the function radiation_py, which shadows the module of the same name
+radiation_py = importlib.import_module("ocelot.rad.radiation_py")
+
+
+def make_motions():
+    lat = MagneticLattice([Drift(l=0.5), Undulator(Kx=0.43, nperiods=20, lperiod=0.007)])
+    p_array = ParticleArray(n=3)
+    p_array.E = 2.5
+    p_array.rparticles[0] = [0., 1e-5, -2e-5]
+    p_array.rparticles[3] = [0., -3e-6, 1e-6]
+    p_array.rparticles[5] = [0., 1e-3, -1e-3]
+    U, E = radiation_py.track4rad_beam(p_array, lat)
+    gammas, motions = [], []
+    for i in range(p_array.n):
+        for u, e in zip(U, E):
+            gammas.append((1 + p_array.p()[i]) * e / m_e_GeV)
+            motions.append(radiation_py.traj2motion(u[:, i]))
+    return gammas, motions, len(U)
+
+
+def make_screen():
+    screen = Screen()
+    screen.z = 20.
+    screen.size_x = screen.size_y = 0.0005
+    screen.nx, screen.ny = 4, 3
+    screen.start_energy, screen.end_energy, screen.num_energy = 500., 1500., 5
+    screen.update()
+    screen.nullify()
+    return screen
+
+
+def radiation_fields_reference(gammas, motions, screen, nseg):
+    Xscr = screen.Xph
+    Yscr = screen.Yph[:, np.newaxis]
+    Erad = screen.Eph[:, np.newaxis, np.newaxis]
+    shape = (screen.ne, screen.ny, screen.nx)
+    fields = [np.zeros(shape) for _ in range(5)]
+    for m, (gamma, motion) in enumerate(zip(gammas, motions)):
+        if m % nseg == 0:
+            phase = np.zeros(shape)
+        Nmotion = int((len(motion.z) + 1) / 3)
+        half_step = (motion.z[-1] - motion.z[0]) / 2. / (Nmotion - 1)
+        radiation_py.gintegrator_over_traj_py(Nmotion, Xscr, Yscr, Erad, len(motion.z) - 2, gamma, half_step,
+                                              screen.Distance, motion.x, motion.y, motion.z, motion.bx, motion.by,
+                                              motion.XbetaI2, motion.YbetaI2, motion.Bx, motion.By, *fields[:4], phase)
+        if m % nseg == nseg - 1:
+            fields[4] += phase
+    return [f.flatten() for f in fields]
+
+
+@pytest.mark.parametrize("compiled", [False, True])
+def test_radiation_fields(compiled, monkeypatch):
+    if compiled and radiation_py.radiation_kernel is None:
+        pytest.skip("numba is not installed")
+    if not compiled:
+        monkeypatch.setattr(radiation_py, "radiation_kernel", None)
+    gammas, motions, nseg = make_motions()
+    assert nseg == 2
+    screen = make_screen()
+    ref = radiation_fields_reference(gammas, motions, screen, nseg)
+
+    radiation_py.radiation_fields(gammas, motions, screen, nseg=nseg)
+    fields = [screen.arReEx, screen.arImEx, screen.arReEy, screen.arImEy, screen.arPhase]
+    for field, field_ref in zip(fields, ref):
+        np.testing.assert_allclose(field, field_ref, rtol=1e-10, atol=1e-12 * np.max(np.abs(field_ref)))